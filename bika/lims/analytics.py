@@ -0,0 +1,483 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+""" Denormalized extract of the analyses, used by the reports that aggregate
+    analyses over long periods, so they don't have to wake every analysis.
+
+    The extract is stored column by column: numbers (dates as seconds since
+    the epoch, result and specs) in typed arrays ('d') with NaN
+    for missing values, and strings in arrays of codes ('i') that index a
+    vocabulary of the distinct values of the column. The arrays support the
+    buffer protocol, so they can be wrapped with numpy.frombuffer where numpy
+    is available.
+
+    Analyses that change are recorded in a delta (UID -> row) after each
+    workflow transition. The delta is merged into the columns by
+    merge_analyses_extract, usually run every night from the
+    @@merge_analyses_extract view. Until then, the rows of the delta are laid
+    over the columns when the extract is read (see ExtractView), so reports
+    are always up to date.
+"""
+
+from array import array
+from BTrees.OOBTree import OOBTree
+from DateTime import DateTime
+from persistent import Persistent
+from Products.CMFCore.utils import getToolByName
+from bika.lims import logger
+from bika.lims.catalog import CATALOG_ANALYSIS_LISTING
+from bika.lims.utils import dicts_to_dict
+from zope.annotation.interfaces import IAnnotations
+import transaction
+
+# Annotation key of the portal where the extract is stored
+ANALYSES_EXTRACT = 'bika.lims.analytics.extract'
+# Annotation key of the portal where the analyses changed since the last
+# merge are stored
+ANALYSES_EXTRACT_DELTA = 'bika.lims.analytics.delta'
+
+NAN = float('nan')
+
+# Columns of the extract: strings, stored as codes of a vocabulary
+STRING_COLUMNS = (
+    'request_id',
+    'keyword',
+    'title',
+    'service_uid',
+    'category_title',
+    'client_uid',
+    'client_title',
+    'sampletype_uid',
+    'sampletype_title',
+    'samplepoint_title',
+    'analyst',
+    'instrument_uid',
+    'review_state',
+    'cancellation_state',
+    'worksheetanalysis_review_state',
+)
+# Columns of the extract: numbers, stored as floats. NaN if missing
+FLOAT_COLUMNS = (
+    'created',
+    'date_received',
+    'date_published',
+    'date_started',
+    'date_verified',
+    'result',
+    'spec_min',
+    'spec_max',
+    'spec_error',
+)
+
+
+def to_float(value):
+    """ Returns the value passed in as a float, or NaN
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return NAN
+
+
+def to_time(value):
+    """ Returns the DateTime passed in as seconds since the epoch, or NaN
+    """
+    if not isinstance(value, DateTime):
+        return NAN
+    return value.timeTime()
+
+
+def is_nan(value):
+    return value != value
+
+
+def date_range(date_query):
+    """ Returns the date query passed in (as built by formatDateQuery) as a
+        (min, max) tuple of seconds since the epoch, to select a float column
+        of the extract. Returns None if the query is empty
+    """
+    if not date_query:
+        return None
+    dates = date_query['query']
+    if not isinstance(dates, (list, tuple)):
+        dates = [dates]
+    dates = [DateTime(date).timeTime() for date in dates]
+    if date_query['range'] == 'min:max':
+        return tuple(dates)
+    if date_query['range'] == 'min':
+        return (dates[0], None)
+    return (None, dates[0])
+
+
+def get_analysis_row(analysis):
+    """ Returns the row of the extract for the analysis passed in, as a dict
+    """
+    workflow = getToolByName(analysis, 'portal_workflow')
+    request = analysis.aq_parent
+    specs = dicts_to_dict(request.getResultsRange(), 'keyword')
+    specs = specs.get(analysis.getKeyword(), {})
+    row = {
+        'uid': analysis.UID(),
+        'request_id': analysis.getRequestID(),
+        'keyword': analysis.getKeyword(),
+        'title': analysis.Title(),
+        'service_uid': analysis.getServiceUID(),
+        'category_title': analysis.getCategoryTitle(),
+        'client_uid': analysis.getClientUID(),
+        'client_title': analysis.getClientTitle(),
+        'sampletype_uid': analysis.getSampleTypeUID(),
+        'sampletype_title': request.getSampleTypeTitle(),
+        'samplepoint_title': request.getSamplePointTitle(),
+        'analyst': analysis.getAnalyst(),
+        'instrument_uid': analysis.getInstrumentUID(),
+        'created': to_time(analysis.created()),
+        'date_received': to_time(analysis.getDateReceived()),
+        'date_published': to_time(analysis.getDatePublished()),
+        'date_started': to_time(analysis.getStartProcessDate()),
+        'date_verified': to_time(analysis.getDateVerified()),
+        'result': to_float(analysis.getResult()),
+        'spec_min': to_float(specs.get('min')),
+        'spec_max': to_float(specs.get('max')),
+        'spec_error': to_float(specs.get('error')),
+    }
+    for state_var in ('review_state', 'cancellation_state',
+                      'worksheetanalysis_review_state'):
+        row[state_var] = workflow.getInfoFor(analysis, state_var, '')
+    return row
+
+
+def get_row_value(row, name):
+    """ Returns the value of the column in the row (a dict) passed in, as it
+        would be read from the columns of the extract
+    """
+    if name in FLOAT_COLUMNS:
+        return row.get(name, NAN)
+    return row.get(name) or ''
+
+
+def row_matches(row, criteria):
+    """ Returns whether the row (a dict) passed in matches all the criteria,
+        as given to AnalysesExtract.select
+    """
+    for name, value in criteria.items():
+        val = get_row_value(row, name)
+        if name in FLOAT_COLUMNS:
+            low, high = value
+            if low is None:
+                low = float('-inf')
+            if high is None:
+                high = float('inf')
+            if not low <= val <= high:
+                return False
+        else:
+            if not isinstance(value, (list, tuple)):
+                value = [value]
+            if val not in value:
+                return False
+    return True
+
+
+class ExtractReader(object):
+    """ Methods shared by the extract and the views of it
+    """
+
+    def durations(self, positions, now=None):
+        """ Returns the time in minutes taken by the analyses at the positions
+            passed in, as Analysis.getDuration: 0 if not started yet, and up
+            to now (seconds since the epoch) if not verified yet
+        """
+        if now is None:
+            now = DateTime().timeTime()
+        durations = []
+        for start, end in zip(self.values('date_started', positions),
+                              self.values('date_verified', positions)):
+            if is_nan(start):
+                durations.append(0)
+                continue
+            if is_nan(end):
+                end = now
+            durations.append((end - start) / 60.0)
+        return durations
+
+    def rows(self, positions, names):
+        """ Returns the rows at the positions passed in as dicts with the
+            columns passed in
+        """
+        columns = [(name, self.values(name, positions)) for name in names]
+        return [dict([(name, values[num]) for name, values in columns])
+                for num in range(len(positions))]
+
+
+class AnalysesExtract(ExtractReader, Persistent):
+    """ Columns of the extract. The position of each analysis is given by
+        its UID in 'uids'
+    """
+
+    def __init__(self):
+        self.uids = []
+        self.vocabularies = dict([(name, []) for name in STRING_COLUMNS])
+        self.columns = dict([(name, array('i')) for name in STRING_COLUMNS])
+        self.columns.update(
+            dict([(name, array('d')) for name in FLOAT_COLUMNS]))
+        self._codes = None
+
+    def __len__(self):
+        return len(self.uids)
+
+    def __getstate__(self):
+        state = Persistent.__getstate__(self).copy()
+        state.pop('_codes', None)
+        return state
+
+    def __setstate__(self, state):
+        Persistent.__setstate__(self, state)
+        self._codes = None
+
+    def get_code(self, name, value, add=False):
+        """ Returns the code of the value in the vocabulary of the column, or
+            -1 if the value is not in it and add is False
+        """
+        if self._codes is None:
+            self._codes = dict([
+                (column, dict([(val, code) for code, val in
+                               enumerate(self.vocabularies[column])]))
+                for column in STRING_COLUMNS])
+        codes = self._codes[name]
+        code = codes.get(value, -1)
+        if code == -1 and add:
+            code = codes[value] = len(self.vocabularies[name])
+            self.vocabularies[name].append(value)
+            self._p_changed = True
+        return code
+
+    def append(self, row):
+        """ Adds the row (a dict) passed in at the end of the columns
+        """
+        self.uids.append(row['uid'])
+        for name in STRING_COLUMNS:
+            value = row.get(name) or ''
+            self.columns[name].append(self.get_code(name, value, add=True))
+        for name in FLOAT_COLUMNS:
+            self.columns[name].append(row.get(name, NAN))
+        self._p_changed = True
+
+    def merge(self, delta):
+        """ Returns a new extract with the rows of the delta (UID -> row, or
+            None for removed analyses) applied to this one
+        """
+        extract = AnalysesExtract()
+        extract.vocabularies = dict([(name, values[:]) for name, values
+                                     in self.vocabularies.items()])
+        kept = [pos for pos, uid in enumerate(self.uids) if uid not in delta]
+        if len(kept) == len(self.uids):
+            extract.uids = self.uids[:]
+            extract.columns = dict([(name, column[:]) for name, column
+                                    in self.columns.items()])
+        else:
+            extract.uids = [self.uids[pos] for pos in kept]
+            for name, column in self.columns.items():
+                extract.columns[name] = array(
+                    column.typecode, [column[pos] for pos in kept])
+        for row in delta.values():
+            if row is not None:
+                extract.append(row)
+        return extract
+
+    def column(self, name):
+        """ Returns the values of the column. Strings are decoded
+        """
+        if name == 'uid':
+            return self.uids
+        if name in FLOAT_COLUMNS:
+            return self.columns[name]
+        vocabulary = self.vocabularies[name]
+        return [vocabulary[code] for code in self.columns[name]]
+
+    def select(self, **criteria):
+        """ Returns the positions of the rows that match all the criteria.
+            Each criterion is the name of a column, with either a value or
+            a list of values for string columns, or a (min, max) tuple for
+            float columns (either can be None).
+        """
+        positions = None
+        for name, value in criteria.items():
+            column = self.columns[name]
+            if name in FLOAT_COLUMNS:
+                low, high = value
+                if low is None:
+                    low = float('-inf')
+                if high is None:
+                    high = float('inf')
+                test = lambda val: low <= val <= high
+            else:
+                if not isinstance(value, (list, tuple)):
+                    value = [value]
+                codes = set([self.get_code(name, val) for val in value])
+                test = codes.__contains__
+            if positions is None:
+                positions = [pos for pos, val in enumerate(column)
+                             if test(val)]
+            else:
+                positions = [pos for pos in positions if test(column[pos])]
+        if positions is None:
+            positions = range(len(self.uids))
+        return positions
+
+    def values(self, name, positions):
+        """ Returns the values of the column for the positions passed in
+        """
+        column = self.columns[name]
+        if name in FLOAT_COLUMNS:
+            return [column[pos] for pos in positions]
+        vocabulary = self.vocabularies[name]
+        return [vocabulary[column[pos]] for pos in positions]
+
+
+class ExtractView(ExtractReader):
+    """ Read-only view of the extract with the rows of the delta (UID -> row,
+        or None for removed analyses) laid over it, without copying the
+        columns. The rows of the extract changed in the delta are left out,
+        and the rows of the delta are given the positions that follow the
+        ones of the extract.
+    """
+
+    def __init__(self, extract, delta):
+        self.extract = extract
+        changed = set(delta.keys())
+        self.hidden = set([pos for pos, uid in enumerate(extract.uids)
+                           if uid in changed])
+        self.delta_rows = [row for row in delta.values() if row is not None]
+
+    def __len__(self):
+        return len(self.extract) - len(self.hidden) + len(self.delta_rows)
+
+    def column(self, name):
+        """ Returns the values of the column. Strings are decoded
+        """
+        return self.values(name, self.select())
+
+    def select(self, **criteria):
+        """ Returns the positions of the rows that match all the criteria.
+            See AnalysesExtract.select
+        """
+        positions = self.extract.select(**criteria)
+        if self.hidden:
+            positions = [pos for pos in positions if pos not in self.hidden]
+        size = len(self.extract)
+        positions.extend([size + num for num, row
+                          in enumerate(self.delta_rows)
+                          if row_matches(row, criteria)])
+        return positions
+
+    def values(self, name, positions):
+        """ Returns the values of the column for the positions passed in
+        """
+        size = len(self.extract)
+        if name == 'uid':
+            column = self.extract.uids
+        else:
+            column = self.extract.columns[name]
+        vocabulary = self.extract.vocabularies.get(name)
+        values = []
+        for pos in positions:
+            if pos >= size:
+                values.append(get_row_value(self.delta_rows[pos - size],
+                                            name))
+            elif vocabulary is None:
+                values.append(column[pos])
+            else:
+                values.append(vocabulary[column[pos]])
+        return values
+
+
+def group_by(keys, values=None):
+    """ Groups the values by the keys passed in (two sequences of the same
+        length). Returns a dict {key: [values]}, or {key: count} if no values
+        are passed in
+    """
+    groups = {}
+    if values is None:
+        for key in keys:
+            groups[key] = groups.get(key, 0) + 1
+        return groups
+    for key, value in zip(keys, values):
+        groups.setdefault(key, []).append(value)
+    return groups
+
+
+def get_extract_storage(context):
+    """ Returns a tuple (extract, delta) with the extract and the analyses
+        changed since the last merge stored in the portal
+    """
+    portal = getToolByName(context, 'portal_url').getPortalObject()
+    annotations = IAnnotations(portal)
+    if ANALYSES_EXTRACT not in annotations:
+        annotations[ANALYSES_EXTRACT] = AnalysesExtract()
+    if ANALYSES_EXTRACT_DELTA not in annotations:
+        annotations[ANALYSES_EXTRACT_DELTA] = OOBTree()
+    return annotations[ANALYSES_EXTRACT], annotations[ANALYSES_EXTRACT_DELTA]
+
+
+def get_analyses_extract(context):
+    """ Returns the up to date extract of the analyses: the extract itself,
+        or a view of it with the analyses changed since the last merge laid
+        over. Not to be modified
+    """
+    extract, delta = get_extract_storage(context)
+    if not len(delta):
+        return extract
+    return ExtractView(extract, delta)
+
+
+def update_analyses_extract(instance, removed=False):
+    """ Records the current row of the analysis passed in, to be merged into
+        the extract. Called after each workflow transition of the analyses
+    """
+    factory = getToolByName(instance, 'portal_factory', None)
+    if factory is not None and factory.isTemporary(instance):
+        return
+    extract, delta = get_extract_storage(instance)
+    delta[instance.UID()] = None if removed else get_analysis_row(instance)
+
+
+def merge_analyses_extract(context):
+    """ Merges the analyses changed since the last merge into the extract.
+        Returns the number of analyses merged.
+    """
+    portal = getToolByName(context, 'portal_url').getPortalObject()
+    extract, delta = get_extract_storage(portal)
+    changes = dict(delta.items())
+    merged = len(changes)
+    if merged:
+        annotations = IAnnotations(portal)
+        annotations[ANALYSES_EXTRACT] = extract.merge(changes)
+        # Only the rows merged are removed, so analyses changed meanwhile in
+        # other transactions conflict instead of being lost
+        for uid in changes:
+            del delta[uid]
+    logger.info("Analyses extract: {0} analyses merged".format(merged))
+    return merged
+
+
+def rebuild_analyses_extract(context):
+    """ Discards the extract and extracts again all the analyses listed in
+        bika_analysis_catalog. Returns the number of analyses extracted.
+    """
+    portal = getToolByName(context, 'portal_url').getPortalObject()
+    catalog = getToolByName(portal, CATALOG_ANALYSIS_LISTING)
+    brains = catalog.unrestrictedSearchResults(portal_type='Analysis')
+    logger.info("Extracting {0} analyses".format(len(brains)))
+    extract = AnalysesExtract()
+    for num, brain in enumerate(brains):
+        analysis = brain._unrestrictedGetObject()
+        extract.append(get_analysis_row(analysis))
+        if num and num % 1000 == 0:
+            # Let the analyses woken up go
+            transaction.savepoint(optimistic=True)
+            portal._p_jar.cacheGC()
+    annotations = IAnnotations(portal)
+    annotations[ANALYSES_EXTRACT] = extract
+    annotations[ANALYSES_EXTRACT_DELTA] = OOBTree()
+    return len(extract)
@@ -0,0 +1,120 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+""" Index of the references set through IndexedReferenceFields, so the
+    sources that point to an object (e.g. the worksheet an analysis is
+    assigned to) can be looked up without querying reference_catalog or
+    waking the reference objects.
+
+    The index maps (relationship, target UID) to the UIDs of the sources,
+    and (relationship, source UID) to the UIDs of the targets, the latter
+    being used to update the index when the references of a source change.
+"""
+
+from BTrees.OOBTree import OOBTree
+from BTrees.OOBTree import OOTreeSet
+from Products.Archetypes.config import REFERENCE_CATALOG
+from Products.CMFCore.utils import getToolByName
+from bika.lims import logger
+from zope.annotation.interfaces import IAnnotations
+import transaction
+
+# Annotation key of the portal where the back references are stored
+BACKREFERENCES = 'bika.lims.backreferences'
+# Annotation key of the portal where the forward references are stored
+FORWARDREFERENCES = 'bika.lims.forwardreferences'
+
+
+def get_reference_storage(context):
+    """ Returns a tuple (backrefs, forwardrefs) with the BTrees stored in the
+        portal. 'backrefs' maps (relationship, target UID) to an OOTreeSet of
+        source UIDs and 'forwardrefs' maps (relationship, source UID) to the
+        tuple of target UIDs.
+    """
+    portal = getToolByName(context, 'portal_url').getPortalObject()
+    annotations = IAnnotations(portal)
+    for key in (BACKREFERENCES, FORWARDREFERENCES):
+        if key not in annotations:
+            annotations[key] = OOBTree()
+    return annotations[BACKREFERENCES], annotations[FORWARDREFERENCES]
+
+
+def _set(backrefs, forwardrefs, relationship, source_uid, target_uids):
+    """ Sets the targets of the source with the uid passed in for the
+        relationship, updating the back references of the targets added
+        and removed
+    """
+    target_uids = tuple([uid for uid in target_uids if uid])
+    previous = forwardrefs.get((relationship, source_uid), ())
+    if previous == target_uids:
+        return
+    for uid in set(previous).difference(target_uids):
+        sources = backrefs.get((relationship, uid))
+        if sources is None:
+            continue
+        if source_uid in sources:
+            sources.remove(source_uid)
+        if not sources:
+            del backrefs[(relationship, uid)]
+    for uid in set(target_uids).difference(previous):
+        key = (relationship, uid)
+        if key not in backrefs:
+            backrefs[key] = OOTreeSet()
+        backrefs[key].insert(source_uid)
+    if target_uids:
+        forwardrefs[(relationship, source_uid)] = target_uids
+    elif (relationship, source_uid) in forwardrefs:
+        del forwardrefs[(relationship, source_uid)]
+
+
+def set_references(source, relationship, target_uids):
+    """ Indexes the targets the source passed in references under the
+        relationship. Called by IndexedReferenceField after each set.
+    """
+    factory = getToolByName(source, 'portal_factory', None)
+    if factory is not None and factory.isTemporary(source):
+        return
+    backrefs, forwardrefs = get_reference_storage(source)
+    _set(backrefs, forwardrefs, relationship, source.UID(), target_uids)
+
+
+def remove_references(source, relationship):
+    """ Removes the references of the source passed in from the index.
+        Called when the source is deleted.
+    """
+    backrefs, forwardrefs = get_reference_storage(source)
+    _set(backrefs, forwardrefs, relationship, source.UID(), ())
+
+
+def get_backreference_uids(target, relationship):
+    """ Returns the UIDs of the objects referencing the target passed in
+        under the relationship
+    """
+    backrefs, forwardrefs = get_reference_storage(target)
+    sources = backrefs.get((relationship, target.UID()))
+    return sources is not None and list(sources) or []
+
+
+def rebuild_references(context, relationship):
+    """ Discards the index of the relationship passed in and indexes again
+        all the references listed in reference_catalog. Returns the number of
+        references indexed.
+    """
+    backrefs, forwardrefs = get_reference_storage(context)
+    for tree in (backrefs, forwardrefs):
+        for key in [key for key in tree.keys() if key[0] == relationship]:
+            del tree[key]
+    rc = getToolByName(context, REFERENCE_CATALOG)
+    brains = rc.unrestrictedSearchResults(relationship=relationship)
+    logger.info("Indexing {0} '{1}' references".format(
+        len(brains), relationship))
+    targets = {}
+    for brain in brains:
+        targets.setdefault(brain.sourceUID, []).append(brain.targetUID)
+    for num, (source_uid, target_uids) in enumerate(targets.items()):
+        _set(backrefs, forwardrefs, relationship, source_uid, target_uids)
+        if num and num % 1000 == 0:
+            transaction.savepoint(optimistic=True)
+    return len(brains)
@@ -12,7 +12,9 @@ from bika.lims import logger
 from bika.lims.utils import t, dicts_to_dict, format_supsub
 from bika.lims.utils.analysis import format_uncertainty
 from bika.lims.browser.bika_listing import BikaListingView
+from bika.lims.browser.fields.uidreferencefield import resolve_uids
 from bika.lims.config import QCANALYSIS_TYPES
+from bika.lims.content.instrument import get_instrument_validity
 from bika.lims.interfaces import IResultOutOfRange
 from bika.lims.interfaces import IRoutineAnalysis
 from bika.lims.permissions import *
@@ -63,6 +65,10 @@ class AnalysesView(BikaListingView):
         self.portal = getToolByName(context, 'portal_url').getPortalObject()
         self.portal_url = self.portal.absolute_url()
         self.rc = getToolByName(context, REFERENCE_CATALOG)
+        # Vocabularies of the Method and Instrument columns, shared by the
+        # analyses with the same allowed methods and instruments
+        self._methods_vocabularies = {}
+        self._instruments_vocabularies = {}
         # Initializing the deximal mark variable
         self.dmk = ''
         self.scinot = ''
@@ -281,6 +287,13 @@ class AnalysesView(BikaListingView):
         :type analysis: CatalogBrain
         :returns: A list of dicts
         """
+        key = analysis and tuple(sorted(analysis.getAllowedMethodUIDs or []))
+        if key not in self._methods_vocabularies:
+            self._methods_vocabularies[key] = \
+                self._get_methods_vocabulary(analysis)
+        return self._methods_vocabularies[key][:]
+
+    def _get_methods_vocabulary(self, analysis=None):
         ret = []
         if analysis:
             # This function returns  a list of tuples as [(UID,Title),(),...]
@@ -321,11 +334,19 @@ class AnalysesView(BikaListingView):
         :returns: A vocabulary with the instruments for the analysis
         :rtype: A list of dicts: [{'ResultValue':UID, 'ResultText':Title}]
         """
-        ret = []
         if not analysis_brain or not analysis_brain.getInstrumentEntryOfResults:
             return []
-
-        bsc = getToolByName(self.context, 'bika_setup_catalog')
+        key = (analysis_brain.getMethodUID,
+               tuple(sorted(analysis_brain.getAllowedInstrumentUIDs or [])),
+               analysis_brain.meta_type)
+        if key not in self._instruments_vocabularies:
+            self._instruments_vocabularies[key] = \
+                self._get_instruments_vocabulary(analysis_brain)
+        return self._instruments_vocabularies[key][:]
+
+    def _get_instruments_vocabulary(self, analysis_brain):
+        ret = []
+        bsc = self.bsc
 
         m_uid = analysis_brain.getMethodUID
         method = None
@@ -344,13 +365,14 @@ class AnalysesView(BikaListingView):
             instruments = [b.getObject() for b in brains]
 
         for ins in instruments:
+            isvalid, isoutofdate = get_instrument_validity(ins)
             if analysis_brain.meta_type in [
                 'ReferenceAnalysis', 'DuplicateAnalysis'] \
-                    and not ins.isOutOfDate():
+                    and not isoutofdate:
                 # Add the 'invalid', but in-date instrument
                 ret.append({'ResultValue': ins.UID(),
                             'ResultText': ins.Title()})
-            if ins.isValid():
+            if isvalid:
                 # Only add the 'valid' instruments: certificate
                 # on-date and valid internal calibration tests
                 ret.append({'ResultValue': ins.UID(),
@@ -901,10 +923,9 @@ class AnalysesView(BikaListingView):
             if obj.meta_type in ['ReferenceAnalysis',
                                    'DuplicateAnalysis'] or \
                             obj.worksheetanalysis_review_state == 'assigned':
-                full_obj = full_obj if full_obj else obj.getObject()
-                br = full_obj.getBackReferences('WorksheetAnalysis')
-                if len(br) > 0:
-                    ws = br[0]
+                ws_uid = getattr(obj, 'getWorksheetUID', None)
+                ws = ws_uid and resolve_uids(self.context, [ws_uid]).get(ws_uid)
+                if ws:
                     after_icons.append(
                         "<a href='%s'><img "
                         "src='++resource++bika.lims.images/worksheet.png' "
@@ -1122,12 +1143,10 @@ class QCAnalysesView(AnalysesView):
         """
         obj = obj.getObject()
         # Group items by RefSample - Worksheet - Position
-        wss = obj.getBackReferences('WorksheetAnalysis')
-        wsid = wss[0].id if wss and len(wss) > 0 else ''
-        wshref = wss[0].absolute_url() if wss and len(wss) > 0 else None
-        if wshref:
+        ws = obj.getWorksheet()
+        if ws:
             item['replace']['Worksheet'] = "<a href='%s'>%s</a>" % (
-                wshref, wsid)
+                ws.absolute_url(), ws.id)
 
         imgtype = ""
         if obj.portal_type == 'ReferenceAnalysis':
@@ -16,7 +16,9 @@ from smtplib import SMTPAuthenticationError
 from smtplib import SMTPRecipientsRefused, SMTPServerDisconnected
 
 import App
+import json
 import transaction
+from BTrees.OOBTree import OOBTree
 from DateTime import DateTime
 from Products.Archetypes.interfaces import IDateTimeField, IFileField, \
     ILinesField, IReferenceField, IStringField, ITextField
@@ -30,6 +32,7 @@ from bika.lims.browser import BrowserView, ulocalized_time
 from bika.lims.idserver import renameAfterCreation
 from bika.lims.interfaces import IAnalysisRequest, IResultOutOfRange
 from bika.lims.interfaces.field import IUIDReferenceField
+from bika.lims.permissions import Verify
 from bika.lims.utils import attachPdf, createPdf, encode_header, \
     format_supsub, \
     isnumber
@@ -37,6 +40,7 @@ from bika.lims.utils import formatDecimalMark, to_utf8
 from bika.lims.utils.analysis import format_uncertainty
 from bika.lims.vocabularies import getARReportTemplates
 from bika.lims.workflow import wasTransitionPerformed
+from collective.taskqueue.interfaces import ITaskQueue
 from plone.api.portal import get_registry_record
 from plone.api.portal import set_registry_record
 from plone.app.blob.interfaces import IBlobField
@@ -44,7 +48,18 @@ from plone.registry import Record
 from plone.registry import field
 from plone.registry.interfaces import IRegistry
 from plone.resource.utils import queryResourceDirectory
-from zope.component import getAdapters, getUtility
+from time import time
+from ZODB.POSException import ConflictError
+from zope.annotation.interfaces import IAnnotations
+from zope.component import getAdapters, getUtility, queryUtility
+
+# Annotation key of the portal where the UIDs of the ARs waiting to be
+# digested are stored
+DIGEST_QUEUE = 'bika.lims.digest.queue'
+# Name of the collective.taskqueue queue the digestion worker runs in
+DIGEST_TASK_QUEUE = 'ar-digest'
+# Number of times the digestion of an AR is retried on conflict errors
+DIGEST_RETRIES = 3
 
 
 class AnalysisRequestPublishView(BrowserView):
@@ -717,9 +732,10 @@ class AnalysisRequestDigester:
         self.context = ar
         self.request = ar.REQUEST
 
-        # if AR was previously digested, use existing data (if exists)
+        # if AR was previously digested, use existing data (if exists),
+        # unless the AR is still waiting in the digest queue
         verified = wasTransitionPerformed(ar, 'verify')
-        if not overwrite and verified:
+        if not overwrite and verified and not is_digest_queued(ar):
             # Prevent any error related with digest
             data = ar.getDigest() if hasattr(ar, 'getDigest') else {}
             if data:
@@ -749,6 +765,7 @@ class AnalysisRequestDigester:
         data = self._ar_data(ar)
         if hasattr(ar, 'setDigest'):
             ar.setDigest(data)
+            unqueue_digest(ar)
         logger.info("=========== new data for %s created." % ar)
         return data
 
@@ -1253,10 +1270,9 @@ class AnalysisRequestDigester:
         if analysis.portal_type == 'DuplicateAnalysis':
             andict['reftype'] = 'd'
 
-        ws = analysis.getBackReferences('WorksheetAnalysis')
-        andict['worksheet'] = ws[0].id if ws and len(ws) > 0 else None
-        andict['worksheet_url'] = ws[0].absolute_url() \
-            if ws and len(ws) > 0 else None
+        ws = analysis.getWorksheet()
+        andict['worksheet'] = ws.id if ws else None
+        andict['worksheet_url'] = ws.absolute_url() if ws else None
         andict['refsample'] = analysis.getSample().id \
             if analysis.portal_type == 'Analysis' \
             else '%s - %s' % (analysis.aq_parent.id, analysis.aq_parent.Title())
@@ -1402,42 +1418,133 @@ class AnalysisRequestDigester:
         return self.request.form.get('hvisible', '0').lower() in ['true', '1']
 
 
+def get_digest_queue(context):
+    """ Returns the BTree (AR UID -> time queued) of the ARs waiting to be
+        digested, stored in the portal
+    """
+    portal = getToolByName(context, 'portal_url').getPortalObject()
+    annotations = IAnnotations(portal)
+    if DIGEST_QUEUE not in annotations:
+        annotations[DIGEST_QUEUE] = OOBTree()
+    return annotations[DIGEST_QUEUE]
+
+
+def queue_digest(ar):
+    """ Adds the AR to the digest queue and flags it in the request, so the
+        digestion is triggered once the request has finished
+    """
+    get_digest_queue(ar)[ar.UID()] = time()
+    request = ar.REQUEST
+    ars_to_digest = set(request.get('ars_to_digest', []))
+    ars_to_digest.add(ar)
+    request['ars_to_digest'] = ars_to_digest
+
+
+def unqueue_digest(ar):
+    """ Removes the AR from the digest queue
+    """
+    queue = get_digest_queue(ar)
+    if ar.UID() in queue:
+        del queue[ar.UID()]
+
+
+def is_digest_queued(ar):
+    """ Returns True if the digest of the AR is waiting to be rebuilt
+    """
+    return ar.UID() in get_digest_queue(ar)
+
+
+def process_digest_queue(context):
+    """ Digests all the ARs in the digest queue. Each AR is digested and
+        committed in its own transaction, retried on conflict errors, so a
+        long queue neither holds a big transaction open nor conflicts with
+        the users that keep verifying. ARs that still conflict after
+        DIGEST_RETRIES attempts are left in the queue for the next run.
+        Returns the number of ARs digested.
+    """
+    uc = getToolByName(context, 'uid_catalog')
+    digester = AnalysisRequestDigester()
+    digested = 0
+    for uid in list(get_digest_queue(context).keys()):
+        for attempt in range(DIGEST_RETRIES):
+            try:
+                queue = get_digest_queue(context)
+                if uid not in queue:
+                    # Digested on demand in the meantime
+                    break
+                brains = uc.unrestrictedSearchResults(UID=uid)
+                if brains:
+                    digester(brains[0]._unrestrictedGetObject(),
+                             overwrite=True)
+                    digested += 1
+                else:
+                    del queue[uid]
+                transaction.commit()
+                break
+            except ConflictError:
+                transaction.abort()
+                logger.warn("Conflict while digesting %s (attempt %s)"
+                            % (uid, attempt + 1))
+            except Exception:
+                transaction.abort()
+                logger.error("Cannot digest %s: %s"
+                             % (uid, traceback.format_exc()))
+                break
+    return digested
+
+
+class ProcessDigestQueueView(BrowserView):
+    """ Worker that drains the digest queue. Called from the 'ar-digest'
+        task queue once the request that queued the ARs has finished, as the
+        user that queued them. Restricted to the users that can verify, as
+        it digests all the ARs queued.
+    """
+
+    def __call__(self):
+        digested = process_digest_queue(self.context)
+        return json.dumps({'success': True, 'digested': digested})
+
+
 def ARModifiedHandler(instance, event):
     """After any modification of an AR that has already been verified,
-    re-populate the ar.Digest.
+    queue the AR for its ar.Digest to be re-populated.
     """
     if IAnalysisRequest.providedBy(instance):
         if wasTransitionPerformed(instance, 'verify'):
-            request = instance.REQUEST
-            ars_to_digest = set(request.get('ars_to_digest', []))
-            ars_to_digest.add(instance)
-            request['ars_to_digest'] = ars_to_digest
+            queue_digest(instance)
 
 
 def AnalysisAfterTransitionHandler(instance, event):
-    """After a 'verify' transition on any analysis, we must set a flag in
-    the request so that the AR is digested before the request terminates.
-    We're doing it here so that the digestion happens only once at the end
-    of the request, regardless of how many children were transitioned.
+    """After a 'verify' transition on any analysis, we must queue the AR so
+    that it is digested once the request terminates. We're doing it here so
+    that the digestion happens only once, regardless of how many children
+    were transitioned.
     """
     if event.transition and event.transition.id == 'verify':
-        request = instance.REQUEST
-        ar = instance.aq_parent
-        ars_to_digest = set(request.get('ars_to_digest', []))
-        ars_to_digest.add(ar)
-        request['ars_to_digest'] = ars_to_digest
+        queue_digest(instance.aq_parent)
 
 
 def EndRequestHandler(event):
     """At the end of the request, we check, to see if any pre-digestion is
     required, for any ars or analyses that were processed during the request.
+    If the 'ar-digest' task queue is registered and the user is allowed to
+    run the worker, the digestion is left to the worker, so the user does not
+    have to wait for it. Otherwise the ARs are digested right away.
     """
     request = event.request
     ars_to_digest = set(request.get('ars_to_digest', []))
-    digester = AnalysisRequestDigester()
     if ars_to_digest:
-        for ar in ars_to_digest:
-            digester(ar, overwrite=True)
+        portal = getToolByName(
+            list(ars_to_digest)[0], 'portal_url').getPortalObject()
+        task_queue = queryUtility(ITaskQueue, name=DIGEST_TASK_QUEUE)
+        mtool = getToolByName(portal, 'portal_membership')
+        if task_queue is None or not mtool.checkPermission(Verify, portal):
+            digester = AnalysisRequestDigester()
+            for ar in ars_to_digest:
+                digester(ar, overwrite=True)
+        else:
+            path = '/'.join(portal.getPhysicalPath())
+            task_queue.add(path + '/process_digest_queue', method='POST')
     # If this commit() is not here, then the data does not appear to be
     # saved.  IEndRequest happens outside the transaction?
     transaction.commit()
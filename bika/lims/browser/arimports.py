@@ -9,6 +9,7 @@ from bika.lims import bikaMessageFactory as _
 from bika.lims.browser import BrowserView, ulocalized_time
 from bika.lims.browser.bika_listing import BikaListingView
 from bika.lims.interfaces import IClient
+from bika.lims.utils import t
 from bika.lims.utils import tmpID
 from bika.lims.workflow import getTransitionDate
 from plone.app.contentlisting.interfaces import IContentListing
@@ -130,6 +131,12 @@ class ARImportsView(BikaListingView):
             items[x]['DateValidated'] = date if date else ''
             date = getTransitionDate(obj, 'import')
             items[x]['DateImported'] = date if date else ''
+            if items[x]['review_state'] == 'imported' \
+                    and not obj.isImportComplete():
+                # The import was interrupted
+                items[x]['replace']['DateImported'] = \
+                    "<a href='%s/resume_import'>%s</a>" % (
+                        obj.absolute_url(), t(_("Resume import")))
 
         return items
 
@@ -231,3 +238,18 @@ class ClientARImportAddView(BrowserView):
             if not existing:
                 return newname
             nr += 1
+
+
+class ResumeARImportView(BrowserView):
+    """Creates the objects of the rows of an imported ARImport that were not
+    created because the import was interrupted.
+    """
+
+    def __call__(self):
+        if self.context.isImportComplete():
+            addStatusMessage(self.request, _("All the rows have already "
+                                             "been imported"))
+        else:
+            self.context.import_rows()
+            addStatusMessage(self.request, _("Import resumed and completed"))
+        self.request.response.redirect(self.context.absolute_url())
@@ -5,9 +5,11 @@
 
 """ Display lists of items in tables.
 """
+import base64
 import copy
 import json
 import traceback
+import types
 from AccessControl import getSecurityManager
 from Acquisition import aq_inner
 
@@ -30,6 +32,7 @@ from bika.lims.workflow import doActionFor
 from bika.lims.workflow import getAllowedTransitions
 from bika.lims.workflow import skip
 from plone.app.content.browser import tableview
+from plone.memoize import ram
 from plone.i18n.normalizer.interfaces import IIDNormalizer
 from zope.component import getAdapters
 from zope.component import getUtility
@@ -240,6 +243,68 @@ class WorkflowAction:
         return len(transitioned), dest
 
 
+# Catalog indexes that accept range queries, and can therefore be used to
+# fetch the next page of a listing from the last item displayed (cursor)
+CURSOR_INDEX_TYPES = ('FieldIndex', 'DateIndex')
+
+
+def encode_cursor(value, uid, ties):
+    """Returns an opaque token for the position of the item with the uid and
+    sort value passed in. ties is the number of items already displayed that
+    share the same sort value.
+    """
+    return base64.urlsafe_b64encode(json.dumps([value, uid, ties]))
+
+
+def decode_cursor(token):
+    """Returns the (value, uid, ties) tuple of a token generated with
+    encode_cursor, or None if the token is not valid
+    """
+    try:
+        value, uid, ties = json.loads(base64.urlsafe_b64decode(str(token)))
+        ties = int(ties)
+    except (TypeError, ValueError):
+        return None
+    # The value is passed to a range query as it is
+    if not isinstance(value, (basestring, int, long, float)) \
+            or not isinstance(uid, basestring) or ties < 0:
+        return None
+    return value, uid, ties
+
+
+def _state_title_cache_key(method, workflow, portal_type, state, language):
+    """Returns the key used to cache the translated titles of states
+    """
+    path = '/'.join(workflow.getPhysicalPath())
+    return path, portal_type, state, language
+
+
+@ram.cache(_state_title_cache_key)
+def get_state_title(workflow, portal_type, state, language):
+    """Returns the title of the state for the portal type passed in,
+    translated to the language of the current request. The titles are cached
+    for the whole process, keyed by portal_type, state and language
+    """
+    title = workflow.getTitleForStateOnType(state, portal_type)
+    return title and t(PMF(title)) or None
+
+
+def get_column_resolver(string):
+    """Returns a function that returns the same value as
+    getFromString(obj, string) for the obj passed in. Attribute names without
+    dots, like catalog metadata columns, are read directly from the object
+    """
+    if '.' in string:
+        return lambda obj: getFromString(obj, string)
+
+    def resolver(obj):
+        value = getattr(obj, string, None)
+        if isinstance(value, types.MethodType) and callable(value):
+            value = value()
+        return value if value else None
+    return resolver
+
+
 class BikaListingView(BrowserView):
     """
     """
@@ -491,6 +556,12 @@ class BikaListingView(BrowserView):
         self.show_all = False
         self.show_more = False
         self.limit_from = 0
+        # Opaque tokens with the position of the last item displayed and of
+        # the last item to be displayed by this request. See folderitems
+        self.cursor = None
+        self.next_cursor = None
+        self._sort_limit = 0
+        self._truncated = False
         self.mtool = None
         self.member = None
         self.workflow = None
@@ -504,7 +575,8 @@ class BikaListingView(BrowserView):
         # to know if the functionality is activeated or not for its views.
         self.filter_bar_enabled = False
         # Stores the translations of the statuses from the items displayed in
-        # this list. It value is set automatically in folderitems function.
+        # this list, keyed by (portal_type, state). Its value is set
+        # automatically in folderitems function.
         self.state_titles = {}
 
     @property
@@ -544,6 +616,9 @@ class BikaListingView(BrowserView):
 
         Request parameters:
         <form_id>_limit_from:       index of the first item to display
+        <form_id>_cursor:           token of the last item displayed. Takes
+                                    precedence over limit_from if the sort
+                                    index supports range queries
         <form_id>_rows_only:        returns only the rows
         <form_id>_sort_on:          list items are sorted on this key
         <form_id>_manual_sort_on:   no index - sort with python
@@ -583,6 +658,7 @@ class BikaListingView(BrowserView):
 
         self.rows_only = self.request.get('rows_only','') == form_id
         self.limit_from = int(self.request.get(form_id + '_limit_from',0))
+        self.cursor = self.request.get(form_id + '_cursor', None)
 
         # contentFilter is allowed in every self.review_state.
         for k, v in self.review_state.get('contentFilter', {}).items():
@@ -906,6 +982,33 @@ class BikaListingView(BrowserView):
         """
         return True
 
+    def get_column_resolvers(self):
+        """Returns a list of (column key, value resolvers, replace_url
+        resolver) tuples, one for each column, so the column definitions are
+        only parsed once per listing instead of once per row and column
+        """
+        resolvers = []
+        for key, column in self.columns.items():
+            getters = [get_column_resolver(key)]
+            vattr = column.get('attr', None)
+            if vattr:
+                getters.append(get_column_resolver(vattr))
+            replace_url = column.get('replace_url', None)
+            if replace_url:
+                replace_url = get_column_resolver(replace_url)
+            resolvers.append((key, getters, replace_url))
+        return resolvers
+
+    def get_state_title(self, portal_type, state):
+        """Returns the translated title of the state for the portal type
+        """
+        key = (portal_type, state)
+        if key not in self.state_titles:
+            language = self.request.get('LANGUAGE', '')
+            self.state_titles[key] = get_state_title(
+                self.workflow, portal_type, state, language)
+        return self.state_titles[key]
+
     def folderitem(self, obj, item, index):
         """ Service triggered each time an item is iterated in folderitems.
             The use of this service prevents the extra-loops in child objects.
@@ -949,7 +1052,16 @@ class BikaListingView(BrowserView):
         idx = 0
         results = []
         self.show_more = False
-        brains = self._fetch_brains(self.limit_from)
+        self.next_cursor = None
+        cursor_index = self.get_cursor_index()
+        cursor = cursor_index and decode_cursor(self.cursor) or None
+        if cursor:
+            brains = self._fetch_brains(cursor=cursor, limit=True)
+        else:
+            brains = self._fetch_brains(self.limit_from, limit=True)
+        # brains walked through, either rendered or not allowed
+        walked = []
+        resolvers = self.get_column_resolvers()
         for obj in brains:
             # avoid creating unnecessary info for items outside the current
             # batch;  only the path is needed for the "select all" case...
@@ -958,6 +1070,7 @@ class BikaListingView(BrowserView):
                 # Maximum number of items to be shown reached!
                 self.show_more = True
                 break
+            walked.append(obj)
 
             # check if the item must be rendered or not (prevents from
             # doing it later in folderitems) and dealing with paging
@@ -1004,18 +1117,15 @@ class BikaListingView(BrowserView):
             ptype = obj.portal_type
             for state_var, state in states.items():
                 results_dict[state_var] = state
-                st_title = self.state_titles.get(state, None)
-                if not st_title:
-                    try:
-                        st_title = self.workflow.getTitleForStateOnType(state,
-                                                                        ptype)
-                        if st_title:
-                            st_title = t(PMF(st_title))
-                            self.state_titles[state] = st_title
-                    except:
-                        logger.warning("Cannot obtain title for state {0} and "
-                                       "object {1}".format(state, obj.getId))
-                if st_title and state == obj.review_state:
+                if state != obj.review_state:
+                    continue
+                try:
+                    st_title = self.get_state_title(ptype, state)
+                except:
+                    st_title = None
+                    logger.warning("Cannot obtain title for state {0} and "
+                                   "object {1}".format(state, obj.getId))
+                if st_title:
                     results_dict['state_title'] = st_title
 
             # extra classes for individual fields on this item
@@ -1034,25 +1144,20 @@ class BikaListingView(BrowserView):
             #         else:
             #             self.field_icons[auid] = alerts[auid]
             # Search for values for all columns in obj
-            for key in self.columns.keys():
+            for key, getters, replace_url in resolvers:
                 # if the key is already in the results dict
                 # then we don't replace it's value
                 value = results_dict.get(key, '')
                 if not value:
-                    attrobj = getFromString(obj, key)
-                    value = attrobj if attrobj else value
-
-                    # Custom attribute? Inspect to set the value
-                    # for the current column dynamically
-                    vattr = self.columns[key].get('attr', None)
-                    if vattr:
-                        attrobj = getFromString(obj, vattr)
+                    # The column key first, then the custom attribute, if
+                    # any, to set the value for the current column
+                    for getter in getters:
+                        attrobj = getter(obj)
                         value = attrobj if attrobj else value
                     results_dict[key] = value
                 # Replace with an url?
-                replace_url = self.columns[key].get('replace_url', None)
                 if replace_url:
-                    attrobj = getFromString(obj, replace_url)
+                    attrobj = replace_url(obj)
                     if attrobj:
                         results_dict['replace'][key] = \
                             '<a href="%s">%s</a>' % (attrobj, value)
@@ -1063,15 +1168,90 @@ class BikaListingView(BrowserView):
             if item:
                 results.append(item)
                 idx += 1
+
+        if cursor_index and walked:
+            # The catalog results were limited, so there might be more items
+            # even if all the results have been walked through
+            if self._truncated:
+                self.show_more = True
+            if self.show_more:
+                self.next_cursor = self._get_next_cursor(
+                    cursor_index, walked, cursor)
+                self.request.response.setHeader(
+                    'X-Bika-Listing-Cursor', self.next_cursor or '')
         return results
 
-    def _fetch_brains(self, idxfrom=0):
+    def get_cursor_index(self):
+        """Returns the catalog index the listing is sorted on if the next
+        pages can be fetched with a cursor (a range query on that index from
+        the last item displayed) instead of walking all the results from the
+        start. Returns None otherwise.
+        """
+        if not self.pagesize or self.show_all or self.manual_sort_on:
+            return None
+        if self.request.get('show_all', '').lower() == 'true':
+            return None
+        if getattr(self, 'And', None) or getattr(self, 'Or', None):
+            return None
+        if self.get_filter_bar_queryaddition():
+            return None
+        sort_on = self.contentFilter.get('sort_on', None)
+        if not sort_on or not isinstance(sort_on, basestring):
+            return None
+        indexes = getattr(self.contentsMethod, 'Indexes', None)
+        if indexes is None:
+            return None
+        index = indexes.get(sort_on, None)
+        if index is None or index.meta_type not in CURSOR_INDEX_TYPES:
+            return None
+        return index
+
+    def _get_cursor_key(self, index, value):
+        """Returns the value passed in as it is stored in the sort index,
+        so values can be compared with the resolution of the index
+        """
+        if index.meta_type == 'DateIndex':
+            return index._convert(value, None)
+        return value
+
+    def _get_next_cursor(self, index, brains, cursor=None):
+        """Returns the token of the last brain passed in, or None if its sort
+        value cannot be used in a range query
+        """
+        last = brains[-1]
+        value = getattr(last, index.getId(), None)
+        if isinstance(value, DateTime):
+            value = value.timeTime()
+        elif not isinstance(value, (basestring, int, long, float)):
+            return None
+        key = self._get_cursor_key(index, value)
+        ties = 0
+        for brain in reversed(brains):
+            brain_value = getattr(brain, index.getId(), None)
+            if self._get_cursor_key(index, brain_value) != key:
+                break
+            ties += 1
+        if cursor and ties == len(brains) \
+                and self._get_cursor_key(index, cursor[0]) == key:
+            # all the items of this page share the sort value of the
+            # previous page's last item
+            ties += cursor[2]
+        return encode_cursor(value, last.UID, ties)
+
+    def _fetch_brains(self, idxfrom=0, cursor=None, limit=False):
         """Returns the brains that must be displayed in the current list
         Uses the contentFilter and/or contentsMethod class variables (or
         functions) to query against the database. Also takes into account if
         only a subset of the results must be returned by using idxfrom and. If
         the number of results is lower than idxfrom, will return an empty array
+        If limit is True and the sort index supports range queries, the
+        results are limited to the ones required for the current page. If a
+        cursor is passed in, only the results after the item it points to are
+        searched.
         :param idxfrom: index to start to count for results
+        :param cursor: (sort value, uid, ties) of the last item displayed
+        :param limit: whether the caller handles truncated results. Listings
+            that filter out items afterwards (classic mode) need them all
         :return: the list of brains to be displayed in this list
         """
         # Creating a copy of the contentFilter dictionary in order to include
@@ -1083,6 +1263,19 @@ class BikaListingView(BrowserView):
         # Adding the extra filtering elements
         if addition:
             contentFilterTemp.update(addition)
+        # Only query what's needed for this page, if the sort index allows
+        # to search from a given position
+        index = limit and self.get_cursor_index() or None
+        if index:
+            self._sort_limit = idxfrom + self.pagesize + 1
+            if cursor:
+                value, uid, ties = cursor
+                reverse = contentFilterTemp.get('sort_order') == 'reverse'
+                contentFilterTemp[index.getId()] = {
+                    'query': value, 'range': reverse and 'max' or 'min'}
+                self._sort_limit = self.pagesize + ties + 1
+                idxfrom = 0
+            contentFilterTemp['sort_limit'] = self._sort_limit
         # Check for 'and'/'or' logic queries
         if (hasattr(self, 'And') and self.And) \
            or (hasattr(self, 'Or') and self.Or):
@@ -1106,6 +1299,23 @@ class BikaListingView(BrowserView):
         else:
             brains = self.contentsMethod(contentFilterTemp)
 
+        self._truncated = bool(index) and len(brains) >= self._sort_limit
+
+        # Skip the items with the same sort value as the cursor that were
+        # already displayed. The range query includes them
+        if index and cursor:
+            key = self._get_cursor_key(index, value)
+            leading = []
+            for brain in brains:
+                brain_value = getattr(brain, index.getId(), None)
+                if self._get_cursor_key(index, brain_value) != key:
+                    break
+                leading.append(brain.UID)
+                if brain.UID == uid:
+                    break
+            start = uid in leading and len(leading) or min(ties, len(leading))
+            return brains[start:]
+
         # Return a subset of results, if necessary
         if idxfrom and len(brains) > idxfrom:
             return brains[idxfrom:]
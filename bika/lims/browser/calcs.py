@@ -19,7 +19,6 @@ from zope.component import getAdapters
 from zope.interface import implements
 
 import json
-import math
 import plone
 
 
@@ -205,17 +204,11 @@ class ajaxCalculateAnalysisEntry(BrowserView):
                     except ValueError:
                         pass
 
-            # convert formula to a valid python string, ready for interpolation
+            # the formula is shown in the alerts
             formula = calculation.getMinifiedFormula()
-            formula = formula.replace('[', '%(').replace(']', ')f')
             try:
-                formula = eval("'%s'%%mapping" % formula,
-                               {"__builtins__": None,
-                                'math': math,
-                                'context': self.context},
-                               {'mapping': mapping})
                 # calculate
-                result = eval(formula)
+                result = calculation.evaluateFormula(mapping, self.context)
                 Result['result'] = result
                 self.current_results[uid]['result'] = result
             except TypeError as e:
@@ -4,3 +4,4 @@
 # Some rights reserved. See LICENSE.txt, AUTHORS.txt.
 
 from dashboard import DashboardView
+from dashboard import RebuildCountersView
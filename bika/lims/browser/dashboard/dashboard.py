@@ -3,20 +3,75 @@
 # Copyright 2011-2016 by it's authors.
 # Some rights reserved. See LICENSE.txt, AUTHORS.txt.
 
+from AccessControl import getSecurityManager
+from BTrees.IIBTree import IITreeSet
+from BTrees.IIBTree import intersection
 from Products.CMFCore.utils import getToolByName
 from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
 from bika.lims.browser import BrowserView
 from bika.lims.catalog import CATALOG_ANALYSIS_REQUEST_LISTING
 from bika.lims.catalog import CATALOG_ANALYSIS_LISTING
 from bika.lims.catalog import CATALOG_WORKSHEET_LISTING
+from bika.lims.dashboard_counters import get_evolution_counts
+from bika.lims.dashboard_counters import rebuild_evolution_counters
 from bika.lims import bikaMessageFactory as _
 from bika.lims import logger
 from calendar import monthrange
 from DateTime import DateTime
+from plone.memoize import ram
+from time import time
 import plone
 import json
 import datetime
 
+# Number of seconds the counts of objects per state are cached
+STATISTICS_CACHE_TIMEOUT = 60
+
+
+def _cache_key_review_state_counts(method, catalog, query):
+    """
+    This function returns the key used to decide if the counts per state
+    have to be recomputed. The query contains the department filter and the
+    roles of the current user.
+    """
+    key = time() // STATISTICS_CACHE_TIMEOUT, \
+        '/'.join(catalog.getPhysicalPath()), repr(sorted(query.items()))
+    return key
+
+
+@ram.cache(_cache_key_review_state_counts)
+def get_review_state_counts(catalog, query):
+    """ Returns a tuple (total, counts), where total is the number of
+        objects from the catalog that match the query and counts is a dict
+        with the number of those objects in each review_state.
+        Instead of running a search per state, the result set of the query
+        is intersected with the sets of document ids stored in each entry of
+        the review_state index, so all the counts are computed at once.
+    """
+    zcatalog = catalog._catalog
+    docids = None
+    for name, value in query.items():
+        index = zcatalog.indexes.get(name, None)
+        if index is None:
+            continue
+        result = index._apply_index({name: value})
+        if result is None:
+            continue
+        if docids is None:
+            docids = result[0]
+        else:
+            docids = intersection(docids, result[0])
+    counts = {}
+    states = zcatalog.getIndex('review_state')
+    for state, state_docids in states._index.items():
+        if isinstance(state_docids, int):
+            state_docids = IITreeSet((state_docids,))
+        if docids is not None:
+            state_docids = intersection(docids, state_docids)
+        counts[state] = len(state_docids)
+    total = len(docids) if docids is not None else len(zcatalog)
+    return total, counts
+
 
 class DashboardView(BrowserView):
     template = ViewPageTemplateFile("templates/dashboard.pt")
@@ -130,7 +185,17 @@ class DashboardView(BrowserView):
                     self.get_worksheets_section()]
         return sections
 
-    def _getStatistics(self, name, description, url, catalog, criterias, total):
+    def _get_counts(self, catalog, query):
+        """ Returns the total of objects that match the query and the
+            number of them in each review_state. The catalog's security
+            filtering is added to the query, as a catalog search would do.
+        """
+        query = query.copy()
+        user = getSecurityManager().getUser()
+        query['allowedRolesAndUsers'] = catalog._listAllowedRolesAndUsers(user)
+        return get_review_state_counts(catalog, query)
+
+    def _getStatistics(self, name, description, url, counts, states, total):
         out = {'type':        'simple-panel',
                'name':        name,
                'class':       'informative',
@@ -141,7 +206,7 @@ class DashboardView(BrowserView):
         results = 0
         ratio = 0
         if total > 0:
-            results = len(catalog(criterias))
+            results = sum([counts.get(state, 0) for state in states])
             results = results if total >= results else total
             ratio = (float(results)/float(total))*100 if results > 0 else 0
         ratio = str("%%.%sf" % 1) % ratio
@@ -158,13 +223,15 @@ class DashboardView(BrowserView):
         catalog = getToolByName(self.context, CATALOG_ANALYSIS_REQUEST_LISTING)
         query = {'portal_type': "AnalysisRequest",
                  'cancellation_state': ['active']}
+        departments = None
         filtering_allowed = self.context.bika_setup.getAllowDepartmentFiltering()
         if filtering_allowed:
             cookie_dep_uid = self.request.get('filter_by_department_info', '').split(',') if filtering_allowed else ''
             query['getDepartmentUIDs'] = { "query": cookie_dep_uid,"operator":"or" }
+            departments = cookie_dep_uid
 
         # Active Analysis Requests (All)
-        total = len(catalog(query))
+        total, counts = self._get_counts(catalog, query)
 
         # Sampling workflow enabled?
         if (self.context.bika_setup.getSamplingWorkflowEnabled()):
@@ -172,66 +239,63 @@ class DashboardView(BrowserView):
             name = _('Analysis Requests to be sampled')
             desc = _("To be sampled")
             purl = 'samples?samples_review_state=to_be_sampled'
-            query['review_state'] = ['to_be_sampled', ]
-            out.append(self._getStatistics(name, desc, purl, catalog, query, total))
+            states = ['to_be_sampled', ]
+            out.append(self._getStatistics(name, desc, purl, counts, states, total))
 
             # Analysis Requests awaiting to be preserved
             name = _('Analysis Requests to be preserved')
             desc = _("To be preserved")
             purl = 'samples?samples_review_state=to_be_preserved'
-            query['review_state'] = ['to_be_preserved', ]
-            out.append(self._getStatistics(name, desc, purl, catalog, query, total))
+            states = ['to_be_preserved', ]
+            out.append(self._getStatistics(name, desc, purl, counts, states, total))
 
             # Analysis Requests scheduled for Sampling
             name = _('Analysis Requests scheduled for sampling')
             desc = _("Sampling scheduled")
             purl = 'samples?samples_review_state=scheduled_sampling'
-            query['review_state'] = ['scheduled_sampling', ]
-            out.append(self._getStatistics(name, desc, purl, catalog, query, total))
+            states = ['scheduled_sampling', ]
+            out.append(self._getStatistics(name, desc, purl, counts, states, total))
 
         # Analysis Requests awaiting for reception
         name = _('Analysis Requests to be received')
         desc = _("Reception pending")
         purl = 'analysisrequests?analysisrequests_review_state=sample_due'
-        query['review_state'] = ['sample_due', ]
-        out.append(self._getStatistics(name, desc, purl, catalog, query, total))
+        states = ['sample_due', ]
+        out.append(self._getStatistics(name, desc, purl, counts, states, total))
 
         # Analysis Requests under way
         name = _('Analysis Requests with results pending')
         desc = _("Results pending")
         purl = 'analysisrequests?analysisrequests_review_state=sample_received'
-        query['review_state'] = ['attachment_due',
-                                 'sample_received',
-                                 'assigned']
-        out.append(self._getStatistics(name, desc, purl, catalog, query, total))
+        states = ['attachment_due',
+                  'sample_received',
+                  'assigned']
+        out.append(self._getStatistics(name, desc, purl, counts, states, total))
 
         # Analysis Requests to be verified
         name = _('Analysis Requests to be verified')
         desc = _("To be verified")
         purl = 'analysisrequests?analysisrequests_review_state=to_be_verified'
-        query['review_state'] = ['to_be_verified', ]
-        out.append(self._getStatistics(name, desc, purl, catalog, query, total))
+        states = ['to_be_verified', ]
+        out.append(self._getStatistics(name, desc, purl, counts, states, total))
 
         # Analysis Requests verified (to be published)
         name = _('Analysis Requests verified')
         desc = _("Verified")
         purl = 'analysisrequests?analysisrequests_review_state=verified'
-        query['review_state'] = ['verified', ]
-        out.append(self._getStatistics(name, desc, purl, catalog, query, total))
+        states = ['verified', ]
+        out.append(self._getStatistics(name, desc, purl, counts, states, total))
 
         # Analysis Requests published
         name = _('Analysis Requests published')
         desc = _("Published")
         purl = 'analysisrequests?analysisrequests_review_state=published'
-        query['review_state'] = ['published', ]
-        out.append(self._getStatistics(name, desc, purl, catalog, query, total))
+        states = ['published', ]
+        out.append(self._getStatistics(name, desc, purl, counts, states, total))
 
         # Chart with the evolution of ARs over a period, grouped by
         # periodicity
-        del query['review_state']
-        query['sort_on'] = 'created'
-        query['created'] = self.min_date_range
-        outevo = self._fill_dates_evo(catalog, query)
+        outevo = self._fill_dates_evo('AnalysisRequest', departments)
         out.append({'type':         'bar-chart-panel',
                     'name':         _('Evolution of Analysis Requests'),
                     'class':        'informative',
@@ -257,35 +321,32 @@ class DashboardView(BrowserView):
             query['getDepartmentUIDs'] = { "query": cookie_dep_uid,"operator":"or" }
 
         # Active Worksheets (all)
-        total = len(bc(query))
+        total, counts = self._get_counts(bc, query)
 
         # Open worksheets
         name = _('Results pending')
         desc = _('Results pending')
         purl = 'worksheets?list_review_state=open'
-        query['review_state'] = ['open', 'attachment_due']
-        out.append(self._getStatistics(name, desc, purl, bc, query, total))
+        states = ['open', 'attachment_due']
+        out.append(self._getStatistics(name, desc, purl, counts, states, total))
 
         # Worksheets to be verified
         name = _('To be verified')
         desc =_('To be verified')
         purl = 'worksheets?list_review_state=to_be_verified'
-        query['review_state'] = ['to_be_verified', ]
-        out.append(self._getStatistics(name, desc, purl, bc, query, total))
+        states = ['to_be_verified', ]
+        out.append(self._getStatistics(name, desc, purl, counts, states, total))
 
         # Worksheets verified
         name = _('Verified')
         desc =_('Verified')
         purl = 'worksheets?list_review_state=verified'
-        query['review_state'] = ['verified', ]
-        out.append(self._getStatistics(name, desc, purl, bc, query, total))
+        states = ['verified', ]
+        out.append(self._getStatistics(name, desc, purl, counts, states, total))
 
         # Chart with the evolution of WSs over a period, grouped by
         # periodicity
-        del query['review_state']
-        query['sort_on'] = 'created'
-        query['created'] = self.min_date_range
-        outevo = self._fill_dates_evo(bc, query)
+        outevo = self._fill_dates_evo('Worksheet')
         out.append({'type':         'bar-chart-panel',
                     'name':         _('Evolution of Worksheets'),
                     'class':        'informative',
@@ -311,48 +372,47 @@ class DashboardView(BrowserView):
         bc = getToolByName(self.context, CATALOG_ANALYSIS_LISTING)
         query = {'portal_type': "Analysis",
                  'cancellation_state': ['active']}
+        departments = None
         filtering_allowed = self.context.bika_setup.getAllowDepartmentFiltering()
         if filtering_allowed:
             cookie_dep_uid = self.request.get('filter_by_department_info', '').split(',') if filtering_allowed else ''
             query['getDepartmentUID'] = { "query": cookie_dep_uid,"operator":"or" }
+            departments = cookie_dep_uid
 
         # Active Analyses (All)
-        total = len(bc(query))
+        total, counts = self._get_counts(bc, query)
 
         # Analyses to be assigned
         name = _('Assignment pending')
         desc = _('Assignment pending')
         purl = 'aggregatedanalyses'
-        query['review_state'] = ['sample_received', ]
-        out.append(self._getStatistics(name, desc, purl, bc, query, total))
+        states = ['sample_received', ]
+        out.append(self._getStatistics(name, desc, purl, counts, states, total))
 
         # Analyses pending
         name = _('Results pending')
         desc = _('Results pending')
         purl = 'aggregatedanalyses'
-        query['review_state'] = ['assigned','attachment_due']
-        out.append(self._getStatistics(name, desc, purl, bc, query, total))
+        states = ['assigned','attachment_due']
+        out.append(self._getStatistics(name, desc, purl, counts, states, total))
 
         # Analyses to be verified
         name = _('To be verified')
         desc = _('To be verified')
         purl = 'aggregatedanalyses'
-        query['review_state'] = ['to_be_verified', ]
-        out.append(self._getStatistics(name, desc, purl, bc, query, total))
+        states = ['to_be_verified', ]
+        out.append(self._getStatistics(name, desc, purl, counts, states, total))
 
         # Analyses verified
         name = _('Verified')
         desc = _('Verified')
         purl = 'aggregatedanalyses'
-        query['review_state'] = ['verified', ]
-        out.append(self._getStatistics(name, desc, purl, bc, query, total))
+        states = ['verified', ]
+        out.append(self._getStatistics(name, desc, purl, counts, states, total))
 
         # Chart with the evolution of Analyses over a period, grouped by
         # periodicity
-        del query['review_state']
-        query['sort_on'] = 'created'
-        query['created'] = self.min_date_range
-        outevo = self._fill_dates_evo(bc, query)
+        outevo = self._fill_dates_evo('Analysis', departments)
         out.append({'type':         'bar-chart-panel',
                     'name':         _('Evolution of Analyses'),
                     'class':        'informative',
@@ -454,7 +514,12 @@ class DashboardView(BrowserView):
             created = '%s-%s-%s' % (str(created.year())[2:], str(created.month()).zfill(2), str(created.day()).zfill(2))
         return created
 
-    def _fill_dates_evo(self, catalog, query):
+    def _fill_dates_evo(self, portal_type, departments=None):
+        """ Returns the number of objects of the portal_type passed in
+            created in each period, grouped by state. The numbers come from
+            the per-day counters kept up to date by the workflow events, so
+            only the days of the range have to be summed up.
+        """
         outevoidx = {}
         outevo = []
         days = 1
@@ -472,7 +537,7 @@ class DashboardView(BrowserView):
             days = 336
 
         otherstate = _('Other status')
-        statesmap = self.get_states_map(query['portal_type'])
+        statesmap = self.get_states_map(portal_type)
         stats = statesmap.values()
         stats.sort()
         stats.append(otherstate)
@@ -489,30 +554,31 @@ class DashboardView(BrowserView):
                 outevo.append(outdict)
                 outevoidx[currstr] = len(outevo)-1
             curr = curr + datetime.timedelta(days=days)
-        for brain in catalog(query):
-            # Check if we can use the brain
-            if query.get('portal_type', '') in ['AnalysisRequest', 'Analysis']:
-                created = brain.created
-            # I not, get the object
-            else:
-                created = brain.getObject().created()
-            state = brain.review_state
+        counts = get_evolution_counts(self.context, portal_type,
+                                      self.min_date, self.date_to,
+                                      departments)
+        datestrs = {}
+        for (day, state), count in sorted(counts.items()):
             if state not in statesmap:
-                logger.warn("'%s' State for '%s' not available" % (state, query['portal_type']))
+                logger.warn("'%s' State for '%s' not available" % (state, portal_type))
             state = statesmap[state] if state in statesmap else otherstate
-            created = self._getDateStr(self.periodicity, created)
+            if day not in datestrs:
+                created = DateTime(day.year, day.month, day.day)
+                datestrs[day] = self._getDateStr(self.periodicity, created)
+            created = datestrs[day]
             if created in outevoidx:
                 oidx = outevoidx[created]
-                statscount[state] += 1
+                statscount[state] += count
                 if state in outevo[oidx]:
-                    outevo[oidx][state] += 1
+                    outevo[oidx][state] += count
                 else:
-                    outevo[oidx][state] = 1
+                    outevo[oidx][state] = count
             else:
                 # Create new row
                 currow = {'date': created,
-                          state: 1 }
+                          state: count }
                 outevo.append(currow)
+                outevoidx[created] = len(outevo)-1
 
         # Remove all those states for which there is no data
         rstates = [k for k,v in statscount.items() if v==0]
@@ -522,3 +588,14 @@ class DashboardView(BrowserView):
                     del o[r]
 
         return outevo
+
+
+class RebuildCountersView(BrowserView):
+    """ Counts again all the objects displayed in the evolution charts of
+        the dashboard. Needed once after installing the counters on a site
+        with data, and whenever they get out of sync with the catalogs.
+    """
+
+    def __call__(self):
+        total = rebuild_evolution_counters(self.context)
+        return json.dumps({'success': True, 'total': total})
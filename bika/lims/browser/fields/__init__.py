@@ -13,3 +13,4 @@ from .historyawarereferencefield import HistoryAwareReferenceField
 from .coordinatefield import CoordinateField
 from .reflexrulefield import ReflexRuleField
 from .uidreferencefield import UIDReferenceField
+from .indexedreferencefield import IndexedReferenceField
@@ -185,7 +185,7 @@ class ARAnalysesField(ObjectField):
                 state = workflow.getInfoFor(analysis,
                                             'worksheetanalysis_review_state')
                 if state == 'assigned':
-                    ws = analysis.getBackReferences("WorksheetAnalysis")[0]
+                    ws = analysis.getWorksheet()
                     ws.removeAnalysis(analysis)
                 # Unset the partition reference
                 analysis.edit(SamplePartition=None)
@@ -0,0 +1,45 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+from AccessControl import ClassSecurityInfo
+from Products.Archetypes.Field import ReferenceField
+from Products.Archetypes.Registry import registerField
+from bika.lims.backreferences import set_references
+
+
+class IndexedReferenceField(ReferenceField):
+    """ReferenceField that also records its references in the back
+    references index (see bika.lims.backreferences), so the objects that
+    point to a target can be looked up without querying reference_catalog.
+    """
+    _properties = ReferenceField._properties.copy()
+    _properties.update({
+        'type': 'indexedreference',
+    })
+
+    security = ClassSecurityInfo()
+
+    security.declarePrivate('set')
+
+    def set(self, instance, value, **kwargs):
+        """Sets the references and updates the back references index
+        """
+        ReferenceField.set(self, instance, value, **kwargs)
+        if not value:
+            value = ()
+        elif not isinstance(value, (list, tuple)):
+            value = (value, )
+        uids = []
+        for val in value:
+            if isinstance(val, basestring):
+                uids.append(val)
+            elif hasattr(val, 'UID'):
+                uids.append(callable(val.UID) and val.UID() or val.UID)
+        set_references(instance, self.relationship, uids)
+
+
+registerField(IndexedReferenceField,
+              title='Indexed Reference',
+              description='Reference field with an index of back references')
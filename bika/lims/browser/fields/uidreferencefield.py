@@ -15,13 +15,158 @@ from Products.ZCatalog.interfaces import ICatalogBrain
 from bika.lims import logger
 from bika.lims.interfaces.field import IUIDReferenceField
 from plone.api.portal import get_tool
+from zope.annotation.interfaces import IAnnotations
 from zope.interface import implements
 
+# Annotation key of the request where the objects resolved are cached
+UID_CACHE = 'bika.lims.uidreference.cache'
+
 
 class ReferenceException(Exception):
     pass
 
 
+def get_uid_catalog(context):
+    """Returns the uid_catalog tool.
+
+    :param context: Context is only used for acquiring uid_catalog tool.
+    :type context: BaseContent
+    :return: uid_catalog
+    """
+    try:
+        return getToolByName(context, 'uid_catalog')
+    except AttributeError:
+        # Sometimes an object doesn't have an acquisition chain,
+        # in these cases we just hope that get_tool's call to
+        # getSite doesn't fuck up.
+        return get_tool('uid_catalog')
+
+
+def get_uid_cache(context):
+    """Returns the dict {UID: object} of the objects resolved during the
+    current request, or None if there is no request.
+
+    :param context: Context is only used for acquiring the request.
+    :type context: BaseContent
+    :rtype: dict
+    """
+    request = getattr(context, 'REQUEST', None)
+    if request is None or isinstance(request, basestring):
+        return None
+    annotations = IAnnotations(request)
+    if UID_CACHE not in annotations:
+        annotations[UID_CACHE] = {}
+    return annotations[UID_CACHE]
+
+
+def uncache_object(instance):
+    """Removes the object from the cache of the current request. Called when
+    the object is moved or removed, so the object (and its acquisition
+    chain) is not returned after that.
+
+    :param instance: A content object.
+    :type instance: BaseContent
+    """
+    cache = get_uid_cache(instance)
+    if cache:
+        cache.pop(instance.UID(), None)
+
+
+def get_brains(context, uids):
+    """Returns a dict {UID: brain} with the uid_catalog brains of the UIDs
+    passed in, with a single catalog query. UIDs not found are left out.
+
+    :param context: Context is only used for acquiring uid_catalog tool.
+    :type context: BaseContent
+    :param uids: UIDs
+    :type uids: list[string]
+    :rtype: dict
+    """
+    uids = [uid for uid in set(uids) if uid]
+    if not uids:
+        return {}
+    brains = get_uid_catalog(context)(UID=uids)
+    return dict([(brain.UID, brain) for brain in brains])
+
+
+def resolve_uids(context, uids):
+    """Resolves the UIDs passed in to objects. Objects already resolved
+    during the current request are taken from the cache and the rest are
+    looked up with a single uid_catalog query.
+
+    :param context: Context is only used for acquiring uid_catalog tool.
+    :type context: BaseContent
+    :param uids: UIDs
+    :type uids: list[string]
+    :return: dict {UID: object}. UIDs not found are left out.
+    :rtype: dict
+    """
+    cache = get_uid_cache(context)
+    if cache is None:
+        cache = {}
+    objects = {}
+    missing = []
+    for uid in uids:
+        if uid in cache:
+            objects[uid] = cache[uid]
+        elif uid:
+            missing.append(uid)
+    for uid, brain in get_brains(context, missing).items():
+        obj = brain.getObject()
+        if obj is not None:
+            cache[uid] = objects[uid] = obj
+    return objects
+
+
+class UIDReferenceSequence(object):
+    """Sequence of the objects referenced by a multiValued UIDReferenceField,
+    returned by the field's get() when called with lazy=True.
+    The UIDs are looked up in uid_catalog once, but the objects are only
+    resolved when accessed, so len(), truth testing, getUIDs() and
+    membership tests don't wake any object.
+    """
+
+    def __init__(self, context, uids):
+        self.context = context
+        brains = get_brains(context, uids)
+        cache = get_uid_cache(context) or {}
+        # Only UIDs of objects which actually exist
+        self._uids = [uid for uid in uids if uid in brains or uid in cache]
+
+    def getUIDs(self):
+        return self._uids[:]
+
+    def __len__(self):
+        return len(self._uids)
+
+    def __nonzero__(self):
+        return len(self._uids) > 0
+
+    def __contains__(self, value):
+        if is_at_content(value):
+            value = value.UID()
+        elif is_brain(value):
+            value = value.UID
+        return value in self._uids
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            uids = self._uids[index]
+            objects = resolve_uids(self.context, uids)
+            return [objects[uid] for uid in uids if uid in objects]
+        uid = self._uids[index]
+        return resolve_uids(self.context, [uid]).get(uid)
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def __add__(self, other):
+        return self[:] + list(other)
+
+    def __repr__(self):
+        return '<UIDReferenceSequence %r>' % self._uids
+
+
 def is_uid(context, value):
     """Checks that the string passed is a valid UID of an existing object
     
@@ -93,28 +238,52 @@ class UIDReferenceField(StringField):
         elif is_at_content(value):
             return value
         else:
-            try:
-                uc = getToolByName(context, 'uid_catalog')
-            except AttributeError:
-                # Sometimes an object doesn't have an acquisition chain,
-                # in these cases we just hope that get_tool's call to
-                # getSite doesn't fuck up.
-                uc = get_tool('uid_catalog')
-            brains = uc(UID=value)
-            if brains:
-                return brains[0].getObject()
+            obj = resolve_uids(context, [value]).get(value)
+            if obj is not None:
+                return obj
             logger.error(
                 "{}.{}: Resolving UIDReference failed for {}.  No object will "
                 "be returned.".format(context, self.getName(), value))
 
     @security.public
-    def get_uid(self, context, value):
+    def get_objects(self, context, values):
+        """Resolve a list of UIDs to objects with a single catalog query.
+
+        :param context: context is the object containing the field's schema.
+        :type context: BaseContent
+        :param values: UIDs (or objects).
+        :type values: list
+        :return: Returns the Content objects, in the same order. UIDs which
+            can't be resolved are left out.
+        :rtype: list[BaseContent]
+        """
+        uids = [value for value in values
+                if value and not is_at_content(value)]
+        objects = resolve_uids(context, uids)
+        ret = []
+        for value in values:
+            if not value:
+                continue
+            elif is_at_content(value):
+                ret.append(value)
+            elif value in objects:
+                ret.append(objects[value])
+            else:
+                logger.error(
+                    "{}.{}: Resolving UIDReference failed for {}.  No object "
+                    "will be returned.".format(context, self.getName(), value))
+        return ret
+
+    @security.public
+    def get_uid(self, context, value, existing=None):
         """Takes a brain or object (or UID), and returns a UID.
         
         :param context: context is the object who's schema contains this field.
         :type context: BaseContent
         :param value: Brain, object, or UID.
         :type value: Any
+        :param existing: UIDs already known to exist, if any.
+        :type existing: set
         :return: resolved UID.
         :rtype: string
         """
@@ -126,7 +295,9 @@ class UIDReferenceField(StringField):
             ret = value.UID
         elif is_at_content(value):
             ret = value.UID()
-        elif is_uid(context, value):
+        elif existing is not None and value in existing:
+            ret = value
+        elif existing is None and is_uid(context, value):
             ret = value
         else:
             raise ReferenceException("{}.{}: Cannot resolve UID for {}".format(
@@ -140,18 +311,23 @@ class UIDReferenceField(StringField):
         :param context: context is the object who's schema contains this field.
         :type context: BaseContent
         :param kwargs: kwargs are passed directly to the underlying get.
+            If lazy=True is passed, multiValued fields return a
+            UIDReferenceSequence that only resolves the objects accessed.
         :type kwargs: dict
         :return: object or list of objects for multiValued fields.
         :rtype: BaseContent | list[BaseContent]
         """
+        lazy = kwargs.pop('lazy', False)
         value = StringField.get(self, context, **kwargs)
         if self.multiValued:
             # Only return objects which actually exist; this is necessary here
             # because there are no BackReferences, or HoldingReferences.
             # This opens the possibility that deletions leave hanging
             # references.
-            ret = filter(
-                lambda x: x, [self.get_object(context, uid) for uid in value])
+            if lazy:
+                ret = UIDReferenceSequence(context, value or [])
+            else:
+                ret = self.get_objects(context, value or [])
         else:
             ret = self.get_object(context, value)
         return ret
@@ -195,7 +371,13 @@ class UIDReferenceField(StringField):
         if self.multiValued:
             if type(value) not in (list, tuple):
                 value = [value, ]
-            ret = [self.get_uid(context, val) for val in value]
+            # Check the UIDs passed in exist with a single catalog query
+            uids = [val for val in value if isinstance(val, basestring)]
+            existing = set(get_brains(context, uids).keys())
+            cache = get_uid_cache(context)
+            if cache:
+                existing.update([uid for uid in uids if uid in cache])
+            ret = [self.get_uid(context, val, existing) for val in value]
         else:
             # Sometimes we get given a list here with an empty string.
             # This is generated by html forms with empty values.
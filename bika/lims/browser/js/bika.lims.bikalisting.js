@@ -42,8 +42,15 @@ function BikaListingTableView() {
 			var pagesize = parseInt($(this).attr('data-pagesize'));
 			var url = $(this).attr('data-ajax-url');
 			var limit_from = parseInt($(this).attr('data-limitfrom'));
+			// Position of the last item displayed. If present, the server
+			// fetches the next page from there instead of using limit_from
+			var cursor = $(this).attr('data-cursor');
 			url = url.replace('_limit_from=','_olf=');
+			url = url.replace('_cursor=','_ocursor=');
 			url += '&'+formid+"_limit_from="+limit_from;
+			if (cursor) {
+				url += '&'+formid+"_cursor="+encodeURIComponent(cursor);
+			}
 			$('#'+formid+' a.bika_listing_show_more').fadeOut();
 			var tbody = $('table.bika-listing-table[form_id="'+formid+'"] tbody.item-listing-tbody');
 			// The results must be filtered?
@@ -60,7 +67,7 @@ function BikaListingTableView() {
 				filterbar.bika_listing_filter_bar = $.toJSON(filter_options);
 			}
 			$.post(url, filterbar)
-				.done(function(data) {
+				.done(function(data, textStatus, jqXHR) {
 					try {
 						// We must surround <tr> inside valid TABLE tags before extracting
 						var rows = $('<html><table>'+data+'</table></html>').find('tr')
@@ -68,6 +75,9 @@ function BikaListingTableView() {
 						$(tbody).append(rows)
 						// Increase limit_from so that next iteration uses correct start point
 						$('#'+formid+' a.bika_listing_show_more').attr('data-limitfrom', limit_from+pagesize);
+						// And the cursor, if the listing supports it
+						var next_cursor = jqXHR.getResponseHeader('X-Bika-Listing-Cursor');
+						$('#'+formid+' a.bika_listing_show_more').attr('data-cursor', next_cursor || '');
 						loadNewRemarksEventHandlers();
 					}
 					catch (e) {
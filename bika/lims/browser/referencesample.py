@@ -6,10 +6,12 @@
 from AccessControl import getSecurityManager
 from bika.lims.browser import BrowserView
 from bika.lims import bikaMessageFactory as _
+from bika.lims import logger
 from bika.lims.utils import t
 from bika.lims.browser.bika_listing import BikaListingView
 from bika.lims.utils import isActive
 from bika.lims.browser.analyses import AnalysesView
+from bika.lims.browser.fields.uidreferencefield import resolve_uids
 from datetime import datetime
 from operator import itemgetter
 from plone.app.layout.globals.interfaces import IViewView
@@ -157,23 +159,16 @@ class ReferenceAnalysesView(AnalysesView):
         if not item:
             return None
         item['Category'] = obj.getCategoryTitle
-        wss = self.rc.getBackReferences(
-            obj.UID,
-            relationship="WorksheetAnalysis")
-        if not wss:
+        ws_uid = getattr(obj, 'getWorksheetUID', None)
+        ws = ws_uid and resolve_uids(self.context, [ws_uid]).get(ws_uid)
+        if not ws:
             logger.warn(
                 'No Worksheet found for ReferenceAnalysis {}'
                 .format(obj.getId))
-        elif wss and len(wss) == 1:
-            # TODO-performance: We are getting the object here...
-            ws = wss[0].getSourceObject()
+        else:
             item['Worksheet'] = ws.Title()
             anchor = '<a href="%s">%s</a>' % (ws.absolute_url(), ws.Title())
             item['replace']['Worksheet'] = anchor
-        else:
-            logger.warn(
-                'More than one Worksheet found for ReferenceAnalysis {}'
-                .format(obj.getId))
         service_uid = obj.getServiceUID
         self.addToJSON(obj, service_uid, item)
         return item
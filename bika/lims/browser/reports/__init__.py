@@ -7,6 +7,8 @@ import json
 
 from Products.CMFPlone.utils import _createObjectByType
 from bika.lims import bikaMessageFactory as _
+from bika.lims.analytics import merge_analyses_extract
+from bika.lims.analytics import rebuild_analyses_extract
 from bika.lims.utils import isAttributeHidden
 from bika.lims.browser import BrowserView
 from bika.lims.browser.bika_listing import BikaListingView
@@ -19,14 +21,45 @@ from bika.lims.interfaces import IProductivityReport
 from bika.lims.interfaces import IQualityControlReport
 from bika.lims.interfaces import IAdministrationReport
 from bika.lims.catalog.report_catalog import CATALOG_REPORT_LISTING
+from collective.taskqueue.interfaces import ITaskQueue
 from DateTime import DateTime
 from plone.app.layout.globals.interfaces import IViewView
 from Products.CMFCore.utils import getToolByName
 from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
+from Products.statusmessages.interfaces import IStatusMessage
+from AccessControl.SecurityManagement import getSecurityManager
+from AccessControl.SecurityManagement import newSecurityManager
+from AccessControl.SecurityManagement import setSecurityManager
+from ZODB.POSException import ConflictError
 from zope.component import getAdapters
+from zope.component import queryUtility
 from zope.interface import implements
+import hashlib
 import os
 import plone
+import time
+import traceback
+import transaction
+
+# Name of the task queue that renders the reports. If not registered, the
+# reports are rendered right away
+REPORT_TASK_QUEUE = 'report-render'
+# Maximum number of reports rendered at the same time
+REPORT_CONCURRENCY = 2
+# Seconds after which a report waiting to be rendered, or being rendered, is
+# considered abandoned
+REPORT_TIMEOUT = 3600
+# Titles of the statuses of the reports. Reports are 'deferred' while
+# REPORT_CONCURRENCY reports are being rendered
+REPORT_STATUSES = {
+    'pending': _("Queued"),
+    'deferred': _("Queued"),
+    'running': _("Generating"),
+    'done': _("Done"),
+    'failed': _("Failed"),
+}
+# Form parameters that don't change the output of a report
+REPORT_IGNORED_PARAMETERS = ('_authenticator', 'submitted', 'form.submitted')
 
 
 class ProductivityView(BrowserView):
@@ -153,7 +186,10 @@ class ReportHistoryView(BikaListingView):
             'creator': {
                 'title': _("By"),
                 'attr': 'getCreatorFullName',
-                'index': 'Creator', }, }
+                'index': 'Creator', },
+            'status': {
+                'title': _("Status"),
+                'sortable': False, }, }
         self.review_states = [
             {'id': 'default',
              'title': 'All',
@@ -161,7 +197,8 @@ class ReportHistoryView(BikaListingView):
              'columns': ['Title',
                          'file_size',
                          'created',
-                         'creator']},
+                         'creator',
+                         'status']},
         ]
 
         self.contentFilter = {
@@ -189,6 +226,12 @@ class ReportHistoryView(BikaListingView):
 
     def folderitem(self, obj, item, index):
         item = BikaListingView.folderitem(self, obj, item, index)
+        # Reports rendered before the report queue existed have no status
+        status = getattr(obj, 'getRenderStatus', None) or 'done'
+        item['status'] = self.context.translate(REPORT_STATUSES[status])
+        if status != 'done':
+            # Not rendered yet, or failed: there is no file to link to
+            return item
         # https://github.com/collective/uwosh.pfg.d2c/issues/20
         # https://github.com/collective/uwosh.pfg.d2c/pull/21
         item['replace']['Title'] = \
@@ -233,6 +276,65 @@ class SubmitForm(BrowserView):
             self.context.plone_utils.addPortalMessage(message, 'error')
             return self.template()
 
+        # CSV output is returned to the user as it is, so it can't be queued
+        if self.request.get('output_format', '') != 'CSV':
+            task_queue = queryUtility(ITaskQueue, name=REPORT_TASK_QUEUE)
+            if task_queue is not None:
+                return self.queue_report(task_queue, report_id)
+
+        self.setup()
+        Report = self.get_report_class(report_id)
+        if Report is None:
+            return self.template()
+
+        # Render form output
+
+        # the report can add file names to this list; they will be deleted
+        # once the PDF has been generated.  temporary plot image files, etc.
+        self.request['to_remove'] = []
+
+        # Report must return dict with:
+        # - report_title - title string for pdf/history listing
+        # - report_data - rendered report
+        output = Report(self.context, self.request)()
+
+        # if CSV output is chosen, report returns None
+        if not output:
+            return
+
+        if type(output) in (str, unicode, bytes):
+            # remove temporary files
+            for f in self.request['to_remove']:
+                os.remove(f)
+            return output
+
+        result = self.render_pdf(output)
+
+        if result:
+            # Create new report object
+            reportid = self.aq_parent.generateUniqueId('Report')
+            report = _createObjectByType("Report", self.aq_parent, reportid)
+            report.edit(Client=self.clientuid)
+            report.processForm()
+
+            # write pdf to report object
+            report.edit(title=output['report_title'], ReportFile=result)
+            report.reindexObject()
+
+            fn = "%s - %s" % (self.date.strftime(self.date_format_short),
+                              _u(output['report_title']))
+
+            setheader = self.request.RESPONSE.setHeader
+            setheader('Content-Type', 'application/pdf')
+            setheader("Content-Disposition",
+                      "attachment;filename=\"%s\"" % _c(fn))
+            self.request.RESPONSE.write(result)
+
+        return
+
+    def setup(self):
+        """Sets the reporter, laboratory and client the report frame displays
+        """
         self.date = DateTime()
         username = self.context.portal_membership.getAuthenticatedMember().getUserName()
         self.reporter = self.user_fullname(username)
@@ -256,20 +358,17 @@ class SubmitForm(BrowserView):
 
         client = logged_in_client(self.context)
         if client:
-            clientuid = client.UID()
+            self.clientuid = client.UID()
             self.client_title = client.Title()
             self.client_address = client.getPrintAddress()
         else:
-            clientuid = None
+            self.clientuid = None
             self.client_title = None
             self.client_address = None
 
-        # Render form output
-
-        # the report can add file names to this list; they will be deleted
-        # once the PDF has been generated.  temporary plot image files, etc.
-        self.request['to_remove'] = []
-
+    def get_report_class(self, report_id):
+        """Returns the Report class of the report requested, or None
+        """
         if "report_module" in self.request:
             module = self.request["report_module"]
         else:
@@ -283,23 +382,13 @@ class SubmitForm(BrowserView):
             message = "Report %s.Report not found (shouldn't happen)" % module
             self.logger.error(message)
             self.context.plone_utils.addPortalMessage(message, 'error')
-            return self.template()
-
-        # Report must return dict with:
-        # - report_title - title string for pdf/history listing
-        # - report_data - rendered report
-        output = Report(self.context, self.request)()
-
-        # if CSV output is chosen, report returns None
-        if not output:
-            return
-
-        if type(output) in (str, unicode, bytes):
-            # remove temporary files
-            for f in self.request['to_remove']:
-                os.remove(f)
-            return output
+            return None
+        return Report
 
+    def render_pdf(self, output):
+        """Renders the output of the report as a PDF and removes the temporary
+        files the report created
+        """
         # The report output gets pulled through report_frame.pt
         self.reportout = output['report_data']
         framed_output = self.frame_template()
@@ -310,28 +399,215 @@ class SubmitForm(BrowserView):
         # remove temporary files
         for f in self.request['to_remove']:
             os.remove(f)
+        return result
 
-        if result:
-            # Create new report object
-            reportid = self.aq_parent.generateUniqueId('Report')
-            report = _createObjectByType("Report", self.aq_parent, reportid)
-            report.edit(Client=clientuid)
-            report.processForm()
+    def queue_report(self, task_queue, report_id):
+        """Creates a pending Report with the parameters of the form and adds
+        a job to the task queue to render it, unless an identical report is
+        already waiting to be rendered.
+        """
+        client = logged_in_client(self.context)
+        clientuid = client and client.UID() or None
+        parameters = get_report_parameters(self.request)
+        parameters_hash = get_parameters_hash(parameters, clientuid)
+        history_url = self.context.absolute_url() + '/history'
+        if find_queued_reports(self.context, parameters_hash):
+            message = _("An identical report is already being generated")
+            self.context.plone_utils.addPortalMessage(message, 'info')
+            return self.request.RESPONSE.redirect(history_url)
+
+        reportid = self.context.generateUniqueId('Report')
+        report = _createObjectByType("Report", self.context, reportid)
+        report.edit(Client=clientuid)
+        report.processForm()
+        report.edit(title=report_id,
+                    ReportType=report_id,
+                    RenderStatus='pending',
+                    RenderParameters=json.dumps(parameters),
+                    ParametersHash=parameters_hash)
+        report.reindexObject()
+
+        path = '/'.join(self.context.getPhysicalPath())
+        task_queue.add(path + '/render_report', method='POST',
+                       params={'uid': report.UID()})
+        message = _("The report is being generated. It will be listed here "
+                    "once it is ready")
+        self.context.plone_utils.addPortalMessage(message, 'info')
+        return self.request.RESPONSE.redirect(history_url)
+
+
+def get_report_parameters(request):
+    """Returns the parameters of the form submitted to render a report
+    """
+    return dict([(key, value) for key, value in request.form.items()
+                 if key not in REPORT_IGNORED_PARAMETERS])
 
-            # write pdf to report object
-            report.edit(title=output['report_title'], ReportFile=result)
+
+def get_parameters_hash(parameters, clientuid=None):
+    """Returns a hash of the parameters passed in, so identical reports can
+    be found
+    """
+    value = json.dumps([parameters, clientuid], sort_keys=True)
+    return hashlib.sha1(value).hexdigest()
+
+
+def is_report_abandoned(brain):
+    """Returns whether the report of the brain passed in has been waiting to
+    be rendered, or running, for more than REPORT_TIMEOUT seconds, so its
+    job or the process rendering it is likely gone
+    """
+    if brain.getRenderStatus not in ('pending', 'deferred', 'running'):
+        return False
+    since = DateTime() - REPORT_TIMEOUT / 86400.0
+    return brain._unrestrictedGetObject().modified() <= since
+
+
+def find_queued_reports(context, parameters_hash):
+    """Returns the brains of the reports with the hash passed in that are
+    waiting to be rendered. Abandoned reports are left out
+    """
+    catalog = getToolByName(context, CATALOG_REPORT_LISTING)
+    brains = catalog(portal_type='Report',
+                     getParametersHash=parameters_hash,
+                     getRenderStatus=['pending', 'deferred', 'running'])
+    return [brain for brain in brains if not is_report_abandoned(brain)]
+
+
+def count_running_reports(context):
+    """Returns the number of reports being rendered. Abandoned reports are
+    not counted
+    """
+    catalog = getToolByName(context, CATALOG_REPORT_LISTING)
+    brains = catalog.unrestrictedSearchResults(portal_type='Report',
+                                               getRenderStatus='running')
+    return len([brain for brain in brains if not is_report_abandoned(brain)])
+
+
+def resume_deferred_report(context):
+    """Queues again the oldest report deferred because REPORT_CONCURRENCY
+    reports were being rendered. The job runs as the owner of the report,
+    as the job that queued it. Returns the report, or None
+    """
+    task_queue = queryUtility(ITaskQueue, name=REPORT_TASK_QUEUE)
+    if task_queue is None:
+        return None
+    catalog = getToolByName(context, CATALOG_REPORT_LISTING)
+    brains = catalog.unrestrictedSearchResults(portal_type='Report',
+                                               getRenderStatus='deferred',
+                                               sort_on='created')
+    if not brains:
+        return None
+    report = brains[0]._unrestrictedGetObject()
+    report.setRenderStatus('pending')
+    report.reindexObject()
+    path = '/'.join(report.aq_parent.getPhysicalPath())
+    security_manager = getSecurityManager()
+    try:
+        newSecurityManager(None, report.getWrappedOwner())
+        task_queue.add(path + '/render_report', method='POST',
+                       params={'uid': report.UID()})
+    finally:
+        setSecurityManager(security_manager)
+    return report
+
+
+class RenderReportView(SubmitForm):
+    """ Worker that renders a pending report. Called from the
+        'report-render' task queue, as the user that requested the report,
+        with the UID of the Report as 'uid'. If REPORT_CONCURRENCY reports
+        are being rendered, the report is deferred until one of them is
+        done.
+    """
+
+    def __call__(self):
+        uc = getToolByName(self.context, 'uid_catalog')
+        brains = uc(UID=self.request.form.get('uid', ''))
+        report = brains and brains[0].getObject() or None
+        if report is None or report.getRenderStatus() != 'pending':
+            return json.dumps({'success': False})
+
+        if count_running_reports(self.context) >= REPORT_CONCURRENCY:
+            # Too many reports being rendered. Queued again by the first
+            # report that is done
+            report.setRenderStatus('deferred')
             report.reindexObject()
+            return json.dumps({'success': False, 'deferred': True})
 
-            fn = "%s - %s" % (self.date.strftime(self.date_format_short),
-                              _u(output['report_title']))
+        # Claim the report, so no other worker renders it
+        report.setRenderStatus('running')
+        report.reindexObject()
+        transaction.commit()
 
-            setheader = self.request.RESPONSE.setHeader
-            setheader('Content-Type', 'application/pdf')
-            setheader("Content-Disposition",
-                      "attachment;filename=\"%s\"" % _c(fn))
-            self.request.RESPONSE.write(result)
+        start = time.time()
+        try:
+            result, title = self.render(report)
+            report.edit(title=title, ReportFile=result, RenderStatus='done')
+        except ConflictError:
+            # Queue the report again, the job is retried by the task queue
+            transaction.abort()
+            report.setRenderStatus('pending')
+            report.reindexObject()
+            transaction.commit()
+            raise
+        except Exception:
+            transaction.abort()
+            error = traceback.format_exc()
+            self.logger.error("Cannot render report %s: %s"
+                              % (report.getId(), error))
+            report.edit(RenderStatus='failed', RenderError=error)
+        report.reindexObject()
+        self.logger.info("Report %s rendered in %.2fs"
+                         % (report.getId(), time.time() - start))
+        resume_deferred_report(self.context)
+        return json.dumps({'success': report.getRenderStatus() == 'done'})
+
+    def render(self, report):
+        """Renders the report passed in with the parameters it was submitted
+        with. Returns a tuple (pdf, title)
+        """
+        parameters = json.loads(report.getRenderParameters() or '{}')
+        for key, value in parameters.items():
+            self.request.form[key] = value
+            self.request.set(key, value)
 
-        return
+        self.selection_macros = SelectionMacrosView(self.context, self.request)
+        self.additional_reports = []
+        self.setup()
+        Report = self.get_report_class(report.getReportType())
+        if Report is None:
+            raise ValueError("Report %s not found" % report.getReportType())
+        self.request['to_remove'] = []
+        output = Report(self.context, self.request)()
+        if not output or type(output) in (str, unicode, bytes):
+            # Reports return the form with the error messages instead
+            messages = IStatusMessage(self.request).show()
+            raise ValueError('; '.join([m.message for m in messages])
+                             or "No data")
+        result = self.render_pdf(output)
+        if not result:
+            raise ValueError("The PDF could not be created")
+        return result, output['report_title']
+
+
+class MergeAnalysesExtractView(BrowserView):
+    """ Merges the analyses changed since the last merge into the extract the
+        analyses reports are built from. Meant to be called every night, so
+        the reports don't have to apply a large delta each time.
+    """
+
+    def __call__(self):
+        merged = merge_analyses_extract(self.context)
+        return json.dumps({'success': True, 'merged': merged})
+
+
+class RebuildAnalysesExtractView(BrowserView):
+    """ Extracts again all the analyses the reports are built from. Needed
+        once on sites with data, and whenever the extract gets out of sync.
+    """
+
+    def __call__(self):
+        total = rebuild_analyses_extract(self.context)
+        return json.dumps({'success': True, 'total': total})
 
 
 class ReferenceAnalysisQC_Samples(BrowserView):
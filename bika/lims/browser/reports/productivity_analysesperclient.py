@@ -4,6 +4,9 @@
 # Some rights reserved. See LICENSE.txt, AUTHORS.txt.
 
 from Products.CMFCore.utils import getToolByName
+from bika.lims.analytics import date_range
+from bika.lims.analytics import get_analyses_extract
+from bika.lims.analytics import group_by
 from bika.lims.browser import BrowserView
 from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
 from bika.lims import bikaMessageFactory as _
@@ -25,7 +28,6 @@ class Report(BrowserView):
         # get all the data into datalines
 
         pc = getToolByName(self.context, 'portal_catalog')
-        bac = getToolByName(self.context, 'bika_analysis_catalog')
         bc = getToolByName(self.context, 'bika_catalog')
         rc = getToolByName(self.context, 'reference_catalog')
 
@@ -36,6 +38,8 @@ class Report(BrowserView):
         count_all_ars = 0
         count_all_analyses = 0
         query = {}
+        # the same query, on the columns of the analyses extract
+        extract_query = {}
 
         this_client = logged_in_client(self.context)
 
@@ -58,6 +62,7 @@ class Report(BrowserView):
         date_query = formatDateQuery(self.context, 'Requested')
         if date_query:
             query['created'] = date_query
+            extract_query['created'] = date_range(date_query)
             requested = formatDateParms(self.context, 'Requested')
             parms.append(
                 {'title': _('Requested'),
@@ -67,6 +72,7 @@ class Report(BrowserView):
         workflow = getToolByName(self.context, 'portal_workflow')
         if 'bika_analysis_workflow' in self.request.form:
             query['review_state'] = self.request.form['bika_analysis_workflow']
+            extract_query['review_state'] = query['review_state']
             review_state = workflow.getTitleForStateOnType(
                 self.request.form['bika_analysis_workflow'], 'Analysis')
             parms.append(
@@ -75,6 +81,7 @@ class Report(BrowserView):
         if 'bika_cancellation_workflow' in self.request.form:
             query['cancellation_state'] = self.request.form[
                 'bika_cancellation_workflow']
+            extract_query['cancellation_state'] = query['cancellation_state']
             cancellation_state = workflow.getTitleForStateOnType(
                 self.request.form['bika_cancellation_workflow'], 'Analysis')
             parms.append({'title': _('Active'), 'value': cancellation_state,
@@ -83,6 +90,8 @@ class Report(BrowserView):
         if 'bika_worksheetanalysis_workflow' in self.request.form:
             query['worksheetanalysis_review_state'] = self.request.form[
                 'bika_worksheetanalysis_workflow']
+            extract_query['worksheetanalysis_review_state'] = query[
+                'worksheetanalysis_review_state']
             ws_review_state = workflow.getTitleForStateOnType(
                 self.request.form['bika_worksheetanalysis_workflow'], 'Analysis')
             parms.append(
@@ -92,6 +101,8 @@ class Report(BrowserView):
         if 'bika_worksheetanalysis_workflow' in self.request.form:
             query['worksheetanalysis_review_state'] = self.request.form[
                 'bika_worksheetanalysis_workflow']
+            extract_query['worksheetanalysis_review_state'] = query[
+                'worksheetanalysis_review_state']
             ws_review_state = workflow.getTitleForStateOnType(
                 self.request.form['bika_worksheetanalysis_workflow'], 'Analysis')
             parms.append(
@@ -105,6 +116,11 @@ class Report(BrowserView):
                                  _('Number of analyses')],
                    'class': ''}
 
+        # count the analyses of each client in a single pass
+        extract = get_analyses_extract(self.context)
+        positions = extract.select(**extract_query)
+        analyses_counts = group_by(extract.values('client_uid', positions))
+
         datalines = []
 
         if this_client:
@@ -121,9 +137,7 @@ class Report(BrowserView):
             dataitem = {'value': count_ars}
             dataline.append(dataitem)
 
-            query['portal_type'] = 'Analysis'
-            analyses = bac(query)
-            count_analyses = len(analyses)
+            count_analyses = analyses_counts.get(client.UID, 0)
             dataitem = {'value': count_analyses}
             dataline.append(dataitem)
 
@@ -4,6 +4,9 @@
 # Some rights reserved. See LICENSE.txt, AUTHORS.txt.
 
 from Products.CMFCore.utils import getToolByName
+from bika.lims.analytics import date_range
+from bika.lims.analytics import get_analyses_extract
+from bika.lims.analytics import group_by
 from bika.lims.browser import BrowserView
 from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
 from bika.lims import bikaMessageFactory as _
@@ -25,7 +28,6 @@ class Report(BrowserView):
 
         # get all the data into datalines
         sc = getToolByName(self.context, 'bika_setup_catalog')
-        bac = getToolByName(self.context, 'bika_analysis_catalog')
         rc = getToolByName(self.context, 'reference_catalog')
         self.report_content = {}
         parm_lines = {}
@@ -35,18 +37,18 @@ class Report(BrowserView):
         headings['subheader'] = _("Number of analyses requested per sample type")
 
         count_all = 0
-        query = {'portal_type': 'Analysis'}
+        query = {}
         client_title = None
         if 'ClientUID' in self.request.form:
             client_uid = self.request.form['ClientUID']
-            query['getClientUID'] = client_uid
+            query['client_uid'] = client_uid
             client = rc.lookupObject(client_uid)
             client_title = client.Title()
         else:
             client = logged_in_client(self.context)
             if client:
                 client_title = client.Title()
-                query['getClientUID'] = client.UID()
+                query['client_uid'] = client.UID()
         if client_title:
             parms.append(
                 {'title': _('Client'),
@@ -55,7 +57,7 @@ class Report(BrowserView):
 
         date_query = formatDateQuery(self.context, 'Requested')
         if date_query:
-            query['created'] = date_query
+            query['created'] = date_range(date_query)
             requested = formatDateParms(self.context, 'Requested')
             parms.append(
                 {'title': _('Requested'),
@@ -98,12 +100,15 @@ class Report(BrowserView):
                    'class': '',
         }
 
+        # count the analyses of each sample type in a single pass
+        extract = get_analyses_extract(self.context)
+        positions = extract.select(**query)
+        counts = group_by(extract.values('sampletype_uid', positions))
+
         datalines = []
         for sampletype in sc(portal_type="SampleType",
                              sort_on='sortable_title'):
-            query['getSampleTypeUID'] = sampletype.UID
-            analyses = bac(query)
-            count_analyses = len(analyses)
+            count_analyses = counts.get(sampletype.UID, 0)
 
             dataline = []
             dataitem = {'value': sampletype.Title}
@@ -4,6 +4,9 @@
 # Some rights reserved. See LICENSE.txt, AUTHORS.txt.
 
 from Products.CMFCore.utils import getToolByName
+from bika.lims.analytics import date_range
+from bika.lims.analytics import get_analyses_extract
+from bika.lims.analytics import group_by
 from bika.lims.browser import BrowserView
 from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
 from bika.lims import bikaMessageFactory as _
@@ -26,7 +29,6 @@ class Report(BrowserView):
         # get all the data into datalines
 
         sc = getToolByName(self.context, 'bika_setup_catalog')
-        bc = getToolByName(self.context, 'bika_analysis_catalog')
         rc = getToolByName(self.context, 'reference_catalog')
         self.report_content = {}
         parms = []
@@ -35,32 +37,32 @@ class Report(BrowserView):
         headings['subheader'] = _(
             "Number of analyses requested per analysis service")
 
-        query = {'portal_type': 'Analysis'}
+        query = {}
         client_title = None
         if 'ClientUID' in self.request.form:
             client_uid = self.request.form['ClientUID']
-            query['getClientUID'] = client_uid
+            query['client_uid'] = client_uid
             client = rc.lookupObject(client_uid)
             client_title = client.Title()
         else:
             client = logged_in_client(self.context)
             if client:
                 client_title = client.Title()
-                query['getClientUID'] = client.UID()
+                query['client_uid'] = client.UID()
         if client_title:
             parms.append(
                 {'title': _('Client'), 'value': client_title, 'type': 'text'})
 
         date_query = formatDateQuery(self.context, 'Requested')
         if date_query:
-            query['created'] = date_query
+            query['created'] = date_range(date_query)
             requested = formatDateParms(self.context, 'Requested')
             parms.append(
                 {'title': _('Requested'), 'value': requested, 'type': 'text'})
 
         date_query = formatDateQuery(self.context, 'Published')
         if date_query:
-            query['getDatePublished'] = date_query
+            query['date_published'] = date_range(date_query)
             published = formatDateParms(self.context, 'Published')
             parms.append(
                 {'title': _('Published'), 'value': published, 'type': 'text'})
@@ -96,6 +98,11 @@ class Report(BrowserView):
                    'class': '',
         }
 
+        # count the analyses of each service in a single pass
+        extract = get_analyses_extract(self.context)
+        positions = extract.select(**query)
+        counts = group_by(extract.values('service_uid', positions))
+
         datalines = []
         count_all = 0
         for cat in sc(portal_type="AnalysisCategory",
@@ -107,9 +114,7 @@ class Report(BrowserView):
             for service in sc(portal_type="AnalysisService",
                               getCategoryUID=cat.UID,
                               sort_on='sortable_title'):
-                query['getServiceUID'] = service.UID
-                analyses = bc(query)
-                count_analyses = len(analyses)
+                count_analyses = counts.get(service.UID, 0)
 
                 dataline = []
                 dataitem = {'value': service.Title}
@@ -3,7 +3,10 @@
 # Copyright 2011-2016 by it's authors.
 # Some rights reserved. See LICENSE.txt, AUTHORS.txt.
 
+from DateTime import DateTime
 from Products.CMFCore.utils import getToolByName
+from bika.lims.analytics import date_range
+from bika.lims.analytics import get_analyses_extract
 from bika.lims.browser import BrowserView
 from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
 from bika.lims import bikaMessageFactory as _
@@ -24,7 +27,6 @@ class Report(BrowserView):
     def __call__(self):
         # get all the data into datalines
 
-        bc = getToolByName(self.context, 'bika_analysis_catalog')
         rc = getToolByName(self.context, 'reference_catalog')
         self.report_content = {}
         parms = []
@@ -33,11 +35,11 @@ class Report(BrowserView):
         headings['subheader'] = \
             _("The turnaround time of analyses plotted over time")
 
-        query = {'portal_type': 'Analysis'}
+        query = {}
 
         if 'ServiceUID' in self.request.form:
             service_uid = self.request.form['ServiceUID']
-            query['ServiceUID'] = service_uid
+            query['service_uid'] = service_uid
             service = rc.lookupObject(service_uid)
             service_title = service.Title()
             parms.append(
@@ -47,7 +49,7 @@ class Report(BrowserView):
 
         if 'Analyst' in self.request.form:
             analyst = self.request.form['Analyst']
-            query['getAnalyst'] = analyst
+            query['analyst'] = analyst
             analyst_title = self.user_fullname(analyst)
             parms.append(
                 {'title': _('Analyst'),
@@ -56,7 +58,7 @@ class Report(BrowserView):
 
         if 'getInstrumentUID' in self.request.form:
             instrument_uid = self.request.form['getInstrumentUID']
-            query['getInstrument'] = instrument_uid
+            query['instrument_uid'] = instrument_uid
             instrument = rc.lookupObject(instrument_uid)
             instrument_title = instrument.Title()
             parms.append(
@@ -71,7 +73,7 @@ class Report(BrowserView):
 
         date_query = formatDateQuery(self.context, 'tats_DateReceived')
         if date_query:
-            query['created'] = date_query
+            query['created'] = date_range(date_query)
             received = formatDateParms(self.context, 'tats_DateReceived')
             parms.append(
                 {'title': _('Received'),
@@ -86,10 +88,11 @@ class Report(BrowserView):
         total_count = 0
         total_duration = 0
 
-        analyses = bc(query)
-        for a in analyses:
-            analysis = a.getObject()
-            received = analysis.created()
+        extract = get_analyses_extract(self.context)
+        positions = extract.select(**query)
+        for created, duration in zip(extract.values('created', positions),
+                                     extract.durations(positions)):
+            received = DateTime(created)
             if period == 'Day':
                 datekey = received.strftime('%d %b %Y')
             elif period == 'Week':
@@ -106,12 +109,8 @@ class Report(BrowserView):
                 periods[datekey] = {'count': 0,
                                     'duration': 0,
                 }
-            count = periods[datekey]['count']
-            duration = periods[datekey]['duration']
-            count += 1
-            duration += analysis.getDuration()
-            periods[datekey]['duration'] = duration
-            periods[datekey]['count'] = count
+            periods[datekey]['duration'] += duration
+            periods[datekey]['count'] += 1
             total_count += 1
             total_duration += duration
 
@@ -4,10 +4,13 @@
 # Some rights reserved. See LICENSE.txt, AUTHORS.txt.
 
 from Products.CMFCore.utils import getToolByName
+from bika.lims.analytics import date_range
+from bika.lims.analytics import get_analyses_extract
+from bika.lims.analytics import is_nan
 from bika.lims.browser import BrowserView
 from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
 from bika.lims import bikaMessageFactory as _
-from bika.lims.utils import t, dicts_to_dict
+from bika.lims.utils import t
 from bika.lims.utils \
     import formatDateQuery, formatDateParms, isAttributeHidden
 from plone.app.layout.globals.interfaces import IViewView
@@ -24,7 +27,6 @@ class Report(BrowserView):
 
     def __call__(self):
         bsc = getToolByName(self.context, 'bika_setup_catalog')
-        bac = getToolByName(self.context, 'bika_analysis_catalog')
         self.report_content = {}
         parms = []
         headings = {}
@@ -33,8 +35,7 @@ class Report(BrowserView):
 
         count_all = 0
 
-        query = {"portal_type": "Analysis",
-                 "sort_order": "reverse"}
+        query = {}
 
         spec_uid = self.request.form.get("spec", False)
         spec_obj = None
@@ -51,7 +52,7 @@ class Report(BrowserView):
 
         date_query = formatDateQuery(self.context, 'Received')
         if date_query:
-            query['getDateReceived'] = date_query
+            query['date_received'] = date_range(date_query)
             received = formatDateParms(self.context, 'Received')
         else:
             received = 'Undefined'
@@ -118,53 +119,53 @@ class Report(BrowserView):
 
         datalines = []
 
-        for a_proxy in bac(query):
-            analysis = a_proxy.getObject()
-            if analysis.getResult():
-                try:
-                    result = float(analysis.getResult())
-                except:
-                    continue
-            else:
+        extract = get_analyses_extract(self.context)
+        positions = extract.select(**query)
+        # the most recent analyses first
+        positions.reverse()
+        names = ('client_title', 'request_id', 'sampletype_title',
+                 'samplepoint_title', 'category_title', 'title', 'keyword',
+                 'result', 'spec_min', 'spec_max', 'spec_error',
+                 'review_state')
+        state_titles = {}
+        specs = spec_obj and spec_obj.getResultsRangeDict() or {}
+        show_samplepoint = not isAttributeHidden('Sample', 'SamplePoint')
+        for row in extract.rows(positions, names):
+            result = row['result']
+            if is_nan(result):
                 continue
 
-            keyword = analysis.getKeyword()
-
             # determine which specs to use for this particular analysis
             # 1) if a spec is given in the query form, use it.
             # 2) if a spec is entered directly on the analysis, use it.
             # otherwise just continue to the next object.
-            spec_dict = False
             if spec_obj:
-                rr = spec_obj.getResultsRangeDict()
-                if keyword in rr:
-                    spec_dict = rr[keyword]
+                spec_dict = specs.get(row['keyword'])
+                if not spec_dict:
+                    continue
+                try:
+                    spec_min = float(spec_dict['min'])
+                    spec_max = float(spec_dict['max'])
+                except ValueError:
+                    continue
+                try:
+                    error = float(spec_dict.get('error', '0'))
+                except:
+                    error = 0
             else:
-                ar = analysis.aq_parent
-                rr = dicts_to_dict(ar.getResultsRange(), 'keyword')
-                if keyword in rr:
-                    spec_dict = rr[keyword]
-                else:
+                spec_min = row['spec_min']
+                spec_max = row['spec_max']
+                if is_nan(spec_min) or is_nan(spec_max):
                     continue
-            if not spec_dict:
-                continue
-            try:
-                spec_min = float(spec_dict['min'])
-                spec_max = float(spec_dict['max'])
-            except ValueError:
-                continue
+                error = row['spec_error']
+                if is_nan(error):
+                    error = 0
             if spec_min <= result <= spec_max:
                 continue
 
             # check if in shoulder: out of range, but in acceptable
             # error percentage
             shoulder = False
-            error = 0
-            try:
-                error = float(spec_dict.get('error', '0'))
-            except:
-                error = 0
-                pass
             error_amount = (result / 100) * error
             error_min = result - error_amount
             error_max = result + error_amount
@@ -174,43 +175,44 @@ class Report(BrowserView):
 
             dataline = []
 
-            dataitem = {'value': analysis.getClientTitle()}
+            dataitem = {'value': row['client_title']}
             dataline.append(dataitem)
 
-            dataitem = {'value': analysis.getRequestID()}
+            dataitem = {'value': row['request_id']}
             dataline.append(dataitem)
 
-            dataitem = {'value': analysis.aq_parent.getSampleTypeTitle()}
+            dataitem = {'value': row['sampletype_title']}
             dataline.append(dataitem)
 
-            if isAttributeHidden('Sample', 'SamplePoint'):
-                dataitem = {'value': analysis.aq_parent.getSamplePointTitle()}
+            if show_samplepoint:
+                dataitem = {'value': row['samplepoint_title']}
                 dataline.append(dataitem)
 
-            dataitem = {'value': analysis.getCategoryTitle()}
+            dataitem = {'value': row['category_title']}
             dataline.append(dataitem)
 
-            dataitem = {'value': analysis.Title()}
+            dataitem = {'value': row['title']}
             dataline.append(dataitem)
 
             if shoulder:
-                dataitem = {'value': analysis.getResult(),
+                dataitem = {'value': result,
                             'img_after': '++resource++bika.lims.images/exclamation.png'}
             else:
-                dataitem = {'value': analysis.getResult()}
+                dataitem = {'value': result}
 
             dataline.append(dataitem)
 
-            dataitem = {'value': spec_dict['min']}
+            dataitem = {'value': spec_min}
             dataline.append(dataitem)
 
-            dataitem = {'value': spec_dict['max']}
+            dataitem = {'value': spec_max}
             dataline.append(dataitem)
 
-            state = wf_tool.getInfoFor(analysis, 'review_state', '')
-            review_state = wf_tool.getTitleForStateOnType(
-                state, 'Analysis')
-            dataitem = {'value': review_state}
+            state = row['review_state']
+            if state not in state_titles:
+                state_titles[state] = wf_tool.getTitleForStateOnType(
+                    state, 'Analysis')
+            dataitem = {'value': state_titles[state]}
             dataline.append(dataitem)
 
             datalines.append(dataline)
@@ -44,6 +44,8 @@ class AutoImportLogsView(BikaListingView):
                         'Results': {'title': _('Results'),
                                     'sortable': False,
                                     'attr': 'getResults'},
+                        'Duration': {'title': _('Duration'),
+                                     'sortable': False},
                         }
         self.review_states = [
             {'id': 'default',
@@ -53,7 +55,8 @@ class AutoImportLogsView(BikaListingView):
                          'Instrument',
                          'Interface',
                          'ImportFile',
-                         'Results']
+                         'Results',
+                         'Duration']
              },
         ]
 
@@ -64,4 +67,6 @@ class AutoImportLogsView(BikaListingView):
     def folderitem(self, obj, item, index):
         item['ImportTime'] = obj.getLogTime.strftime('%Y-%m-%d  \
                                                             %H:%M:%S')
+        duration = getattr(obj, 'getDuration', None)
+        item['Duration'] = '%.2fs' % duration if duration else ''
         return item
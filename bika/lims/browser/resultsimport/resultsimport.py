@@ -5,6 +5,7 @@
 
 import csv
 from DateTime.DateTime import DateTime
+from ZODB.POSException import ConflictError
 from bika.lims.browser import BrowserView
 from bika.lims.utils import tmpID
 from Products.CMFCore.utils import getToolByName
@@ -13,10 +14,150 @@ from bika.lims.exportimport.instruments.resultsimport import \
     AnalysisResultsImporter
 import traceback
 from os import listdir
-from os.path import isfile, join
+from os import stat
+from os.path import join
+from stat import S_ISREG
 from bika.lims.idserver import renameAfterCreation
 from bika.lims import logger
 from datetime import datetime
+from BTrees.OOBTree import OOBTree
+from collective.taskqueue.interfaces import ITaskQueue
+from hashlib import sha1
+from time import time
+from zope.annotation.interfaces import IAnnotations
+from zope.component import queryUtility
+import transaction
+
+# Name of the collective.taskqueue queue the auto-import jobs run in
+AUTOIMPORT_TASK_QUEUE = 'auto-import'
+# Number of attempts to import a file that raises conflict errors
+AUTOIMPORT_RETRIES = 3
+# Annotation key of the portal where the imported files are recorded
+AUTOIMPORT_LEDGER = 'bika.lims.autoimport.ledger'
+# Annotation key of the portal where the records committed of the files
+# partly imported are stored
+AUTOIMPORT_PROGRESS = 'bika.lims.autoimport.progress'
+# Annotation key of the portal where the last scan of each auto-import
+# folder is recorded
+AUTOIMPORT_SCANS = 'bika.lims.autoimport.scans'
+# Seconds between full scans of the auto-import folders. In between, files
+# last modified before the newest file seen by the previous scan are skipped
+AUTOIMPORT_FULL_SCAN = 24 * 3600
+# Files of the auto-import folders that are not result files
+AUTOIMPORT_IGNORED = ('imported.csv', 'logs.log')
+
+
+def get_import_ledger(context, folder):
+    """ Returns the BTree (file name -> (size, mtime, sha1)) of the files
+        imported from the auto-import folder passed in, stored in the portal
+    """
+    portal = getToolByName(context, 'portal_url').getPortalObject()
+    annotations = IAnnotations(portal)
+    if AUTOIMPORT_LEDGER not in annotations:
+        annotations[AUTOIMPORT_LEDGER] = OOBTree()
+    ledgers = annotations[AUTOIMPORT_LEDGER]
+    if folder not in ledgers:
+        ledgers[folder] = OOBTree()
+    return ledgers[folder]
+
+
+def get_import_progress(context, folder):
+    """ Returns the BTree (file name -> (sha1, records)) with the number of
+        records committed of the files of the auto-import folder passed in
+        whose import has not finished
+    """
+    portal = getToolByName(context, 'portal_url').getPortalObject()
+    annotations = IAnnotations(portal)
+    if AUTOIMPORT_PROGRESS not in annotations:
+        annotations[AUTOIMPORT_PROGRESS] = OOBTree()
+    progress = annotations[AUTOIMPORT_PROGRESS]
+    if folder not in progress:
+        progress[folder] = OOBTree()
+    return progress[folder]
+
+
+def get_import_scans(context):
+    """ Returns the BTree (folder -> (newest mtime, time of the last full
+        scan)) of the auto-import folders scanned, stored in the portal
+    """
+    portal = getToolByName(context, 'portal_url').getPortalObject()
+    annotations = IAnnotations(portal)
+    if AUTOIMPORT_SCANS not in annotations:
+        annotations[AUTOIMPORT_SCANS] = OOBTree()
+    return annotations[AUTOIMPORT_SCANS]
+
+
+def get_file_hash(path):
+    """ Returns the sha1 hex digest of the contents of the file
+    """
+    digest = sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_file_entry(path, stat_result=None):
+    """ Returns the (size, mtime, sha1) ledger entry of the file
+    """
+    stat_result = stat_result or stat(path)
+    return (stat_result.st_size, stat_result.st_mtime, get_file_hash(path))
+
+
+def get_changed_files(ledger, folder, since=None):
+    """ Returns a tuple with a list of (file name, entry) with the files of
+        the folder that are not in the ledger or have been modified since
+        they were imported, and the newest mtime of the files of the folder.
+        Files are only read when their size or mtime differ from the ones
+        recorded; the entries of files that were touched without changing
+        their contents are updated in the ledger. Files last modified before
+        'since' are not looked up in the ledger.
+    """
+    changed = []
+    newest = since
+    for file_name in sorted(listdir(folder)):
+        if file_name in AUTOIMPORT_IGNORED:
+            continue
+        path = join(folder, file_name)
+        try:
+            stat_result = stat(path)
+        except OSError:
+            # Removed while listing the folder
+            continue
+        if not S_ISREG(stat_result.st_mode):
+            continue
+        if newest is None or stat_result.st_mtime > newest:
+            newest = stat_result.st_mtime
+        if since is not None and stat_result.st_mtime < since:
+            continue
+        entry = ledger.get(file_name)
+        if entry is not None and entry[:2] == (stat_result.st_size,
+                                               stat_result.st_mtime):
+            continue
+        new_entry = get_file_entry(path, stat_result)
+        if entry is not None and entry[2] == new_entry[2]:
+            ledger[file_name] = new_entry
+            continue
+        changed.append((file_name, new_entry))
+    return changed, newest
+
+
+def seed_import_ledger(ledger, folder):
+    """ Records in the ledger the files listed in the folder's imported.csv,
+        written by previous versions, so they are not imported again
+    """
+    try:
+        with open(join(folder, 'imported.csv'), 'r') as f:
+            imported = [line.strip() for line in f.readlines()]
+    except IOError:
+        return
+    for file_name in imported:
+        if not file_name or file_name in AUTOIMPORT_IGNORED:
+            continue
+        try:
+            ledger[file_name] = get_file_entry(join(folder, file_name))
+        except (IOError, OSError):
+            continue
 
 
 class ResultsImportView(BrowserView):
@@ -27,125 +168,219 @@ class ResultsImportView(BrowserView):
     which auto-import folders assigned, will participate in this process.
     To import for specified Instrument or/and Interface, these parameters can
     be set in URL as well.
+
+    Each instrument/interface pair is imported as an independent job. If the
+    'auto-import' task queue is registered, the jobs are queued and run by
+    its workers (in parallel, one per worker thread), so a slow instrument
+    does not hold the others back. Otherwise the jobs are run one after the
+    other in this request. Either way, each file is imported and committed
+    in its own transaction.
     """
     def __init__(self, context, request):
         super(ResultsImportView, self).__init__(context, request)
 
     def __call__(self):
-        request = self.request
         if not self.is_import_allowed():
             return 'Auto-import skipped due to interval...'
+        jobs = self.get_jobs()
+        task_queue = queryUtility(ITaskQueue, name=AUTOIMPORT_TASK_QUEUE)
+        if task_queue is not None:
+            path = '/'.join(self.portal.getPhysicalPath())
+            for instrument, interface in jobs:
+                logger.info('Queueing auto import for {0} - {1}'.format(
+                    instrument.Title(), interface))
+                task_queue.add(path + '/auto_import_results_job',
+                               method='POST',
+                               params={'i_uid': instrument.UID(),
+                                       'interface': interface})
+            transaction.commit()
+            return 'Auto-Import queued: {0} jobs...'.format(len(jobs))
+        # Commit the time of this run, so the jobs below do not conflict
+        # with the next call if they take longer than the interval
+        transaction.commit()
+        for instrument, interface in jobs:
+            self.run_job(instrument, interface)
+        logger.info('End of auto import...')
+        return 'Auto-Import finished...'
+
+    def get_jobs(self):
+        """ Returns a list of (instrument, interface) tuples, one for each
+            interface with an auto-import folder of the active instruments.
+            If the Instrument UID or the Interface ID are specified in the
+            request, only those are returned.
+        """
+        request = self.request
         bsc = getToolByName(self, 'bika_setup_catalog')
         # Getting instrumnets to run auto-import
         query = {'portal_type': 'Instrument',
                  'inactive_state': 'active'}
         if request.get('i_uid', ''):
             query['UID'] = request.get('i_uid')
-        brains = bsc(query)
-        interfaces = []
-        for brain in brains:
+        jobs = []
+        for brain in bsc(query):
             i = brain.getObject()
-            logger.info('Auto import for ' + i.Title())
-            # If Import Interface ID is specified in request, then auto-import
-            # will run only that interface. Otherwise all available interfaces
-            # of this instruments
-            if request.get('interface', ''):
-                interfaces.append(request.get('interface'))
-            else:
-                interfaces = [pairs.get('InterfaceName', '') for pairs
-                              in i.getResultFilesFolder()]
-            folder = ''
-            for interface in interfaces:
+            for pairs in i.getResultFilesFolder():
+                interface = pairs.get('InterfaceName', '')
+                if request.get('interface', '') and \
+                        interface != request.get('interface'):
+                    continue
                 # Each interface must have its folder where result files are
                 # saved. If not, then we will skip
-                for pairs in i.getResultFilesFolder():
-                    if pairs['InterfaceName'] == interface:
-                        folder = pairs.get('Folder', '')
-                if not folder:
-                    continue
-                logger.info('Auto import for ' + interface)
-                all_files = [f for f in listdir(folder)
-                             if isfile(join(folder, f))]
-                imported_list = self.getAlreadyImportedFiles(folder)
-                if not imported_list:
-                    logger.warn('imported.csv file not found ' + interface)
-                    self.add_to_logs(i, interface,
-                                     'imported.csv File not found...', '')
+                if not pairs.get('Folder', ''):
                     continue
-                for file_name in all_files:
-                    if file_name in imported_list:
-                        continue
-                    temp_file = open(folder+'/'+file_name)
-                    # Parsers work with UploadFile object from
-                    # zope.HTTPRequest which has filename attribute.
-                    # To add this attribute we convert the file.
-                    # CHECK should we add headers too?
-                    result_file = ConvertToUploadFile(temp_file)
-                    exim = instruments.getExim(interface)
-                    parser_name = instruments.getParserName(interface)
-                    parser_function = getattr(exim, parser_name) \
-                        if hasattr(exim, parser_name) else ''
-                    if not parser_function:
-                        self.add_to_logs(i, interface,
-                                         'Parser not found...', file_name)
-                        continue
-                    # We will run import with some default parameters
-                    # Expected to be modified in the future.
-                    logger.info('Parsing ' + file_name)
-                    parser = parser_function(result_file)
-                    importer = GeneralImporter(
-                                parser=parser,
-                                context=self.portal,
-                                idsearchcriteria=['getId',
-                                                  'getSampleID',
-                                                  'getClientSampleID'],
-                                allowed_ar_states=['sample_received'],
-                                allowed_analysis_states=None,
-                                override=[False, False],
-                                instrument_uid=i.UID())
-                    tbex = ''
-                    try:
-                        importer.process()
-                    except:
-                        tbex = traceback.format_exc()
-                    errors = importer.errors
-                    logs = importer.logs
-                    if tbex:
-                        errors.append(tbex)
-                    final_log = ''
-                    success_log = self.getInfoFromLog(logs, 'Import finished')
-                    if success_log:
-                        final_log = success_log
-                    else:
-                        final_log = errors
-                    self.insert_file_name(folder, file_name)
-                    self.add_to_logs(i, interface, final_log, file_name)
-                    self.add_to_log_file(i.Title(), interface, final_log,
-                                         file_name, folder)
-        logger.info('End of auto import...')
-        return 'Auto-Import finished...'
+                jobs.append((i, interface))
+        return jobs
+
+    def get_folder(self, instrument, interface):
+        """ Returns the auto-import folder of the instrument's interface
+        """
+        for pairs in instrument.getResultFilesFolder():
+            if pairs.get('InterfaceName', '') == interface:
+                return pairs.get('Folder', '')
+        return ''
 
-    def getAlreadyImportedFiles(self, folder):
+    def run_job(self, instrument, interface):
+        """ Imports the files of the interface's folder that have not been
+            imported yet. Each file is committed on its own. Only the files
+            modified since the previous scan are looked up in the ledger,
+            except every AUTOIMPORT_FULL_SCAN seconds.
+        """
+        folder = self.get_folder(instrument, interface)
+        if not folder:
+            return
+        logger.info('Auto import for {0} - {1}'.format(
+            instrument.Title(), interface))
+        ledger = get_import_ledger(self.portal, folder)
+        if not ledger:
+            seed_import_ledger(ledger, folder)
+        scans = get_import_scans(self.portal)
+        since, full_scan = scans.get(folder, (None, 0))
+        if time() - full_scan >= AUTOIMPORT_FULL_SCAN:
+            since, full_scan = None, time()
         try:
-            with open(folder+'/imported.csv', 'r') as f:
-                imported = f.readlines()
-                imported = [i.strip() for i in imported]
-                return imported
-        except:
-            with open(folder+'/imported.csv', 'w') as f:
-                f.write('imported.csv\n')
-                f.write('logs.log\n')
-                f.close()
-            return ['']
-        return None
+            changed, newest = get_changed_files(ledger, folder, since)
+        except OSError:
+            logger.warn('Cannot read folder {0} for {1}'.format(
+                folder, interface))
+            self.add_to_logs(instrument, interface,
+                             'Folder not found...', '')
+            transaction.commit()
+            return
+        # Store the entries refreshed for files touched but not modified
+        transaction.commit()
+        exim = instruments.getExim(interface)
+        parser_name = instruments.getParserName(interface)
+        parser_function = getattr(exim, parser_name) \
+            if hasattr(exim, parser_name) else ''
+        for file_name, entry in changed:
+            if not parser_function:
+                self.add_to_logs(instrument, interface,
+                                 'Parser not found...', file_name)
+                transaction.commit()
+                continue
+            if file_name in ledger:
+                logger.info('Re-importing modified file ' + file_name)
+            self.import_file(instrument, interface, folder, file_name,
+                             parser_function, entry)
+        # Files not imported yet have to be looked up again on the next run
+        pending = [entry[1] for file_name, entry in changed
+                   if ledger.get(file_name) != entry]
+        if newest is not None:
+            scans[folder] = (min([newest] + pending), full_scan)
+            transaction.commit()
 
-    def insert_file_name(self, folder, name):
+    def import_file(self, instrument, interface, folder, file_name,
+                    parser_function, entry):
+        """ Imports the file and logs the outcome. The results are committed
+            in chunks, each one with the number of records of the file
+            imported so far. Once the whole file has been imported, the
+            file's entry is stored in the imported files ledger.
+            On conflict errors the import is retried up to AUTOIMPORT_RETRIES
+            times, resuming after the last chunk committed. If it still
+            conflicts or fails, the file is not recorded as imported, so the
+            next run resumes it.
+        """
+        for attempt in range(AUTOIMPORT_RETRIES):
+            start = time()
+            try:
+                final_log, failed = self.process_file(
+                    instrument, folder, file_name, parser_function, entry)
+                duration = time() - start
+                self.add_to_logs(instrument, interface, final_log, file_name,
+                                 duration)
+                if not failed:
+                    progress = get_import_progress(self.portal, folder)
+                    if file_name in progress:
+                        del progress[file_name]
+                    get_import_ledger(self.portal, folder)[file_name] = entry
+                transaction.commit()
+                break
+            except ConflictError:
+                transaction.abort()
+                logger.warn('Conflict while importing {0} (attempt {1})'
+                            .format(file_name, attempt + 1))
+        else:
+            logger.error('Cannot import {0}: too many conflicts'.format(
+                file_name))
+            return
+        logger.info('Imported {0} in {1:.2f}s'.format(file_name, duration))
+        self.add_to_log_file(instrument.Title(), interface, final_log,
+                             file_name, folder)
+
+    def process_file(self, instrument, folder, file_name, parser_function,
+                     entry):
+        """ Runs the import of the file and returns a tuple with the log to
+            be stored and whether the import failed. The results are
+            committed in chunks by the importer, resuming after the records
+            committed by a previous import of the same contents. If the
+            import fails, the changes of the chunk being imported are
+            discarded.
+        """
+        temp_file = open(folder+'/'+file_name)
         try:
-            with open(folder+'/imported.csv', 'a') as fd:
-                fd.write(name+'\n')
-                fd.close()
-        except:
-            pass
+            # Parsers work with UploadFile object from
+            # zope.HTTPRequest which has filename attribute.
+            # To add this attribute we convert the file.
+            # CHECK should we add headers too?
+            result_file = ConvertToUploadFile(temp_file)
+            # We will run import with some default parameters
+            # Expected to be modified in the future.
+            logger.info('Parsing ' + file_name)
+            parser = parser_function(result_file)
+            importer = GeneralImporter(
+                        parser=parser,
+                        context=self.portal,
+                        idsearchcriteria=['getId',
+                                          'getSampleID',
+                                          'getClientSampleID'],
+                        allowed_ar_states=['sample_received'],
+                        allowed_analysis_states=None,
+                        override=[False, False],
+                        instrument_uid=instrument.UID(),
+                        progress=get_import_progress(self.portal, folder),
+                        file_name=file_name,
+                        file_hash=entry[2])
+            if importer.skip_records:
+                logger.info('Resuming {0} after {1} records'.format(
+                    file_name, importer.skip_records))
+            tbex = ''
+            try:
+                importer.process()
+            except ConflictError:
+                raise
+            except:
+                tbex = traceback.format_exc()
+                transaction.abort()
+        finally:
+            temp_file.close()
+        errors = importer.errors
+        logs = importer.logs
+        if tbex:
+            errors.append(tbex)
+        success_log = self.getInfoFromLog(logs, 'Import finished')
+        if success_log and not tbex:
+            return success_log, False
+        return errors, bool(tbex)
 
     def getInfoFromLog(self, logs, keyword):
         try:
@@ -156,7 +391,8 @@ class ResultsImportView(BrowserView):
         except:
             return None
 
-    def add_to_logs(self, instrument, interface, log, filename):
+    def add_to_logs(self, instrument, interface, log, filename,
+                    duration=0.0):
         if not log:
             return
         log = ''.join(log)
@@ -165,7 +401,8 @@ class ResultsImportView(BrowserView):
                                        Instrument=instrument,
                                        Interface=interface,
                                        Results=log,
-                                       ImportedFile=filename)
+                                       ImportedFile=filename,
+                                       Duration=duration)
         item = instrument[_id]
         item.unmarkCreationFlag()
         renameAfterCreation(item)
@@ -219,16 +456,45 @@ class ResultsImportView(BrowserView):
         return log
 
 
+class AutoImportJobView(ResultsImportView):
+    """ Runs the auto-import job for the instrument and interface passed in
+        the request. Called from the 'auto-import' task queue.
+    """
+
+    def __call__(self):
+        jobs = self.get_jobs()
+        for instrument, interface in jobs:
+            self.run_job(instrument, interface)
+        return 'Auto-Import finished...'
+
+
 class GeneralImporter(AnalysisResultsImporter):
 
+    # Files imported automatically can be large, commit them in chunks. The
+    # number of records committed is stored in 'progress', so an import
+    # interrupted or retried after a conflict resumes after them
+    commit_chunks = True
+
     def __init__(self, parser, context, idsearchcriteria, override,
                  allowed_ar_states=None, allowed_analysis_states=None,
-                 instrument_uid=None):
+                 instrument_uid=None, progress=None, file_name=None,
+                 file_hash=None):
         AnalysisResultsImporter.__init__(self, parser, context,
                                          idsearchcriteria, override,
                                          allowed_ar_states,
                                          allowed_analysis_states,
                                          instrument_uid)
+        self.progress = progress
+        self.file_name = file_name
+        self.file_hash = file_hash
+        if progress is not None:
+            done = progress.get(file_name)
+            if done and done[0] == file_hash:
+                self.skip_records = done[1]
+
+    def checkpoint(self, records):
+        if self.progress is not None:
+            self.progress[self.file_name] = (self.file_hash, records)
 
 
 class ConvertToUploadFile:
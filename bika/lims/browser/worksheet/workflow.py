@@ -14,6 +14,7 @@ from bika.lims.permissions import EditResults, EditWorksheet, ManageWorksheets
 from bika.lims.subscribers import doActionFor
 from bika.lims.subscribers import skip
 from bika.lims.utils import isActive
+from bika.lims.utils.analysis import RecalculationPass
 from Products.Archetypes.config import REFERENCE_CATALOG
 from Products.CMFCore.utils import getToolByName
 from Products.CMFCore.WorkflowCore import WorkflowException
@@ -108,13 +109,15 @@ class WorksheetWorkflowAction(WorkflowAction):
             selected_analyses = WorkflowAction._get_selected_items(self)
             selected_analysis_uids = selected_analyses.keys()
             if selected_analyses:
+                analyses = []
                 for uid in selected_analysis_uids:
                     analysis = rc.lookupObject(uid)
                     # Double-check the state first
                     if (workflow.getInfoFor(analysis, 'worksheetanalysis_review_state') == 'unassigned'
                     and workflow.getInfoFor(analysis, 'review_state') == 'sample_received'
                     and workflow.getInfoFor(analysis, 'cancellation_state') == 'active'):
-                        self.context.addAnalysis(analysis)
+                        analyses.append(analysis)
+                self.context.addAnalyses(analyses)
 
             self.destination_url = self.context.absolute_url()
             self.request.response.redirect(self.destination_url)
@@ -182,6 +185,7 @@ class WorksheetWorkflowAction(WorkflowAction):
                 item_data = json.loads(form['item_data'])
 
         # Iterate for each selected analysis and save its data as needed
+        saved = []
         for uid, analysis in selected.items():
 
             allow_edit = sm.checkPermission(EditResults, analysis)
@@ -247,20 +251,26 @@ class WorksheetWorkflowAction(WorkflowAction):
                 analysis.setInterimFields(interims)
                 analysis.setResult(results[uid])
                 analysis.reindexObject()
-
-                can_submit = True
-                deps = analysis.getDependencies() \
-                        if hasattr(analysis, 'getDependencies') else []
-                for dependency in deps:
-                    if workflow.getInfoFor(dependency, 'review_state') in \
-                       ('to_be_sampled', 'to_be_preserved',
-                        'sample_due', 'sample_received'):
-                        can_submit = False
-                        break
-                if can_submit:
-                    # doActionFor transitions the analysis to verif pending,
-                    # so must only be done when results are submitted.
-                    doActionFor(analysis, 'submit')
+                saved.append(analysis)
+
+        # Calculate the empty results that depend on the saved ones. The
+        # dependencies of all the saved analyses are resolved at once.
+        recalculation = RecalculationPass(saved)
+        for analysis in recalculation.calculate():
+            analysis.reindexObject()
+
+        for analysis in saved:
+            can_submit = True
+            for dependency in recalculation.getDependencies(analysis):
+                if workflow.getInfoFor(dependency, 'review_state') in \
+                   ('to_be_sampled', 'to_be_preserved',
+                    'sample_due', 'sample_received'):
+                    can_submit = False
+                    break
+            if can_submit:
+                # doActionFor transitions the analysis to verif pending,
+                # so must only be done when results are submitted.
+                doActionFor(analysis, 'submit')
 
         # Maybe some analyses need to be retracted due to a QC failure
         # Done here because don't know if the last selected analysis is
@@ -52,6 +52,9 @@ _indexes_dict = {
     'getWorksheetUID': 'FieldIndex',
     'getOriginalReflexedAnalysisUID': 'FieldIndex',
     'getPrioritySortkey': 'FieldIndex',
+    # Used to select the analyses a worksheet template can be applied to
+    'getAllowedMethodUIDs': 'KeywordIndex',
+    'getAllowedInstrumentUIDs': 'KeywordIndex',
 }
 # Defining the columns for this catalog
 _columns_list = [
@@ -110,6 +113,7 @@ _columns_list = [
     'getSampleTypeUID',
     'getClientOrderNumber',
     'getDateReceived',
+    'getWorksheetUID',
 ]
 # Adding basic indexes
 _base_indexes_copy = BASE_CATALOG_INDEXES.copy()
@@ -23,7 +23,8 @@ _columns_list = [
     'getImportedFile',
     'getInterface',
     'getResults',
-    'getLogTime'
+    'getLogTime',
+    'getDuration',
 ]
 # Adding basic indexes
 _base_indexes_copy = BASE_CATALOG_INDEXES.copy()
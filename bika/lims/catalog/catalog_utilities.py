@@ -4,7 +4,13 @@
 # Some rights reserved. See LICENSE.txt, AUTHORS.txt.
 
 import copy
+import time
+import transaction
+from BTrees.OOBTree import OOBTree
+from plone.indexer.interfaces import IIndexableObject
 from Products.CMFCore.utils import getToolByName
+from zope.annotation.interfaces import IAnnotations
+from zope.component import queryMultiAdapter
 # Bika LIMS imports
 from bika.lims import logger
 from bika.lims.catalog.analysisrequest_catalog import\
@@ -18,6 +24,14 @@ from bika.lims.catalog.worksheet_catalog import \
 from bika.lims.catalog.report_catalog import \
     bika_catalog_report_definition
 
+# Annotation key of the portal where the indexes and columns still to be
+# filled by backfill_catalogs are stored, with the progress made
+CATALOG_BACKFILLS = 'bika.lims.catalog.backfills'
+# Number of objects after which a savepoint is made while backfilling
+BACKFILL_SAVEPOINT_EVERY = 1000
+# Number of objects after which the progress is committed while backfilling
+BACKFILL_COMMIT_EVERY = 10000
+
 
 def getCatalogDefinitions():
     """
@@ -65,7 +79,8 @@ def getCatalog(instance, field='UID'):
 
 def setup_catalogs(
         portal, catalogs_definition={},
-        force_reindex=False, catalogs_extension={}, force_no_reindex=False):
+        force_reindex=False, catalogs_extension={}, force_no_reindex=False,
+        backfill=False):
     """
     Setup the given catalogs. Redefines the map between content types and
     catalogs and then checks the indexes and metacolumns, if one index/column
@@ -95,6 +110,11 @@ def setup_catalogs(
         Same dict structure as param catalogs_definition. Allows to add
         columns and indexes required by Bika-specific add-ons.
     :type catalog_extensions: dict
+    :param backfill: Migration mode. Catalogs that only got new indexes or
+        columns are not rebuilt: only the new indexes and columns are filled
+        for the objects already catalogued (see backfill_catalogs). Catalogs
+        that index new types are still rebuilt.
+    :type backfill: bool
     """
     # If not given catalogs_definition, use the LIMS one
     if not catalogs_definition:
@@ -114,14 +134,28 @@ def setup_catalogs(
     # Indexing
     for cat_id in definition.keys():
         reindex = False
+        added = {'indexes': [], 'columns': []}
         reindex = _setup_catalog(
-            portal, cat_id, definition.get(cat_id, {}))
+            portal, cat_id, definition.get(cat_id, {}), added)
+        if backfill and not force_reindex \
+                and cat_id not in clean_and_rebuild:
+            # Removed indexes and columns need no reindexing, and the new
+            # ones are filled without rebuilding the whole catalog
+            _addBackfill(portal, cat_id, added['indexes'], added['columns'])
+            continue
         if (reindex or force_reindex) and (cat_id not in clean_and_rebuild):
             # add the catalog if it has not been added before
             clean_and_rebuild.append(cat_id)
+    # The catalogs rebuilt need no backfill
+    backfills = _getBackfills(portal)
+    for cat_id in clean_and_rebuild:
+        if cat_id in backfills:
+            del backfills[cat_id]
     # Reindex the catalogs which needs it
     if not force_no_reindex:
         _cleanAndRebuildIfNeeded(portal, clean_and_rebuild)
+        if backfill:
+            backfill_catalogs(portal)
     return clean_and_rebuild
 
 def _merge_catalog_definitions(dict1, dict2):
@@ -235,7 +269,7 @@ def _map_content_types(archetype_tool, catalogs_definition):
     return to_reindex
 
 
-def _setup_catalog(portal, catalog_id, catalog_definition):
+def _setup_catalog(portal, catalog_id, catalog_definition, added=None):
     """
     Given a catalog definition it updates the indexes, columns and content_type
     definitions of the catalog.
@@ -253,9 +287,13 @@ def _setup_catalog(portal, catalog_id, catalog_definition):
                 ...
             ]
         }
+    :added: a dictionary like {'indexes': [], 'columns': []} where the ids of
+        the indexes and columns added are appended, if given
     """
 
     reindex = False
+    if added is None:
+        added = {'indexes': [], 'columns': []}
     catalog = getToolByName(portal, catalog_id, None)
     if catalog is None:
         logger.warning('Could not find the %s tool.' % (catalog_id))
@@ -267,6 +305,8 @@ def _setup_catalog(portal, catalog_id, catalog_definition):
         # The function returns if the index needs to be reindexed
         indexed = _addIndex(catalog, idx, catalog_definition['indexes'][idx])
         reindex = True if indexed else reindex
+        if indexed:
+            added['indexes'].append(idx)
     # Removing indexes
     in_catalog_idxs = catalog.indexes()
     to_remove = list(set(in_catalog_idxs)-set(indexes_ids))
@@ -279,6 +319,8 @@ def _setup_catalog(portal, catalog_id, catalog_definition):
     for col in columns_ids:
         created = _addColumn(catalog, col)
         reindex = True if created else reindex
+        if created:
+            added['columns'].append(col)
     # Removing columns
     in_catalog_cols = catalog.schema()
     to_remove = list(set(in_catalog_cols)-set(columns_ids))
@@ -419,6 +461,137 @@ def _cleanAndRebuildIfNeeded(portal, cleanrebuild):
             logger.warning('%s do not found' % cat)
 
 
+def _getBackfills(portal):
+    """
+    Returns the backfills pending, stored in the portal. A BTree like
+        {CATALOG_ID: {'indexes': [...], 'columns': [...], 'last': path,
+                      'done': int}}
+    where 'last' is the path of the last object filled and 'done' the number
+    of objects filled so far.
+    """
+    annotations = IAnnotations(portal)
+    if CATALOG_BACKFILLS not in annotations:
+        annotations[CATALOG_BACKFILLS] = OOBTree()
+    return annotations[CATALOG_BACKFILLS]
+
+
+def _addBackfill(portal, catalog_id, indexes, columns):
+    """
+    Adds the indexes and columns passed in to the ones to be filled in the
+    catalog. A backfill in progress goes on from where it was, and the new
+    indexes and columns are filled from the start on the next run.
+    :portal: the Plone portal object
+    :catalog_id: a string as the catalog id
+    :indexes: a list of index ids
+    :columns: a list of column ids
+    """
+    if not (indexes or columns):
+        return
+    backfills = _getBackfills(portal)
+    pending = backfills.get(catalog_id)
+    if pending is not None and pending['done']:
+        # Don't start again the backfill in progress: the new indexes and
+        # columns are left for a later run
+        pending.setdefault('next', {'indexes': [], 'columns': []})
+        pending['next']['indexes'] += indexes
+        pending['next']['columns'] += columns
+    else:
+        pending = pending or {'indexes': [], 'columns': [], 'last': None,
+                              'done': 0}
+        pending['indexes'] = pending['indexes'] + indexes
+        pending['columns'] = pending['columns'] + columns
+    backfills[catalog_id] = pending
+    logger.info('Catalog %s: indexes %s and columns %s to be backfilled.' % (
+        catalog_id, ', '.join(indexes), ', '.join(columns)))
+
+
+def backfill_catalogs(portal):
+    """
+    Fills the indexes and columns added by setup_catalogs in backfill mode
+    for the objects already catalogued, without rebuilding the catalogs.
+    The objects are visited in the order of their paths, making a savepoint
+    every BACKFILL_SAVEPOINT_EVERY objects and committing the progress every
+    BACKFILL_COMMIT_EVERY. If interrupted, calling this again resumes after
+    the last object committed.
+    :portal: the Plone portal object
+    """
+    backfills = _getBackfills(portal)
+    for catalog_id in list(backfills.keys()):
+        catalog = getToolByName(portal, catalog_id, None)
+        if catalog is None:
+            logger.warning('%s do not found' % catalog_id)
+            del backfills[catalog_id]
+            continue
+        while catalog_id in backfills:
+            _backfill_catalog(catalog, backfills)
+            pending = backfills[catalog_id]
+            if 'next' in pending:
+                # Indexes and columns added while the previous ones were
+                # being filled
+                pending = {'indexes': pending['next']['indexes'],
+                           'columns': pending['next']['columns'],
+                           'last': None, 'done': 0}
+                backfills[catalog_id] = pending
+            else:
+                del backfills[catalog_id]
+        transaction.commit()
+
+
+def _backfill_catalog(catalog, backfills):
+    """
+    Fills the pending indexes and columns of the catalog, resuming after
+    the last object filled.
+    :catalog: a catalog object
+    :backfills: the backfills pending, as returned by _getBackfills
+    """
+    pending = backfills[catalog.id]
+    indexes = [idx for idx in pending['indexes'] if idx in catalog.indexes()]
+    columns = [col for col in pending['columns'] if col in catalog.schema()]
+    paths = catalog._catalog.uids
+    total = len(paths)
+    done = pending['done']
+    if pending['last'] is None:
+        remaining = paths.keys()
+    else:
+        remaining = paths.keys(min=pending['last'], excludemin=True)
+    logger.info('Backfilling %s in %s: %s of %s objects to go.' % (
+        ', '.join(indexes + columns), catalog.id, total - done, total))
+    start = time.time()
+    filled = 0
+    path = None
+    for path in remaining:
+        obj = catalog.unrestrictedTraverse(path, None)
+        if obj is not None:
+            if indexes:
+                catalog.catalog_object(
+                    obj, path, idxs=indexes, update_metadata=0)
+            if columns:
+                wrapper = queryMultiAdapter((obj, catalog), IIndexableObject)
+                catalog._catalog.updateMetadata(
+                    wrapper or obj, path, paths[path])
+        filled += 1
+        if filled % BACKFILL_SAVEPOINT_EVERY == 0:
+            transaction.savepoint(optimistic=True)
+            catalog._p_jar.cacheGC()
+        if filled % BACKFILL_COMMIT_EVERY == 0:
+            pending['last'] = path
+            pending['done'] = done + filled
+            backfills[catalog.id] = pending
+            transaction.commit()
+            elapsed = time.time() - start
+            eta = elapsed / filled * max(total - done - filled, 0)
+            logger.info('Backfilling %s: %s of %s objects (%.0f%%), ETA %s.'
+                        % (catalog.id, done + filled, total,
+                           100.0 * (done + filled) / total,
+                           time.strftime('%H:%M:%S', time.gmtime(eta))))
+    pending['last'] = path or pending['last']
+    pending['done'] = done + filled
+    backfills[catalog.id] = pending
+    logger.info('Backfilled %s in %s: %s objects in %.0fs.' % (
+        ', '.join(indexes + columns), catalog.id, filled,
+        time.time() - start))
+
+
 class Empty:
     """
     Just a class to use when we need an object with some attributes to send to
@@ -14,13 +14,16 @@ from bika.lims.catalog.catalog_basic_template import BASE_CATALOG_COLUMNS
 CATALOG_REPORT_LISTING = 'bika_catalog_report'
 # Defining the indexes for this catalog
 _indexes_dict = {'getClientUID': 'FieldIndex',
+                 'getRenderStatus': 'FieldIndex',
+                 'getParametersHash': 'FieldIndex',
 }
 
 # Defining the columns for this catalog
 _columns_list = ['getClientURL',
                  'getFileSize',
                  'getCreatorFullName',
-                 'getClientTitle'
+                 'getClientTitle',
+                 'getRenderStatus',
 ]
 
 # Adding basic indexes
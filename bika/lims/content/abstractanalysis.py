@@ -6,7 +6,6 @@
 # Some rights reserved. See LICENSE.txt, AUTHORS.txt.
 
 import cgi
-import math
 from decimal import Decimal
 
 from AccessControl import ClassSecurityInfo
@@ -19,8 +18,10 @@ from Products.CMFCore.WorkflowCore import WorkflowException
 from Products.CMFCore.utils import getToolByName
 from bika.lims import bikaMessageFactory as _, deprecated
 from bika.lims import logger
+from bika.lims.backreferences import get_backreference_uids
 from bika.lims.browser.fields import HistoryAwareReferenceField
 from bika.lims.browser.fields import UIDReferenceField
+from bika.lims.browser.fields.uidreferencefield import resolve_uids
 from bika.lims.browser.widgets import DateTimeWidget
 from bika.lims.content.abstractbaseanalysis import AbstractBaseAnalysis
 from bika.lims.content.abstractbaseanalysis import schema
@@ -494,9 +495,35 @@ class AbstractAnalysis(AbstractBaseAnalysis):
         return self.getResultsRange()
 
     @security.public
-    def calculateResult(self, override=False, cascade=False):
+    def getCalculationValues(self):
+        """Returns the values this analysis provides to the calculations that
+        depend on it, keyed as they are referred in formulas: the result by
+        keyword (and 'keyword.RESULT'), and the detection limits as
+        'keyword.LDL', 'keyword.UDL', 'keyword.BELOWLDL' and
+        'keyword.ABOVEUDL'. Returns None if the result is not a number.
+        """
+        try:
+            result = float(str(self.getResult()))
+        except (TypeError, ValueError):
+            return None
+        key = self.getKeyword()
+        return {key: result,
+                '%s.%s' % (key, 'RESULT'): result,
+                '%s.%s' % (key, 'LDL'): self.getLowerDetectionLimit(),
+                '%s.%s' % (key, 'UDL'): self.getUpperDetectionLimit(),
+                '%s.%s' % (key, 'BELOWLDL'):
+                    int(self.isBelowLowerDetectionLimit()),
+                '%s.%s' % (key, 'ABOVEUDL'):
+                    int(self.isAboveUpperDetectionLimit())}
+
+    @security.public
+    def calculateResult(self, override=False, cascade=False,
+                        dependencies=None, values=None):
         """Calculates the result for the current analysis if it depends of
-        other analysis/interim fields. Otherwise, do nothing
+        other analysis/interim fields. Otherwise, do nothing.
+        The dependencies can be passed in if already known, and 'values' is
+        a dict (analysis UID -> getCalculationValues) that can be shared
+        between calls, so each dependency is only read once.
         """
         if self.getResult() and override is False:
             return False
@@ -523,44 +550,32 @@ class AbstractAnalysis(AbstractBaseAnalysis):
                 return False
 
         # Add dependencies results to mapping
-        dependencies = self.getDependencies()
+        if dependencies is None:
+            dependencies = self.getDependencies()
+        if values is None:
+            values = {}
         for dependency in dependencies:
-            result = dependency.getResult()
-            if not result:
-                # Dependency without results found
-                if cascade:
-                    # Try to calculate the dependency result
-                    dependency.calculateResult(override, cascade)
-                    result = dependency.getResult()
-                else:
-                    return False
-            if result:
-                try:
-                    result = float(str(result))
-                    key = dependency.getKeyword()
-                    ldl = dependency.getLowerDetectionLimit()
-                    udl = dependency.getUpperDetectionLimit()
-                    bdl = dependency.isBelowLowerDetectionLimit()
-                    adl = dependency.isAboveUpperDetectionLimit()
-                    mapping[key] = result
-                    mapping['%s.%s' % (key, 'RESULT')] = result
-                    mapping['%s.%s' % (key, 'LDL')] = ldl
-                    mapping['%s.%s' % (key, 'UDL')] = udl
-                    mapping['%s.%s' % (key, 'BELOWLDL')] = int(bdl)
-                    mapping['%s.%s' % (key, 'ABOVEUDL')] = int(adl)
-                except (TypeError, ValueError):
-                    return False
+            uid = dependency.UID()
+            if uid not in values:
+                result = dependency.getResult()
+                if not result:
+                    # Dependency without results found
+                    if cascade:
+                        # Try to calculate the dependency result
+                        dependency.calculateResult(override, cascade)
+                        result = dependency.getResult()
+                    else:
+                        return False
+                if not result:
+                    continue
+                values[uid] = dependency.getCalculationValues()
+            if values[uid] is None:
+                return False
+            mapping.update(values[uid])
 
         # Calculate
-        formula = calc.getMinifiedFormula()
-        formula = formula.replace('[', '%(').replace(']', ')f')
         try:
-            formula = eval("'%s'%%mapping" % formula,
-                           {"__builtins__": None,
-                            'math': math,
-                            'context': self},
-                           {'mapping': mapping})
-            result = eval(formula)
+            result = calc.evaluateFormula(mapping, self)
         except TypeError:
             self.setResult("NA")
             return True
@@ -978,9 +993,9 @@ class AbstractAnalysis(AbstractBaseAnalysis):
         analyst = field and field.get(self) or ''
         if not analyst:
             # Is assigned to a worksheet?
-            wss = self.getBackReferences('WorksheetAnalysis')
-            if len(wss) > 0:
-                analyst = wss[0].getAnalyst()
+            worksheet = self.getWorksheet()
+            if worksheet:
+                analyst = worksheet.getAnalyst()
                 field.set(self, analyst)
         return analyst if analyst else ''
 
@@ -1170,23 +1185,25 @@ class AbstractAnalysis(AbstractBaseAnalysis):
     def getWorksheetUID(self):
         """This method is used to populate catalog values
         Returns WS UID if this analysis is assigned to a worksheet, or None.
+        The UID is read from the back references index, so neither the
+        worksheet nor reference_catalog are touched.
         """
-        worksheet = self.getWorksheet()
-        if worksheet:
-            return worksheet.UID()
+        worksheets = get_backreference_uids(self, 'WorksheetAnalysis')
+        if not worksheets:
+            return None
+        if len(worksheets) > 1:
+            logger.error(
+                "Analysis %s is assigned to more than one worksheet."
+                % self.getId())
+        return worksheets[0]
 
     @security.public
     def getWorksheet(self):
         """Returns the Worksheet to which this analysis belongs to, or None
         """
-        worksheet = self.getBackReferences('WorksheetAnalysis')
-        if not worksheet:
-            return None
-        if len(worksheet) > 1:
-            logger.error(
-                "Analysis %s is assigned to more than one worksheet."
-                % self.getId())
-        return worksheet[0]
+        uid = self.getWorksheetUID()
+        if uid:
+            return resolve_uids(self, [uid]).get(uid)
 
     @security.public
     def getExpiryDate(self):
@@ -8,6 +8,9 @@
 import logging
 import sys
 from AccessControl import ClassSecurityInfo
+from Acquisition import aq_base
+from BTrees.Length import Length
+from BTrees.OOBTree import OOBTree
 from decimal import Decimal
 from operator import methodcaller
 from Products.Archetypes.utils import DisplayList
@@ -49,7 +52,6 @@ from bika.lims.workflow import doActionFor
 from bika.lims.workflow import getTransitionDate
 from bika.lims.workflow import getTransitionUsers
 from bika.lims.workflow import isActive
-from bika.lims.workflow import getReviewHistoryActionsList
 from bika.lims.workflow import isBasicTransitionAllowed
 from bika.lims.workflow import isTransitionAllowed
 from bika.lims.workflow import skip
@@ -67,6 +69,26 @@ except ImportError:
     from zope.app.component.hooks import getSite
 
 
+# Indexes of the counts returned by AnalysisRequest.getAnalysesNum
+ANALYSES_NUM_VERIFIED = 0
+ANALYSES_NUM_TOTAL = 1
+ANALYSES_NUM_PENDING = 2
+ANALYSES_NUM_TO_BE_VERIFIED = 3
+
+
+def get_analyses_num_index(review_state, active=True):
+    """ Returns the index of getAnalysesNum an analysis in the review_state
+        passed in is counted in, or None if it is not counted
+    """
+    if not active or review_state in ('retracted', 'rejected'):
+        return None
+    if review_state in ('verified', 'published'):
+        return ANALYSES_NUM_VERIFIED
+    if review_state == 'to_be_verified':
+        return ANALYSES_NUM_TO_BE_VERIFIED
+    return ANALYSES_NUM_PENDING
+
+
 schema = BikaSchema.copy() + Schema((
     UIDReferenceField(
         'Contact',
@@ -1892,31 +1914,59 @@ class AnalysisRequest(BaseFolder):
         """ Returns an array with the number of analyses for the current AR in
             different statuses, like follows:
                 [verified, total, not_submitted, to_be_verified]
+            Retracted, rejected and cancelled analyses are not counted. The
+            counts are kept up to date by updateAnalysesNum, so neither the
+            analyses nor their review history are read here.
         """
-        total = 0
-        an_nums = [0,0,0,0]
-        for analysis in self.getAnalyses():
-            review_state = analysis.review_state
-            analysis_object = analysis.getObject()
-            if review_state in ['retracted', 'rejected'] or \
-                    not isActive(analysis_object):
-                # Discard retracted analyses and non-active analyses
-                continue
+        if getattr(aq_base(self), '_analyses_num', None) is None:
+            self.rebuildAnalysesNum()
+        return [count() for count in self._analyses_num]
 
-            actions = getReviewHistoryActionsList(analysis_object)
-            if 'verify' in actions:
-                # Assume the "last" state of analysis is verified
-                index = 0
-
-            elif 'submit' not in actions or review_state != 'to_be_verified':
-                # Assume the "first" state of analysis is results_pending
-                index = 2
+    @security.private
+    def updateAnalysesNum(self, analysis, removed=False):
+        """ Counts the analysis passed in the status that matches its current
+            state, or stops counting it if it has been removed. Called after
+            each workflow change of the analyses of this AR.
+        """
+        if getattr(aq_base(self), '_analyses_num', None) is None:
+            self.rebuildAnalysesNum()
+        index = None
+        if not removed:
+            workflow = getToolByName(self, 'portal_workflow')
+            index = get_analyses_num_index(
+                workflow.getInfoFor(analysis, 'review_state', ''),
+                isActive(analysis))
+        uid = analysis.UID()
+        previous = self._analyses_num_entries.get(uid)
+        if previous == index:
+            return
+        if previous is not None:
+            self._analyses_num[previous].change(-1)
+            self._analyses_num[ANALYSES_NUM_TOTAL].change(-1)
+            del self._analyses_num_entries[uid]
+        if index is not None:
+            self._analyses_num[index].change(1)
+            self._analyses_num[ANALYSES_NUM_TOTAL].change(1)
+            self._analyses_num_entries[uid] = index
 
-            else:
-                index = 3
-            an_nums[index] += 1
-            an_nums[1] += 1
-        return an_nums
+    @security.private
+    def rebuildAnalysesNum(self):
+        """ Counts again the analyses of this AR from bika_analysis_catalog
+        """
+        self._analyses_num = [Length() for i in range(4)]
+        self._analyses_num_entries = OOBTree()
+        bac = getToolByName(self, CATALOG_ANALYSIS_LISTING)
+        brains = bac(portal_type='Analysis',
+                     cancellation_state='active',
+                     path={'query': '/'.join(self.getPhysicalPath()),
+                           'level': 0})
+        for brain in brains:
+            index = get_analyses_num_index(brain.review_state)
+            if index is None:
+                continue
+            self._analyses_num[index].change(1)
+            self._analyses_num[ANALYSES_NUM_TOTAL].change(1)
+            self._analyses_num_entries[brain.UID] = index
 
     @security.public
     def getResponsible(self):
@@ -2406,9 +2456,8 @@ class AnalysisRequest(BaseFolder):
 
         for an in ans:
             an = an.getObject()
-            br = an.getBackReferences('WorksheetAnalysis')
-            if len(br) > 0:
-                ws = br[0]
+            ws = an.getWorksheet()
+            if ws:
                 was = ws.getAnalyses()
                 for wa in was:
                     if valid_dup(wa):
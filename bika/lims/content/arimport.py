@@ -14,7 +14,10 @@ from bika.lims.config import PROJECTNAME
 from bika.lims.content.bikaschema import BikaSchema
 from bika.lims.content.analysisrequest import schema as ar_schema
 from bika.lims.content.sample import schema as sample_schema
+from bika.lims import logger
+from bika.lims.idserver import discard_id_reservations
 from bika.lims.idserver import renameAfterCreation
+from bika.lims.idserver import reserve_ids
 from bika.lims.interfaces import IARImport, IClient
 from bika.lims.utils import tmpID
 from bika.lims.vocabularies import CatalogVocabulary
@@ -26,6 +29,7 @@ from collective.progressbar.events import UpdateProgressEvent
 from Products.Archetypes import atapi
 from Products.Archetypes.public import *
 from plone.app.blob.field import FileField as BlobFileField
+from Products.ATExtensions.field.records import RecordsField
 from Products.Archetypes.references import HoldingReference
 from Products.Archetypes.utils import addStatusMessage
 from Products.CMFCore.utils import getToolByName
@@ -39,14 +43,22 @@ from Products.DataGridField import LinesColumn
 from Products.DataGridField import SelectColumn
 from zope import event
 from zope.event import notify
+from zope.annotation.interfaces import IAnnotations
 from zope.i18nmessageid import MessageFactory
 from zope.interface import implements
 
 from bika.lims.browser.widgets import ReferenceWidget as bReferenceWidget
 
+from ZODB.POSException import ConflictError
 import sys
 import transaction
 
+# Times a chunk of rows is created again when saving it conflicts with
+# changes made by other users
+IMPORT_CONFLICT_RETRIES = 3
+# Annotation key of the request where the lookup tables are kept
+IMPORT_LOOKUPS = 'bika.lims.arimport.lookups'
+
 _p = MessageFactory(u"plone")
 
 OriginalFile = BlobFileField(
@@ -209,6 +221,27 @@ Errors = LinesField(
     )
 )
 
+# Number of rows of the grid already created. The rows are created in
+# chunks, each one committed on its own, so an interrupted import resumes
+# from here
+ImportCursor = IntegerField(
+    'ImportCursor',
+    default=0,
+    widget=ComputedWidget(
+        visible=False
+    ),
+)
+
+# Objects created for each row of the grid, for reference. Committed with
+# the cursor, which is what tells the rows already created
+ImportedObjects = RecordsField(
+    'ImportedObjects',
+    subfields=('Row', 'Sample', 'AnalysisRequest'),
+    widget=ComputedWidget(
+        visible=False
+    ),
+)
+
 schema = BikaSchema.copy() + Schema((
     OriginalFile,
     Filename,
@@ -222,6 +255,8 @@ schema = BikaSchema.copy() + Schema((
     Batch,
     SampleData,
     Errors,
+    ImportCursor,
+    ImportedObjects,
 ))
 
 schema['title'].validators = ()
@@ -229,6 +264,78 @@ schema['title'].validators = ()
 schema['title']._validationLayer()
 
 
+class ImportLookups(object):
+    """Lookup tables used to validate and import the values of the rows, so
+    each catalog is queried once per request instead of once per value.
+    """
+
+    def __init__(self, context):
+        self.context = context
+        bsc = getToolByName(context, 'bika_setup_catalog')
+
+        # Analysis services by UID, title or keyword (keyword first)
+        self.services = {}
+        brains = bsc(portal_type='AnalysisService')
+        for attr in ('UID', 'Title', 'getKeyword'):
+            for brain in brains:
+                value = getattr(brain, attr, None)
+                if value:
+                    self.services[value] = brain.UID
+        self.keywords = set([b.getKeyword for b in brains if b.getKeyword])
+
+        # Analysis profiles by profile key, UID or title, with their
+        # services. The first profile that matches a value wins
+        self.profile_names = set()
+        self.profiles = {}
+        self.profile_services = {}
+        for brain in bsc(portal_type='AnalysisProfile'):
+            profile = brain.getObject()
+            self.profile_services[brain.UID] = profile.getRawService()
+            for value in (profile.getProfileKey(), brain.UID,
+                          profile.Title()):
+                if value:
+                    self.profiles.setdefault(value, brain.UID)
+            self.profile_names.update(
+                [x for x in (profile.Title(), profile.getProfileKey()) if x])
+
+        # {portal_type: {'Title': {title: [uids]}, 'UID': {uid: [uid]}}},
+        # filled the first time each type is looked up
+        self.references = {}
+        # Objects woken up, by UID
+        self.objects = {}
+
+    def get_references(self, portal_type):
+        if portal_type not in self.references:
+            at = getToolByName(self.context, 'archetype_tool')
+            catalog = at.catalog_map.get(portal_type, [None])[0]
+            catalog = getToolByName(self.context, catalog)
+            tables = {'Title': {}, 'UID': {}}
+            for brain in catalog(portal_type=portal_type):
+                tables['Title'].setdefault(brain.Title, []).append(brain.UID)
+                tables['UID'][brain.UID] = [brain.UID]
+            self.references[portal_type] = tables
+        return self.references[portal_type]
+
+    def lookup(self, allowed_types, key, value):
+        """Returns the UIDs of the objects of the first type in
+        allowed_types whose 'key' (Title or UID) is value
+        """
+        for portal_type in allowed_types:
+            uids = self.get_references(portal_type)[key].get(value)
+            if uids:
+                return uids
+        return []
+
+    def get_object(self, uid):
+        """Returns the object with the UID passed in, woken up only once
+        """
+        if uid not in self.objects:
+            uc = getToolByName(self.context, 'uid_catalog')
+            brains = uc(UID=uid)
+            self.objects[uid] = brains[0].getObject() if brains else None
+        return self.objects[uid]
+
+
 class ARImport(BaseFolder):
     security = ClassSecurityInfo()
     schema = schema
@@ -240,6 +347,14 @@ class ARImport(BaseFolder):
     def _renameAfterCreation(self, check_auto_id=False):
         renameAfterCreation(self)
 
+    def get_lookups(self):
+        """Returns the lookup tables of the current request
+        """
+        annotations = IAnnotations(self.REQUEST)
+        if IMPORT_LOOKUPS not in annotations:
+            annotations[IMPORT_LOOKUPS] = ImportLookups(self)
+        return annotations[IMPORT_LOOKUPS]
+
     def guard_validate_transition(self):
         """We may only attempt validation if file data has been uploaded.
         """
@@ -279,92 +394,155 @@ class ARImport(BaseFolder):
         if 'validate' in trans_ids:
             workflow.doActionFor(self, 'validate')
 
-    # TODO - Workflow. Revisit AR creation (should use utils.analysisrequest)
     def workflow_script_import(self):
         """Create objects from valid ARImport
         """
+        # Keep the transition if the import of a chunk fails, so it can be
+        # resumed
+        transaction.commit()
+        self.import_rows()
+        # document has been written to, and redirect() fails here
+        self.REQUEST.response.write(
+            '<script>document.location.href="%s"</script>' % (
+                self.absolute_url()))
+
+    def isImportComplete(self):
+        """Returns whether the objects of all the rows have been created
+        """
+        gridrows = self.schema['SampleData'].get(self)
+        return (self.getImportCursor() or 0) >= len(gridrows)
+
+    def import_rows(self):
+        """Creates the objects of the rows not imported yet, in chunks of
+        the size set up in bika_setup. Each chunk is committed on its own
+        together with the cursor, so if the import is interrupted, calling
+        this again resumes it after the last chunk committed.
+        """
         bsc = getToolByName(self, 'bika_setup_catalog')
-        workflow = getToolByName(self, 'portal_workflow')
-        client = self.aq_parent
+        gridrows = self.schema['SampleData'].get(self)
+        chunk_size = max(1, self.bika_setup.getARImportChunkSize() or 1)
 
         title = _('Submitting AR Import')
         description = _('Creating and initialising objects')
         bar = ProgressBar(self, self.REQUEST, title, description)
         notify(InitialiseProgressBar(bar))
 
-        profiles = [x.getObject() for x in bsc(portal_type='AnalysisProfile')]
+        prefixes = {}
+        for brain in bsc(portal_type='SampleType'):
+            prefixes[brain.UID] = brain.getObject().getPrefix()
+
+        retries = 0
+        while not self.isImportComplete():
+            cursor = self.getImportCursor() or 0
+            end = min(cursor + chunk_size, len(gridrows))
+            chunk = range(cursor, end)
+
+            # Reserve the ids of the Samples of the chunk up front, so a
+            # single block is requested per Sample Type prefix
+            sampletypes = {}
+            for row_nr in chunk:
+                uid = gridrows[row_nr].get('SampleType')
+                sampletypes[uid] = sampletypes.get(uid, 0) + 1
+            for uid, count in sampletypes.items():
+                if uid in prefixes:
+                    reserve_ids(self, 'Sample', count, prefixes[uid])
 
-        gridrows = self.schema['SampleData'].get(self)
-        row_cnt = 0
-        for therow in gridrows:
-            row = therow.copy()
-            row_cnt += 1
-            # Create Sample
-            sample = _createObjectByType('Sample', client, tmpID())
-            sample.unmarkCreationFlag()
-            # First convert all row values into something the field can take
-            sample.edit(**row)
-            sample._renameAfterCreation()
-            event.notify(ObjectInitializedEvent(sample))
-            sample.at_post_create_script()
-            swe = self.bika_setup.getSamplingWorkflowEnabled()
-            part = _createObjectByType('SamplePartition', sample, 'part-1')
-            part.unmarkCreationFlag()
-            # Container is special... it could be a containertype.
-            container = self.get_row_container(row)
-            if container:
-                if container.portal_type == 'ContainerType':
-                    containers = container.getContainers()
-                # XXX And so we must calculate the best container for this partition
-                part.edit(Container=containers[0])
-
-            # Profiles are titles, profile keys, or UIDS: convert them to UIDs.
-            newprofiles = []
-            for title in row['Profiles']:
-                objects = [x for x in profiles
-                           if title in (x.getProfileKey(), x.UID(), x.Title())]
-                for obj in objects:
-                    newprofiles.append(obj.UID())
-            row['Profiles'] = newprofiles
-
-            # BBB in bika.lims < 3.1.9, only one profile is permitted
-            # on an AR.  The services are all added, but only first selected
-            # profile name is stored.
-            row['Profile'] = newprofiles[0] if newprofiles else None
-
-            # Same for analyses
-            newanalyses = set(self.get_row_services(row) +
-                              self.get_row_profile_services(row))
-            row['Analyses'] = []
-            # get batch
-            batch = self.schema['Batch'].get(self)
-            if batch:
-                row['Batch'] = batch
-            # Add AR fields from schema into this row's data
-            row['ClientReference'] = self.getClientReference()
-            row['ClientOrderNumber'] = self.getClientOrderNumber()
-            row['Contact'] = self.getContact()
-            # Create AR
-            ar = _createObjectByType("AnalysisRequest", client, tmpID())
-            ar.setSample(sample)
-            ar.unmarkCreationFlag()
-            ar.edit(**row)
-            ar._renameAfterCreation()
-            ar.setAnalyses(list(newanalyses))
-            for analysis in ar.getAnalyses(full_objects=True):
-                analysis.setSamplePartition(part)
-            ar.at_post_create_script()
-            if swe:
-                doActionFor(ar, 'sampling_workflow')
-            else:
-                doActionFor(ar, 'no_sampling_workflow')
-            progress_index = float(row_cnt) / len(gridrows) * 100
+            try:
+                records = []
+                for row_nr in chunk:
+                    sample, ar = self.import_row(gridrows[row_nr])
+                    records.append({'Row': str(row_nr),
+                                    'Sample': sample.UID(),
+                                    'AnalysisRequest': ar.UID()})
+                self.setImportedObjects(
+                    list(self.getImportedObjects()) + records)
+                self.setImportCursor(end)
+                transaction.commit()
+            except ConflictError:
+                transaction.abort()
+                discard_id_reservations(self)
+                retries += 1
+                if retries > IMPORT_CONFLICT_RETRIES:
+                    raise
+                logger.warn("{0}: conflict while importing rows {1} to {2}, "
+                            "retrying".format(self.getId(), cursor + 1, end))
+                continue
+            except Exception:
+                transaction.abort()
+                discard_id_reservations(self)
+                logger.exception("{0}: import interrupted at row {1}".format(
+                    self.getId(), cursor + 1))
+                raise
+            retries = 0
+
+            progress_index = float(end) / len(gridrows) * 100
             progress = ProgressState(self.REQUEST, progress_index)
             notify(UpdateProgressEvent(progress))
-        # document has been written to, and redirect() fails here
-        self.REQUEST.response.write(
-            '<script>document.location.href="%s"</script>' % (
-                self.absolute_url()))
+
+    # TODO - Workflow. Revisit AR creation (should use utils.analysisrequest)
+    def import_row(self, therow):
+        """Creates the Sample, the SamplePartition and the AnalysisRequest of
+        a row of the grid. Returns the Sample and the AnalysisRequest.
+        """
+        client = self.aq_parent
+        row = therow.copy()
+        # Create Sample
+        sample = _createObjectByType('Sample', client, tmpID())
+        sample.unmarkCreationFlag()
+        # First convert all row values into something the field can take
+        sample.edit(**row)
+        sample._renameAfterCreation()
+        event.notify(ObjectInitializedEvent(sample))
+        sample.at_post_create_script()
+        swe = self.bika_setup.getSamplingWorkflowEnabled()
+        part = _createObjectByType('SamplePartition', sample, 'part-1')
+        part.unmarkCreationFlag()
+        # Container is special... it could be a containertype.
+        container = self.get_row_container(row)
+        if container:
+            if container.portal_type == 'ContainerType':
+                containers = container.getContainers()
+            # XXX And so we must calculate the best container for this partition
+            part.edit(Container=containers[0])
+
+        # Profiles are titles, profile keys, or UIDS: convert them to UIDs.
+        lookups = self.get_lookups()
+        newprofiles = [lookups.profiles[value] for value in row['Profiles']
+                       if value in lookups.profiles]
+        row['Profiles'] = newprofiles
+
+        # BBB in bika.lims < 3.1.9, only one profile is permitted
+        # on an AR.  The services are all added, but only first selected
+        # profile name is stored.
+        row['Profile'] = newprofiles[0] if newprofiles else None
+
+        # Same for analyses
+        newanalyses = set(self.get_row_services(row) +
+                          self.get_row_profile_services(row))
+        row['Analyses'] = []
+        # get batch
+        batch = self.schema['Batch'].get(self)
+        if batch:
+            row['Batch'] = batch
+        # Add AR fields from schema into this row's data
+        row['ClientReference'] = self.getClientReference()
+        row['ClientOrderNumber'] = self.getClientOrderNumber()
+        row['Contact'] = self.getContact()
+        # Create AR
+        ar = _createObjectByType("AnalysisRequest", client, tmpID())
+        ar.setSample(sample)
+        ar.unmarkCreationFlag()
+        ar.edit(**row)
+        ar._renameAfterCreation()
+        ar.setAnalyses(list(newanalyses))
+        for analysis in ar.getAnalyses(full_objects=True):
+            analysis.setSamplePartition(part)
+        ar.at_post_create_script()
+        if swe:
+            doActionFor(ar, 'sampling_workflow')
+        else:
+            doActionFor(ar, 'no_sampling_workflow')
+        return sample, ar
 
     def get_header_values(self):
         """Scrape the "Header" values from the original input file
@@ -496,13 +674,9 @@ class ARImport(BaseFolder):
         """Save values from the file's header row into the DataGrid columns
         after doing some very basic validation
         """
-        bsc = getToolByName(self, 'bika_setup_catalog')
-        keywords = self.bika_setup_catalog.uniqueValuesFor('getKeyword')
-        profiles = []
-        for p in bsc(portal_type='AnalysisProfile'):
-            p = p.getObject()
-            profiles.append(p.Title())
-            profiles.append(p.getProfileKey())
+        lookups = self.get_lookups()
+        keywords = lookups.keywords
+        profiles = lookups.profile_names
 
         sample_data = self.get_sample_values()
         if not sample_data:
@@ -551,20 +725,18 @@ class ARImport(BaseFolder):
             if 'ContainerType' in row:
                 title = row['ContainerType']
                 if title:
-                    obj = self.lookup(('ContainerType',),
-                                      Title=row['ContainerType'])
-                    if obj:
-                        gridrow['ContainerType'] = obj[0].UID
+                    uids = lookups.lookup(('ContainerType',), 'Title', title)
+                    if uids:
+                        gridrow['ContainerType'] = uids[0]
                 del (row['ContainerType'])
 
             if 'SampleMatrix' in row:
                 # SampleMatrix - not part of sample or AR schema
                 title = row['SampleMatrix']
                 if title:
-                    obj = self.lookup(('SampleMatrix',),
-                                      Title=row['SampleMatrix'])
-                    if obj:
-                        gridrow['SampleMatrix'] = obj[0].UID
+                    uids = lookups.lookup(('SampleMatrix',), 'Title', title)
+                    if uids:
+                        gridrow['SampleMatrix'] = uids[0]
                 del (row['SampleMatrix'])
 
             # match against sample schema
@@ -702,16 +874,17 @@ class ARImport(BaseFolder):
             return value
         if field.type == 'reference':
             value = str(value).strip()
-            brains = self.lookup(field.allowed_types, Title=value)
-            if not brains:
-                brains = self.lookup(field.allowed_types, UID=value)
-            if not brains:
+            lookups = self.get_lookups()
+            uids = lookups.lookup(field.allowed_types, 'Title', value)
+            if not uids:
+                uids = lookups.lookup(field.allowed_types, 'UID', value)
+            if not uids:
                 raise ValueError('Row %s: value is invalid (%s=%s)' % (
                     row_nr, fieldname, value))
             if field.multiValued:
-                return [b.UID for b in brains] if brains else []
+                return uids
             else:
-                return brains[0].UID if brains else None
+                return uids[0]
         if field.type == 'datetime':
             try:
                 value = DateTime(value)
@@ -793,13 +966,9 @@ class ARImport(BaseFolder):
         that each one is correct
         """
 
-        bsc = getToolByName(self, 'bika_setup_catalog')
-        keywords = bsc.uniqueValuesFor('getKeyword')
-        profiles = []
-        for p in bsc(portal_type='AnalysisProfile'):
-            p = p.getObject()
-            profiles.append(p.Title())
-            profiles.append(p.getProfileKey())
+        lookups = self.get_lookups()
+        keywords = lookups.keywords
+        profiles = lookups.profile_names
 
         row_nr = 0
         for gridrow in self.getSampleData():
@@ -854,14 +1023,14 @@ class ARImport(BaseFolder):
                     row_nr, fieldname))
             if not value:
                 return value
-            brains = self.lookup(field.allowed_types, UID=value)
-            if not brains:
+            uids = self.get_lookups().lookup(field.allowed_types, 'UID', value)
+            if not uids:
                 raise ValueError("Row %s: value is invalid (%s=%s)" % (
                     row_nr, fieldname, value))
             if field.multiValued:
-                return [b.UID for b in brains] if brains else []
+                return uids
             else:
-                return brains[0].UID if brains else None
+                return uids[0]
         if field.type == 'datetime':
             try:
                 ulocalized_time(DateTime(value), long_format=True,
@@ -871,33 +1040,15 @@ class ARImport(BaseFolder):
                     row_nr, fieldname, value))
         return value
 
-    def lookup(self, allowed_types, **kwargs):
-        """Lookup an object of type (allowed_types).  kwargs is sent
-        directly to the catalog.
-        """
-        at = getToolByName(self, 'archetype_tool')
-        for portal_type in allowed_types:
-            catalog = at.catalog_map.get(portal_type, [None])[0]
-            catalog = getToolByName(self, catalog)
-            kwargs['portal_type'] = portal_type
-            brains = catalog(**kwargs)
-            if brains:
-                return brains
-
     def get_row_services(self, row):
         """Return a list of services which are referenced in Analyses.
         values may be UID, Title or Keyword.
         """
-        bsc = getToolByName(self, 'bika_setup_catalog')
+        lookups = self.get_lookups()
         services = set()
         for val in row.get('Analyses', []):
-            brains = bsc(portal_type='AnalysisService', getKeyword=val)
-            if not brains:
-                brains = bsc(portal_type='AnalysisService', title=val)
-            if not brains:
-                brains = bsc(portal_type='AnalysisService', UID=val)
-            if brains:
-                services.add(brains[0].UID)
+            if val in lookups.services:
+                services.add(lookups.services[val])
             else:
                 self.error("Invalid analysis specified: %s" % val)
         return list(services)
@@ -906,15 +1057,12 @@ class ARImport(BaseFolder):
         """Return a list of services which are referenced in profiles
         values may be UID, Title or ProfileKey.
         """
-        bsc = getToolByName(self, 'bika_setup_catalog')
+        lookups = self.get_lookups()
         services = set()
-        profiles = [x.getObject() for x in bsc(portal_type='AnalysisProfile')]
         for val in row.get('Profiles', []):
-            objects = [x for x in profiles
-                       if val in (x.getProfileKey(), x.UID(), x.Title())]
-            if objects:
-                for service in objects[0].getService():
-                    services.add(service.UID())
+            if val in lookups.profiles:
+                profile_uid = lookups.profiles[val]
+                services.update(lookups.profile_services[profile_uid])
             else:
                 self.error("Invalid profile specified: %s" % val)
         return list(services)
@@ -922,16 +1070,13 @@ class ARImport(BaseFolder):
     def get_row_container(self, row):
         """Return a sample container
         """
-        bsc = getToolByName(self, 'bika_setup_catalog')
+        lookups = self.get_lookups()
         val = row.get('Container', False)
         if val:
-            brains = bsc(portal_type='Container', UID=row['Container'])
-            if brains:
-                brains[0].getObject()
-            brains = bsc(portal_type='ContainerType', UID=row['Container'])
-            if brains:
+            uids = lookups.lookup(('ContainerType',), 'UID', val)
+            if uids:
                 # XXX Cheating.  The calculation of capacity vs. volume  is not done.
-                return brains[0].getObject()
+                return lookups.get_object(uids[0])
         return None
 
     def get_row_profiles(self, row):
@@ -28,6 +28,9 @@ schema = BikaSchema.copy() + atapi.Schema((
 
     atapi.StringField('Results', default=''),
 
+    # Seconds spent importing the file
+    atapi.FloatField('Duration', default=0.0),
+
     atapi.DateTimeField('LogTime', default=DateTime()),
 ))
 
@@ -477,6 +477,18 @@ schema = BikaFolderSchema.copy() + Schema((
                 "are used to select multiple analysis services together"),
         )
     ),
+    IntegerField(
+        'ARImportChunkSize',
+        schemata="Analyses",
+        required=1,
+        default=50,
+        widget=IntegerWidget(
+            label=_("AR Import chunk size"),
+            description=_(
+                "Number of rows of an AR Import created and saved at once. "
+                "An interrupted import resumes after the last saved row"),
+        )
+    ),
     StringField(
         'ARAttachmentOption',
         schemata="Analyses",
@@ -116,6 +116,8 @@ class Calculation(BaseFolder, HistoryAwareMixin):
 
             self.getField('DependentServices').set(self, DependentServices)
             self.getField('Formula').set(self, Formula)
+        # The compiled formula is no longer valid
+        self._v_compiled_formula = None
 
     def getMinifiedFormula(self):
         """Return the current formula value as text.
@@ -124,6 +126,39 @@ class Calculation(BaseFolder, HistoryAwareMixin):
         value = " ".join(self.getFormula().splitlines())
         return value
 
+    def getCompiledFormula(self):
+        """Return the formula compiled into a code object, with every
+        [Keyword] replaced by a lookup of the keyword in the mapping the
+        formula is evaluated against. The code object is cached together
+        with the formula text it was compiled from.
+        """
+        formula = self.getMinifiedFormula()
+        cached = getattr(self, '_v_compiled_formula', None)
+        if cached and cached[0] == formula:
+            return cached[1]
+        expression = re.sub(r"\[([^\]]+)\]",
+                            lambda match: "_value(%r)" % match.group(1),
+                            formula)
+        code = compile(expression.strip(), '<formula>', 'eval')
+        self._v_compiled_formula = (formula, code)
+        return code
+
+    def evaluateFormula(self, mapping, context=None):
+        """Evaluate the formula against the mapping of keywords to values.
+        Values are rounded to six decimals, as the former interpolation of
+        the mapping into the formula text did ('%f'). Raises KeyError if a
+        keyword is missing in the mapping and TypeError if its value is not
+        a number.
+        """
+        def _value(keyword):
+            return float('%f' % mapping[keyword])
+
+        return eval(self.getCompiledFormula(),
+                    {'__builtins__': __builtins__,
+                     'math': math,
+                     'context': context,
+                     '_value': _value})
+
     def getMappedFormula(self, analysis, mapping):
         formula = self.getMinifiedFormula()
         # XXX regex groups to replace only [x] where x in interim keys.
@@ -141,7 +176,6 @@ class Calculation(BaseFolder, HistoryAwareMixin):
                         'context': analysis},
                        {'mapping': mapping})
 
-        print analysis, mapped, mapping
         return mapped
 
 
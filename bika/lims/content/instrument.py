@@ -4,6 +4,7 @@
 # Some rights reserved. See LICENSE.txt, AUTHORS.txt.
 
 from datetime import date
+import time
 
 from AccessControl import ClassSecurityInfo
 from Products.ATContentTypes.content import schemata
@@ -347,6 +348,38 @@ def getImportDataInterfaces(context, import_only=False):
     exims.insert(0, ('', t(_('None'))))
     return DisplayList(exims)
 
+# Seconds the validity of an instrument is cached for by
+# get_instrument_validity
+VALIDITY_CACHE_TTL = 30
+# {instrument UID: (expires, isValid, isOutOfDate)}
+_validity_cache = {}
+
+
+def get_instrument_validity(instrument):
+    """ Returns a tuple (isValid, isOutOfDate) for the instrument passed
+        in. The values are cached for VALIDITY_CACHE_TTL seconds, so listings
+        with many analyses don't check the certifications, calibrations and
+        internal calibration tests of the instrument for each analysis. The
+        cache is invalidated when any of them changes, but the values can be
+        out of date (e.g. a certification expired) for up to the ttl.
+    """
+    uid = instrument.UID()
+    now = time.time()
+    cached = _validity_cache.get(uid)
+    if cached and cached[0] > now:
+        return cached[1:]
+    validity = (instrument.isValid(), instrument.isOutOfDate())
+    _validity_cache[uid] = (now + VALIDITY_CACHE_TTL, ) + validity
+    return validity
+
+
+def invalidate_instrument_validity(instrument):
+    """ Removes the instrument passed in from the cache of
+        get_instrument_validity
+    """
+    _validity_cache.pop(instrument.UID(), None)
+
+
 def getMaintenanceTypes(context):
     types = [('preventive', 'Preventive'),
              ('repair', 'Repair'),
@@ -740,6 +773,11 @@ class Instrument(ATFolder):
 
     def cleanReferenceAnalysesCache(self):
         self.getField('_LatestReferenceAnalyses').set(self, [])
+        invalidate_instrument_validity(self)
+
+    def setDisposeUntilNextCalibrationTest(self, value):
+        self.getField('DisposeUntilNextCalibrationTest').set(self, value)
+        invalidate_instrument_validity(self)
 
     def addReferences(self, reference, service_uids):
         """ Add reference analyses to reference
@@ -782,8 +820,7 @@ class Instrument(ATFolder):
                 ref_analysis.setInterimFields(calc.getInterimFields())
 
             # Comes from a worksheet or has been attached directly?
-            ws = ref_analysis.getBackReferences('WorksheetAnalysis')
-            if not ws or len(ws) == 0:
+            if not ref_analysis.getWorksheetUID():
                 # This is a reference analysis attached directly to the
                 # Instrument, we apply the assign state
                 wf.doActionFor(ref_analysis, 'assign')
@@ -794,7 +831,7 @@ class Instrument(ATFolder):
 
         # Set DisposeUntilNextCalibrationTest to False
         if (len(addedanalyses) > 0):
-            self.getField('DisposeUntilNextCalibrationTest').set(self, False)
+            self.setDisposeUntilNextCalibrationTest(False)
 
         return addedanalyses
 
@@ -35,6 +35,38 @@ schema = BikaSchema.copy() + Schema((
             label=_("Client"),
         ),
     ),
+    # Reports are rendered by the 'report-render' task queue if registered.
+    # Until then they are 'pending' (or 'running'), and 'failed' if the
+    # rendering raised. Reports rendered right away are 'done'.
+    StringField('RenderStatus',
+        default = 'done',
+        widget = StringWidget(
+            visible = False,
+        ),
+    ),
+    # Form parameters the report is rendered with, as JSON
+    TextField('RenderParameters',
+        default_content_type = 'text/plain',
+        allowed_content_types = ('text/plain', ),
+        default_output_type = 'text/plain',
+        widget = TextAreaWidget(
+            visible = False,
+        ),
+    ),
+    # Hash of the parameters, used to find identical reports being rendered
+    StringField('ParametersHash',
+        widget = StringWidget(
+            visible = False,
+        ),
+    ),
+    TextField('RenderError',
+        default_content_type = 'text/plain',
+        allowed_content_types = ('text/plain', ),
+        default_output_type = 'text/plain',
+        widget = TextAreaWidget(
+            visible = False,
+        ),
+    ),
 ),
 )
 
@@ -19,6 +19,7 @@ from Products.CMFPlone.utils import _createObjectByType, safe_unicode
 from bika.lims import bikaMessageFactory as _
 from bika.lims import deprecated
 from bika.lims import logger
+from bika.lims.browser.fields import IndexedReferenceField
 from bika.lims.browser.fields import UIDReferenceField
 from bika.lims.config import *
 from bika.lims.config import PROJECTNAME
@@ -50,7 +51,7 @@ schema = BikaSchema.copy() + Schema((
         subfield_types={'position': 'int'},
     ),
     # all layout info lives in Layout; Analyses is used for back references.
-    ReferenceField('Analyses',
+    IndexedReferenceField('Analyses',
         required=1,
         multiValued=1,
         allowed_types=('Analysis', 'DuplicateAnalysis', 'ReferenceAnalysis', 'RejectAnalysis'),
@@ -148,72 +149,105 @@ class Worksheet(BaseFolder, HistoryAwareMixin):
            - position is overruled if a slot for this analysis' parent exists
            - if position is None, next available pos is used.
         """
-        workflow = getToolByName(self, 'portal_workflow')
-
-        analysis_uid = analysis.UID()
-        parent_uid = analysis.aq_parent.UID()
-        analyses = self.getAnalyses()
+        positions = None
+        if position:
+            positions = {analysis.aq_parent.UID(): position}
+        self.addAnalyses([analysis], positions)
+
+    security.declareProtected(EditWorksheet, 'addAnalyses')
+
+    def addAnalyses(self, analyses, positions=None):
+        """- add the analyses to self.Analyses() at once.
+           - positions is an optional dict {container_uid: position} with
+             the slot to be used for the analyses of each container. It is
+             overruled if a slot for the container exists already.
+           - the analyses of containers without slot are placed in the next
+             available positions.
+           Analyses and Layout are written once and the worksheet is
+           reindexed once, regardless of the number of analyses added.
+        """
+        ws_analyses = self.getAnalyses()
         layout = self.getLayout()
+        positions = positions or {}
 
-        # check if this analysis is already in the layout
-        if analysis_uid in [l['analysis_uid'] for l in layout]:
-            return
+        # container_uid -> position of the slots in the layout
+        slots = {}
+        for slot in layout:
+            slots.setdefault(slot['container_uid'], int(slot['position']))
+        used_positions = set([int(slot['position']) for slot in layout])
+        assigned = set([slot['analysis_uid'] for slot in layout])
 
         # If the ws has an instrument assigned for which the analysis
         # is allowed, set it
         instr = self.getInstrument()
-        if instr and analysis.isInstrumentAllowed(instr):
-            # TODO After enabling multiple methods for instruments, we are
-            # setting intrument's first method as a method.
-            methods = instr.getMethods()
-            if len(methods) > 0:
-                # Set the first method assigned to the selected instrument
-                analysis.setMethod(methods[0])
-            analysis.setInstrument(instr)
-        # If the ws DOESN'T have an instrument assigned but it has a method,
-        # set the method to the analysis
+        # TODO After enabling multiple methods for instruments, we are
+        # setting intrument's first method as a method.
+        instr_methods = instr and instr.getMethods() or []
         method = self.getMethod()
-        if not instr and method and analysis.isMethodAllowed(method):
-            # Set the method
-            analysis.setMethod(method)
-        self.setAnalyses(analyses + [analysis, ])
-
-        # if our parent has a position, use that one.
-        if analysis.aq_parent.UID() in [slot['container_uid'] for slot in layout]:
-            position = [int(slot['position']) for slot in layout if
-                        slot['container_uid'] == analysis.aq_parent.UID()][0]
-        else:
-            # prefer supplied position parameter
-            if not position:
-                used_positions = [0, ] + [int(slot['position']) for slot in layout]
-                position = [pos for pos in range(1, max(used_positions) + 2)
-                            if pos not in used_positions][0]
-        self.setLayout(layout + [{'position': position,
-                                  'type': 'a',
-                                  'container_uid': parent_uid,
-                                  'analysis_uid': analysis.UID()}, ])
-
-        doActionFor(analysis, 'assign')
-
-        # If a dependency of DryMatter service is added here, we need to
-        # make sure that the dry matter analysis itself is also
-        # present.  Otherwise WS calculations refer to the DB version
-        # of the DM analysis, which is out of sync with the form.
         dms = self.bika_setup.getDryMatterService()
-        if dms:
-            dmk = dms.getKeyword()
-            deps = analysis.getDependents()
-            # if dry matter service in my dependents:
-            if dmk in [a.getKeyword() for a in deps]:
+        dmk = dms and dms.getKeyword() or None
+
+        added = []
+        new_slots = []
+        pending = list(analyses)
+        while pending:
+            analysis = pending.pop(0)
+            analysis_uid = analysis.UID()
+            # check if this analysis is already in the layout
+            if analysis_uid in assigned:
+                continue
+            assigned.add(analysis_uid)
+
+            if instr and analysis.isInstrumentAllowed(instr):
+                if len(instr_methods) > 0:
+                    # Set the first method assigned to the selected
+                    # instrument
+                    analysis.setMethod(instr_methods[0])
+                analysis.setInstrument(instr)
+            # If the ws DOESN'T have an instrument assigned but it has a
+            # method, set the method to the analysis
+            if not instr and method and analysis.isMethodAllowed(method):
+                analysis.setMethod(method)
+
+            # if our parent has a position, use that one.
+            parent_uid = analysis.aq_parent.UID()
+            position = slots.get(parent_uid)
+            if position is None:
+                # prefer supplied position parameter
+                position = positions.get(parent_uid)
+                if not position:
+                    position = 1
+                    while position in used_positions:
+                        position += 1
+                slots[parent_uid] = int(position)
+                used_positions.add(int(position))
+            added.append(analysis)
+            new_slots.append({'position': position,
+                              'type': 'a',
+                              'container_uid': parent_uid,
+                              'analysis_uid': analysis_uid})
+
+            # If a dependency of DryMatter service is added here, we need
+            # to make sure that the dry matter analysis itself is also
+            # present.  Otherwise WS calculations refer to the DB version
+            # of the DM analysis, which is out of sync with the form.
+            if dmk and dmk in [a.getKeyword() for a in
+                               analysis.getDependents()]:
                 # get dry matter analysis from AR
                 dma = analysis.aq_parent.getAnalyses(getKeyword=dmk,
                                                      full_objects=True)[0]
-                # add it.
-                if dma not in self.getAnalyses():
-                    self.addAnalysis(dma)
+                pending.append(dma)
+
+        if not added:
+            return
+        self.setAnalyses(ws_analyses + added)
+        self.setLayout(layout + new_slots)
+        for analysis in added:
+            doActionFor(analysis, 'assign')
         # Reindex the worksheet in order to update its columns
         self.reindexObject()
-        analysis.reindexObject(idxs=['getWorksheetUID',])
+        for analysis in added:
+            analysis.reindexObject(idxs=['getWorksheetUID', ])
 
     security.declareProtected(EditWorksheet, 'removeAnalysis')
 
@@ -227,7 +261,7 @@ class Worksheet(BaseFolder, HistoryAwareMixin):
         doActionFor(analysis, 'unassign')
 
         # remove analysis from context.Analyses *after* unassign,
-        # (doActionFor requires worksheet in analysis.getBackReferences)
+        # (doActionFor requires worksheet in analysis.getWorksheet)
         Analyses = self.getAnalyses()
         if analysis in Analyses:
             Analyses.remove(analysis)
@@ -460,37 +494,64 @@ class Worksheet(BaseFolder, HistoryAwareMixin):
         nr_slots = len(wst_slots) - len(ws_slots)
         positions = [pos for pos in wst_slots if pos not in ws_slots]
 
-        analyses = bac(portal_type='Analysis',
-                       getServiceUID=wst_service_uids,
-                       review_state='sample_received',
-                       worksheetanalysis_review_state='unassigned',
-                       cancellation_state = 'active',
-                       sort_on='getDueDate')
-
-        # ar_analyses is used to group analyses by AR.
-        ar_analyses = {}
+        query = dict(portal_type='Analysis',
+                     getServiceUID=wst_service_uids,
+                     review_state='sample_received',
+                     worksheetanalysis_review_state='unassigned',
+                     cancellation_state = 'active',
+                     sort_on='getDueDate')
         instr = self.getInstrument() if self.getInstrument() else wst.getInstrument()
         method = wst.getRestrictToMethod()
-        for brain in analyses:
-            analysis = brain.getObject()
-            if (instr and analysis.isInstrumentAllowed(instr) is False) or\
-                    (method and analysis.isMethodAllowed(method) is False):
-                # Exclude those analyses for which the ws selected
-                # instrument or method is not allowed
-                continue
+        instr_uid = instr and instr.UID() or None
+        method_uid = method and method.UID() or None
+        indexes = bac.indexes()
+        if instr_uid and 'getAllowedInstrumentUIDs' in indexes:
+            query['getAllowedInstrumentUIDs'] = instr_uid
+        if method_uid and 'getAllowedMethodUIDs' in indexes:
+            query['getAllowedMethodUIDs'] = method_uid
+
+        def is_allowed(brain):
+            # Exclude those analyses for which the ws selected
+            # instrument or method is not allowed
+            if instr_uid and \
+                    instr_uid not in (brain.getAllowedInstrumentUIDs or []):
+                return False
+            if method_uid and \
+                    method_uid not in (brain.getAllowedMethodUIDs or []):
+                return False
+            return True
 
-            ar_id = brain.getRequestID
-            if ar_id in ar_analyses:
-                ar_analyses[ar_id].append(analysis)
-            else:
-                if len(ar_analyses.keys()) < nr_slots:
-                    ar_analyses[ar_id] = [analysis, ]
+        # Select the ARs with the analyses due first, until the slots are
+        # filled
+        ar_ids = []
+        if nr_slots > 0:
+            for brain in bac(query):
+                if brain.getRequestID in ar_ids or not is_allowed(brain):
+                    continue
+                ar_ids.append(brain.getRequestID)
+                if len(ar_ids) == nr_slots:
+                    break
+
+        # ar_analyses is used to group analyses by AR.
+        ar_analyses = {}
+        if ar_ids:
+            query['getRequestID'] = ar_ids
+            for brain in bac(query):
+                if is_allowed(brain):
+                    ar_analyses.setdefault(brain.getRequestID, []).append(
+                        brain)
 
         # Add analyses, sorted by AR ID
         ars = sorted(ar_analyses.keys())
+        to_add = []
+        ar_positions = {}
         for ar in ars:
-            for analysis in ar_analyses[ar]:
-                self.addAnalysis(analysis, position=positions[ars.index(ar)])
+            for brain in ar_analyses[ar]:
+                analysis = brain.getObject()
+                to_add.append(analysis)
+                ar_positions[analysis.aq_parent.UID()] = \
+                    positions[ars.index(ar)]
+        self.addAnalyses(to_add, ar_positions)
 
         # find best maching reference samples for Blanks and Controls
         for t in ('b', 'c'):
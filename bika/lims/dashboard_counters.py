@@ -0,0 +1,192 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+""" Per-day counters of the Analysis Requests, Analyses and Worksheets in
+    each review_state, used to build the evolution charts of the dashboard
+    without walking the catalogs.
+
+    Every object is counted once, in the bucket of the day it was created,
+    its current review_state and the departments it belongs to. The bucket
+    each object is counted in is remembered, so the counters can be updated
+    after any workflow change by moving the object from its previous bucket
+    to the current one. Cancelled objects are not counted.
+"""
+
+from BTrees.Length import Length
+from BTrees.OOBTree import OOBTree
+from Products.CMFCore.utils import getToolByName
+from bika.lims import logger
+from bika.lims.catalog import CATALOG_ANALYSIS_LISTING
+from bika.lims.catalog import CATALOG_ANALYSIS_REQUEST_LISTING
+from bika.lims.catalog import CATALOG_WORKSHEET_LISTING
+from zope.annotation.interfaces import IAnnotations
+import datetime
+import transaction
+
+# Annotation key of the portal where the counters are stored
+EVOLUTION_COUNTS = 'bika.lims.dashboard.counts'
+# Annotation key of the portal where the bucket of each object is stored
+EVOLUTION_ENTRIES = 'bika.lims.dashboard.entries'
+
+# Types counted, with the catalog they are listed in and the name of the
+# accessor that returns their department(s). Worksheets are not indexed by
+# department, so they have no department dimension.
+EVOLUTION_TYPES = {
+    'AnalysisRequest': (CATALOG_ANALYSIS_REQUEST_LISTING, 'getDepartmentUIDs'),
+    'Analysis': (CATALOG_ANALYSIS_LISTING, 'getDepartmentUID'),
+    'Worksheet': (CATALOG_WORKSHEET_LISTING, None),
+}
+
+
+def get_evolution_storage(context):
+    """ Returns a tuple (counts, entries) with the BTrees stored in the
+        portal. 'counts' maps the buckets (portal_type, day, departments,
+        review_state) to the number of objects in them and 'entries' maps
+        the UID of each counted object to its bucket.
+    """
+    portal = getToolByName(context, 'portal_url').getPortalObject()
+    annotations = IAnnotations(portal)
+    for key in (EVOLUTION_COUNTS, EVOLUTION_ENTRIES):
+        if key not in annotations:
+            annotations[key] = OOBTree()
+    return annotations[EVOLUTION_COUNTS], annotations[EVOLUTION_ENTRIES]
+
+
+def get_day(created):
+    """ Returns the day (as a proleptic Gregorian ordinal) of the DateTime
+        passed in
+    """
+    return datetime.date(
+        created.year(), created.month(), created.day()).toordinal()
+
+
+def get_departments(value):
+    """ Returns the department UIDs passed in as a sorted tuple
+    """
+    if not value:
+        return ()
+    if isinstance(value, basestring):
+        return (value, )
+    return tuple(sorted(set([uid for uid in value if uid])))
+
+
+def get_bucket(portal_type, created, review_state, departments):
+    """ Returns the bucket for an object with the values passed in
+    """
+    return (portal_type, get_day(created), get_departments(departments),
+            review_state)
+
+
+def get_object_bucket(instance):
+    """ Returns the bucket the instance has to be counted in, or None if it
+        does not have to be counted
+    """
+    workflow = getToolByName(instance, 'portal_workflow')
+    if workflow.getInfoFor(instance, 'cancellation_state', '') == 'cancelled':
+        return None
+    review_state = workflow.getInfoFor(instance, 'review_state', '')
+    if not review_state:
+        return None
+    accessor = EVOLUTION_TYPES[instance.portal_type][1]
+    departments = accessor and getattr(instance, accessor)() or None
+    return get_bucket(instance.portal_type, instance.created(), review_state,
+                      departments)
+
+
+def _move(counts, entries, uid, bucket):
+    """ Moves the object with the uid passed in from the bucket it is
+        counted in to the bucket passed in. If bucket is None, the object is
+        no longer counted.
+    """
+    previous = entries.get(uid)
+    if previous == bucket:
+        return
+    if previous is not None:
+        counts[previous].change(-1)
+        del entries[uid]
+    if bucket is not None:
+        if bucket not in counts:
+            counts[bucket] = Length()
+        counts[bucket].change(1)
+        entries[uid] = bucket
+
+
+def update_evolution_counters(instance):
+    """ Counts the instance in the bucket that matches its current state.
+        Called after each workflow change of the instance, including the
+        one that sets the initial state when the object is created.
+    """
+    if instance.portal_type not in EVOLUTION_TYPES:
+        return
+    factory = getToolByName(instance, 'portal_factory', None)
+    if factory is not None and factory.isTemporary(instance):
+        return
+    counts, entries = get_evolution_storage(instance)
+    _move(counts, entries, instance.UID(), get_object_bucket(instance))
+
+
+def remove_from_evolution_counters(instance):
+    """ Stops counting the instance. Called when the object is deleted.
+    """
+    if instance.portal_type not in EVOLUTION_TYPES:
+        return
+    counts, entries = get_evolution_storage(instance)
+    _move(counts, entries, instance.UID(), None)
+
+
+def get_evolution_counts(context, portal_type, date_from, date_to,
+                         departments=None):
+    """ Returns a dict {(day, review_state): count} with the number of
+        objects of the portal_type passed in created per day between
+        date_from and date_to (both DateTime), in each review_state. 'day'
+        is a datetime.date. If a list of department UIDs is passed in, only
+        the objects that belong to any of those departments are counted.
+    """
+    counts, entries = get_evolution_storage(context)
+    if departments is not None:
+        departments = set(departments)
+    out = {}
+    buckets = counts.items(min=(portal_type, get_day(date_from)),
+                           max=(portal_type, get_day(date_to) + 1),
+                           excludemax=True)
+    for (ptype, day, deps, state), count in buckets:
+        count = count()
+        if not count:
+            continue
+        if departments is not None and not departments.intersection(deps):
+            continue
+        key = (datetime.date.fromordinal(day), state)
+        out[key] = out.get(key, 0) + count
+    return out
+
+
+def rebuild_evolution_counters(context):
+    """ Discards the counters and counts again all the objects listed in the
+        catalogs. Returns the number of objects counted.
+    """
+    portal = getToolByName(context, 'portal_url').getPortalObject()
+    annotations = IAnnotations(portal)
+    annotations[EVOLUTION_COUNTS] = OOBTree()
+    annotations[EVOLUTION_ENTRIES] = OOBTree()
+    counts, entries = get_evolution_storage(portal)
+    total = 0
+    for portal_type, (catalog_id, accessor) in EVOLUTION_TYPES.items():
+        catalog = getToolByName(portal, catalog_id)
+        query = {'portal_type': portal_type}
+        if 'cancellation_state' in catalog.indexes():
+            query['cancellation_state'] = 'active'
+        brains = catalog.unrestrictedSearchResults(query)
+        logger.info("Counting {0} {1} for the dashboard".format(
+            len(brains), portal_type))
+        for brain in brains:
+            departments = accessor and getattr(brain, accessor, None) or None
+            bucket = get_bucket(portal_type, brain.created,
+                                brain.review_state, departments)
+            _move(counts, entries, brain.UID, bucket)
+            total += 1
+            if total % 10000 == 0:
+                transaction.savepoint(optimistic=True)
+    logger.info("Dashboard counters rebuilt: {0} objects".format(total))
+    return total
@@ -23,12 +23,24 @@ class AlerePimaSLKParser(InstrumentCSVResultsFileParser):
         self._linedata = {}#The line with the data
         self._rownum = None
         self._isFirst = True #Used to know if is the first linedata
+        self._ended = False #Whether the end of file has been reached
 
 
     def parse(self):
+        for line in self._readrows():
+            pass
+        return self._ended or None
+
+    def parseRecords(self, chunk_size=None):
+        return self._streamRecords(self._readrows(), chunk_size)
+
+    def _readrows(self):
+        """ Parses the file lazily, yielding each line parsed
+        """
         infile = self.getInputFile()
         self.log("Parsing file ${file_name}", mapping={"file_name":infile.filename})
-        for line in infile.readlines():
+        for line in infile:
+            yield line
             line = line.split(';')
             #The end of file
             if line[0] == 'E\n':
@@ -40,7 +52,8 @@ class AlerePimaSLKParser(InstrumentCSVResultsFileParser):
                 "total_results":self.getResultsTotalCount()}
                 )
                 self.builddict(self._isFirst)
-                return True
+                self._ended = True
+                return
             #The header
             elif line[0] != 'C' and line[0] != 'E':
                 self._header[line[0]] = line[1]
@@ -39,7 +39,16 @@ class Parser(InstrumentResultsFileParser):
     def parse(self):
         """ CSV Parser
         """
+        for row in self._readrows():
+            pass
+        return True
+
+    def parseRecords(self, chunk_size=None):
+        return self._streamRecords(self._readrows(), chunk_size)
 
+    def _readrows(self):
+        """ Parses the file lazily, yielding each row parsed
+        """
         reader = csv.DictReader(self.getInputFile(), delimiter='\t')
 
         for row in reader:
@@ -56,6 +65,7 @@ class Parser(InstrumentResultsFileParser):
             self._addRawResult(row['Sample ID'],
                                values={row['Analyte Name']: row},
                                override=False)
+            yield row
 
         self.log(
             "End of file reached successfully: ${total_objects} objects, "
@@ -65,8 +75,6 @@ class Parser(InstrumentResultsFileParser):
                      "total_results": self.getResultsTotalCount()}
         )
 
-        return True
-
 
 class Importer(AnalysisResultsImporter):
     """ Instrument Importer
@@ -54,7 +54,16 @@ class EasyQParser(InstrumentResultsFileParser):
     def parse(self):
         """ parse the data
         """
+        for row in self._readrows():
+            pass
 
+    def parseRecords(self, chunk_size=None):
+        return self._streamRecords(self._readrows(), chunk_size)
+
+    def _readrows(self):
+        """ Parses the rows of the worksheet lazily, yielding the number of
+            each row parsed
+        """
         # convert the xlsx file to csv first
         delimiter = "|"
         csv_file = self.xlsx_to_csv(self.getInputFile(), delimiter=delimiter)
@@ -85,6 +94,7 @@ class EasyQParser(InstrumentResultsFileParser):
             key = resid or serial
             testname = row.get("Product", "EasyQDirector")
             self._addRawResult(key, {testname: rawdict}, False)
+            yield n
 
 
 class EasyQImporter(AnalysisResultsImporter):
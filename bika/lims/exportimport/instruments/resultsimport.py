@@ -12,12 +12,15 @@ from bika.lims.utils import t
 from bika.lims.exportimport.instruments.logger import Logger
 from bika.lims.idserver import renameAfterCreation
 from bika.lims.utils import tmpID
+from bika.lims.utils.analysis import RecalculationPass
 from Products.Archetypes.config import REFERENCE_CATALOG
 from datetime import datetime
 from DateTime import DateTime
 from bika.lims.workflow import doActionFor
 from bika.lims.catalog import CATALOG_ANALYSIS_REQUEST_LISTING
+from collections import OrderedDict
 import os
+import transaction
 
 class InstrumentResultsFileParser(Logger):
 
@@ -28,6 +31,13 @@ class InstrumentResultsFileParser(Logger):
         self._rawresults = {}
         self._mimetype = mimetype
         self._numline = 0
+        # Object ids in _rawresults, the least recently added first. Used
+        # to pick the objects to be handed over when streaming
+        self._recent = OrderedDict()
+        # Object ids, keywords and results already handed over
+        self._streamedids = set()
+        self._streamedkeywords = set()
+        self._streamedresults = 0
 
     def getInputFile(self):
         """ Returns the results input file
@@ -93,28 +103,45 @@ class InstrumentResultsFileParser(Logger):
                        'Accuracy':      '98.19' }
                 }
         """
-        if override == True or resid not in self._rawresults.keys():
+        if override == True or resid not in self._rawresults:
             self._rawresults[resid] = [values]
         else:
             self._rawresults[resid].append(values)
+        self._recent.pop(resid, None)
+        self._recent[resid] = True
+
+    def _flushRawResults(self, keep=0):
+        """ Removes the raw results of the objects that have been added least
+            recently, leaving only the last 'keep' ones, and yields them as
+            (objid, results) tuples
+        """
+        while len(self._recent) > keep:
+            resid = self._recent.popitem(last=False)[0]
+            results = self._rawresults.pop(resid, [])
+            self._streamedids.add(resid)
+            for row in results:
+                self._streamedkeywords.update(row.keys())
+                self._streamedresults += len(row)
+            yield resid, results
 
     def _emptyRawResults(self):
         """ Remove all grabbed raw results
         """
         self._rawresults = {}
+        self._recent = OrderedDict()
 
     def getObjectsTotalCount(self):
         """ The total number of objects (ARs, ReferenceSamples, etc.) parsed
         """
-        return len(self.getRawResults())
+        return len(self._streamedids.union(self.getRawResults().keys()))
 
     def getResultsTotalCount(self):
         """ The total number of analysis results parsed
         """
-        count = 0
+        count = self._streamedresults
         for val in self.getRawResults().values():
             for row in val:
-                count += len(val)
+                count += len(row)
         return count
 
     def getAnalysesTotalCount(self):
@@ -125,11 +152,11 @@ class InstrumentResultsFileParser(Logger):
     def getAnalysisKeywords(self):
         """ The analysis service keywords found
         """
-        analyses = []
+        analyses = set(self._streamedkeywords)
         for rows in self.getRawResults().values():
             for row in rows:
-                analyses = list(set(analyses + row.keys()))
-        return analyses
+                analyses.update(row.keys())
+        return list(analyses)
 
     def getRawResults(self):
         """ Returns a dictionary containing the parsed results data
@@ -182,11 +209,41 @@ class InstrumentResultsFileParser(Logger):
         """
         return self._rawresults
 
+    def parseRecords(self, chunk_size=None):
+        """ Parses the input results file and yields the raw results as
+            (objid, results) tuples, in which results is a list of dicts as
+            described in getRawResults().
+            The same objid may be yielded more than once if its results are
+            spread over the file, each time with the results read since the
+            last. Once the generator is exhausted, resume() tells whether any
+            result has been found.
+            By default, the whole file is parsed before yielding anything.
+            Parsers able to stream the file keep the results of about
+            chunk_size objects in memory.
+        """
+        self.parse()
+        for record in self._flushRawResults():
+            yield record
+
+    def _streamRecords(self, steps, chunk_size=None):
+        """ Consumes steps, an iterator that parses the file as it is
+            consumed, and yields the raw results as parseRecords() does.
+            Whenever the results of more than 2 * chunk_size objects are kept
+            in memory, the results of the objects that have not been added to
+            for the last chunk_size objects parsed are yielded.
+        """
+        for step in steps:
+            if chunk_size and len(self._recent) > 2 * chunk_size:
+                for record in self._flushRawResults(chunk_size):
+                    yield record
+        for record in self._flushRawResults():
+            yield record
+
     def resume(self):
         """ Resumes the parse process
             Called by the Results Importer after parse() call
         """
-        if len(self.getRawResults()) == 0:
+        if self.getObjectsTotalCount() == 0:
             self.err("No results found")
             return False
         return True
@@ -201,8 +258,33 @@ class InstrumentCSVResultsFileParser(InstrumentResultsFileParser):
         self._encoding = encoding
 
     def parse(self):
+        for line in self._readlines():
+            pass
+        return self._endOfFile()
+
+    def parseRecords(self, chunk_size=None):
+        """ Parses the file line by line and yields the results of the
+            objects that have not been added to for the last chunk_size
+            objects parsed, so only the results of about 2 * chunk_size
+            objects are kept in memory. Parsers that override parse() are not
+            streamed.
+        """
+        if not chunk_size or self.parse.im_func is not \
+                InstrumentCSVResultsFileParser.parse.im_func:
+            for record in InstrumentResultsFileParser.parseRecords(self):
+                yield record
+            return
+        for record in self._streamRecords(self._readlines(), chunk_size):
+            yield record
+        self._endOfFile()
+
+    def _readlines(self):
+        """ Reads the input file lazily and passes each line to _parseline(),
+            yielding the number of each line parsed
+        """
         infile = self.getInputFile()
         self.log("Parsing file ${file_name}", mapping={"file_name":infile.filename})
+        self._critical = False
         jump = 0
         # We test in import functions if the file was uploaded
         try:
@@ -213,12 +295,12 @@ class InstrumentCSVResultsFileParser(InstrumentResultsFileParser):
                 f = open(infile.name, 'rU')
         except AttributeError:
             f = infile
-        for line in f.readlines():
+        for line in f:
             self._numline += 1
             if jump == -1:
                 # Something went wrong. Finish
-                self.err("File processing finished due to critical errors")
-                return False
+                self._critical = True
+                return
             if jump > 0:
                 # Jump some lines
                 jump -= 1
@@ -231,7 +313,15 @@ class InstrumentCSVResultsFileParser(InstrumentResultsFileParser):
             jump = 0
             if line:
                 jump = self._parseline(line)
+                yield self._numline
 
+    def _endOfFile(self):
+        """ Logs the end of the file parsed by _readlines(). Returns False if
+            the parsing finished due to critical errors
+        """
+        if self._critical:
+            self.err("File processing finished due to critical errors")
+            return False
         self.log(
             "End of file reached successfully: ${total_objects} objects, "
             "${total_analyses} analyses, ${total_results} results",
@@ -257,6 +347,15 @@ class InstrumentCSVResultsFileParser(InstrumentResultsFileParser):
 
 class AnalysisResultsImporter(Logger):
 
+    # Number of objects whose results are imported at once (see
+    # getChunkSize) and whether the transaction is committed after each
+    # chunk. If not, a savepoint is set instead.
+    chunk_size = 100
+    commit_chunks = False
+    # Number of records at the start of the file that are not imported,
+    # because they were committed by a previous import of the same file
+    skip_records = 0
+
     def __init__(self, parser, context,
                  idsearchcriteria=None,
                  override=[False, False],
@@ -270,7 +369,6 @@ class AnalysisResultsImporter(Logger):
         self._allowed_analysis_states = allowed_analysis_states
         self._override = override
         self._idsearch = idsearchcriteria
-        self._priorizedsearchcriteria = ''
         self.bsc = getToolByName(self.context, 'bika_setup_catalog')
         self.bac = getToolByName(self.context, 'bika_analysis_catalog')
         self.ar_catalog = getToolByName(
@@ -290,6 +388,15 @@ class AnalysisResultsImporter(Logger):
         if not self._idsearch:
             self._idsearch=['getId']
         self.instrument_uid=instrument_uid
+        # Analyses whose results, or the results of the analyses that
+        # depend on them, must be calculated once all results are imported
+        self._recalculate = []
+        # UIDs of the calculated analyses whose result has been imported, so
+        # it is not calculated again
+        self._imported_results = set()
+        # Analyses to be filled with results for each object id parsed, as
+        # {objid: {keyword: [analyses]}}, resolved before importing
+        self._targets = {}
 
     def getParser(self):
         """ Returns the parser that will be used for the importer
@@ -334,53 +441,174 @@ class AnalysisResultsImporter(Logger):
         """
         return []
 
+    def getChunkSize(self):
+        """ The number of objects (ARs, Reference Samples, etc.) whose
+            results are imported at once. Parsers able to stream the file
+            only keep the results of about twice this number of objects in
+            memory. If None, the whole file is parsed before importing.
+        """
+        return self.chunk_size
+
     def process(self):
-        self._parser.parse()
-        parsed = self._parser.resume()
         self._errors = self._parser.errors
         self._warns = self._parser.warns
         self._logs = self._parser.logs
-        self._priorizedsearchcriteria = ''
+        # Keywords to be imported, UIDs of their services (by keyword) and
+        # keywords already looked up
+        self._acodes = set()
+        self._services = {}
+        self._checkedacodes = set()
+        self._chunks = 0
+        self._records = 0
+        self._attachments = {}
+        self._importedars = {}
+        self._importedinsts = {}
+        self._ancount = 0
+        self._instrument = None
+        if self.instrument_uid:
+            insts = self.bsc(portal_type='Instrument', UID=self.instrument_uid)
+            self._instrument = insts and insts[0].getObject() or None
+
+        chunk_size = self.getChunkSize()
+        chunk = []
+        for record in self._parser.parseRecords(chunk_size):
+            self._records += 1
+            if self._records <= self.skip_records:
+                continue
+            chunk.append(record)
+            if chunk_size and len(chunk) >= chunk_size:
+                self._processChunk(chunk)
+                chunk = []
+        if chunk:
+            self._processChunk(chunk)
 
+        parsed = self._parser.resume()
         if parsed == False:
             return False
 
-        # Allowed analysis states
-        allowed_ar_states_msg = [t(_(s)) for s in self.getAllowedARStates()]
-        allowed_an_states_msg = [t(_(s)) for s in self.getAllowedAnalysisStates()]
-        self.log("Allowed Analysis Request states: ${allowed_states}",
-                 mapping={'allowed_states': ', '.join(allowed_ar_states_msg)})
-        self.log("Allowed analysis states: ${allowed_states}",
-                 mapping={'allowed_states': ', '.join(allowed_an_states_msg)})
-
-        # Exclude non existing ACODEs
-        acodes = []
-        ancount = 0
-        instprocessed = []
-        importedars = {}
-        importedinsts = {}
-        rawacodes = self._parser.getAnalysisKeywords()
+        # All the records may have been imported by a previous import
+        if len(self._acodes) == 0 and self._records > self.skip_records:
+            self.err("Service keywords: no matches found")
+
+        importedars = self._importedars
+        importedinsts = self._importedinsts
+        ancount = self._ancount
+
+        for arid, acodes in importedars.iteritems():
+            acodesmsg = ["Analysis %s" % acod for acod in acodes]
+            self.log("${request_id}: ${analysis_keywords} imported sucessfully",
+                     mapping={"request_id": arid,
+                              "analysis_keywords": acodesmsg})
+
+        for instid, acodes in importedinsts.iteritems():
+            acodesmsg = ["Analysis %s" % acod for acod in acodes]
+            msg = "%s: %s %s" % (instid, ", ".join(acodesmsg), "imported sucessfully")
+            self.log(msg)
+
+        if self.instrument_uid:
+            self.log(
+                "Import finished successfully: ${nr_updated_ars} ARs, "
+                "${nr_updated_instruments} Instruments and ${nr_updated_results} "
+                "results updated",
+                mapping={"nr_updated_ars": str(len(importedars)),
+                         "nr_updated_instruments": str(len(importedinsts)),
+                         "nr_updated_results": str(ancount)})
+        else:
+            self.log(
+                "Import finished successfully: ${nr_updated_ars} ARs and "
+                "${nr_updated_results} results updated",
+                mapping={"nr_updated_ars": str(len(importedars)),
+                         "nr_updated_results": str(ancount)})
+
+    def _processChunk(self, records):
+        """ Imports the results of the (objid, results) records passed in and
+            calculates the results that depend on them. Then commits the
+            transaction if commit_chunks is set, or sets a savepoint
+            otherwise, so the objects modified can be released from memory.
+        """
+        if not self._chunks:
+            # Allowed analysis states
+            allowed_ar_states_msg = [t(_(s)) for s in self.getAllowedARStates()]
+            allowed_an_states_msg = [t(_(s)) for s in self.getAllowedAnalysisStates()]
+            self.log("Allowed Analysis Request states: ${allowed_states}",
+                     mapping={'allowed_states': ', '.join(allowed_ar_states_msg)})
+            self.log("Allowed analysis states: ${allowed_states}",
+                     mapping={'allowed_states': ', '.join(allowed_an_states_msg)})
+        self._chunks += 1
+        self._checkKeywords(records)
+        self._processRecords(records)
+
+        # Calculate all the results that depend on the imported ones at once
+        recalculation = RecalculationPass(self._recalculate)
+        for analysis in recalculation.calculate(
+                override=self._override[1], keep=self._imported_results):
+            analysis.reindexObject(idxs=['Result'])
+        self._recalculate = []
+        self._imported_results = set()
+        self._targets = {}
+        if self.commit_chunks:
+            self.checkpoint(self._records)
+            transaction.commit()
+        else:
+            transaction.savepoint(optimistic=True)
+
+    def checkpoint(self, records):
+        """ Called before committing each chunk (if commit_chunks is set)
+            with the number of records of the file imported so far, so it
+            can be stored in the same transaction and an interrupted import
+            resumed after them (see skip_records)
+        """
+        pass
+
+    def _checkKeywords(self, records):
+        """ Looks for the services of the keywords in the records passed in
+            that have not been checked yet. Keywords without service are
+            warned about and excluded from the import
+        """
+        rawacodes = set()
+        for objid, results in records:
+            for result in results:
+                rawacodes.update(result.keys())
+        rawacodes = [acode for acode in rawacodes
+                     if acode and acode not in self._checkedacodes]
+        if not rawacodes:
+            return
+        self._checkedacodes.update(rawacodes)
         exclude = self.getKeywordsToBeExcluded()
+        # Keyword -> UID of the services with the keywords parsed
+        found = set()
+        for brain in self.bsc(getKeyword=rawacodes):
+            found.add(brain.getKeyword)
+            if brain.portal_type == 'AnalysisService':
+                self._services[brain.getKeyword] = brain.UID
         for acode in rawacodes:
-            if acode in exclude or not acode:
+            if acode in exclude:
                 continue
-            service = self.bsc(getKeyword=acode)
-            if not service:
+            if acode not in found:
                 self.warn('Service keyword ${analysis_keyword} not found',
                             mapping={"analysis_keyword": acode})
             else:
-                acodes.append(acode)
-        if len(acodes) == 0:
-            self.err("Service keywords: no matches found")
+                self._acodes.add(acode)
 
+    def _processRecords(self, records):
+        """ Imports the results of the (objid, results) records passed in
+        """
+        allowed_ar_states_msg = [t(_(s)) for s in self.getAllowedARStates()]
+        acodes = self._acodes
+        services = self._services
+        instrument = self._instrument
+        importedars = self._importedars
+        importedinsts = self._importedinsts
+        instprocessed = []
         # Attachments will be created in any worksheet that contains
         # analyses that are updated by this import
-        attachments = {}
+        attachments = self._attachments
         infile = self._parser.getInputFile()
+        # Resolve the analyses of all the objects at once
+        self._targets = self._prefetch([objid for objid, results in records],
+                                       acodes)
 
-        searchcriteria = self.getIdSearchCriteria()
-        #self.log(_("Search criterias: %s") % (', '.join(searchcriteria)))
-        for objid, results in self._parser.getRawResults().iteritems():
+        for objid, results in records:
             # Allowed more than one result for the same sample and analysis.
             # Needed for calibration tests
             for result in results:
@@ -389,8 +617,7 @@ class AnalysisResultsImporter(Logger):
                 if len(analyses) == 0 and self.instrument_uid:
                     # No registered analyses found, but maybe we need to
                     # create them first if an instruemnt id has been set in
-                    insts = self.bsc(portal_type='Instrument', UID=self.instrument_uid)
-                    if len(insts) == 0:
+                    if instrument is None:
                         # No instrument found
                         self.err("No Analysis Request with '${allowed_ar_states}' "
                                  "states found, And no QC analyses found for ${object_id}",
@@ -399,7 +626,7 @@ class AnalysisResultsImporter(Logger):
                         self.err("Instrument not found")
                         continue
 
-                    inst = insts[0].getObject()
+                    inst = instrument
 
                     # Create a new ReferenceAnalysis and link it to the Instrument
                     # Here we have an objid (i.e. R01200012) and
@@ -428,10 +655,10 @@ class AnalysisResultsImporter(Logger):
                     # to the Reference Sample
                     service_uids = []
                     reference_type = 'b' if refsample.getBlank() == True else 'c'
-                    services = self.bsc(portal_type='AnalysisService')
-                    service_uids = [service.UID for service in services \
-                                    if service.getObject().getKeyword() in result.keys()]
-                    analyses = inst.addReferences(refsample, service_uids)
+                    service_uids = [services[keyword] for keyword in result
+                                    if keyword in services]
+                    analyses = self._groupByKeyword(
+                        inst.addReferences(refsample, service_uids))
 
                 elif len(analyses) == 0:
                     # No analyses found
@@ -451,8 +678,7 @@ class AnalysisResultsImporter(Logger):
                         # Analysis keyword doesn't exist
                         continue
 
-                    ans = [analysis for analysis in analyses \
-                           if analysis.getKeyword() == acode]
+                    ans = analyses.get(acode, [])
 
                     if len(ans) > 1:
                         self.err("More than one analysis found for ${object_id} and ${analysis_keyword}",
@@ -473,8 +699,7 @@ class AnalysisResultsImporter(Logger):
                     # And only if the filename of the attachment is unique in
                     # this worksheet.  Otherwise we will attempt to use existing
                     # attachment.
-                    wss = analysis.getBackReferences('WorksheetAnalysis')
-                    ws = wss[0] if wss else None
+                    ws = analysis.getWorksheet()
                     if ws:
                         if ws.getId() not in attachments:
                             fn = infile.filename
@@ -489,7 +714,7 @@ class AnalysisResultsImporter(Logger):
                         values['DateTime'] = capturedate
                     processed = self._process_analysis(objid, analysis, values)
                     if processed:
-                        ancount += 1
+                        self._ancount += 1
                         if inst:
                             # Calibration Test (import to Instrument)
                             instprocessed.append(inst.UID())
@@ -516,32 +741,6 @@ class AnalysisResultsImporter(Logger):
                                 "it is not assigned to a worksheet (%s)" %
                                 analysis)
 
-        for arid, acodes in importedars.iteritems():
-            acodesmsg = ["Analysis %s" % acod for acod in acodes]
-            self.log("${request_id}: ${analysis_keywords} imported sucessfully",
-                     mapping={"request_id": arid,
-                              "analysis_keywords": acodesmsg})
-
-        for instid, acodes in importedinsts.iteritems():
-            acodesmsg = ["Analysis %s" % acod for acod in acodes]
-            msg = "%s: %s %s" % (instid, ", ".join(acodesmsg), "imported sucessfully")
-            self.log(msg)
-
-        if self.instrument_uid:
-            self.log(
-                "Import finished successfully: ${nr_updated_ars} ARs, "
-                "${nr_updated_instruments} Instruments and ${nr_updated_results} "
-                "results updated",
-                mapping={"nr_updated_ars": str(len(importedars)),
-                         "nr_updated_instruments": str(len(importedinsts)),
-                         "nr_updated_results": str(ancount)})
-        else:
-            self.log(
-                "Import finished successfully: ${nr_updated_ars} ARs and "
-                "${nr_updated_results} results updated",
-                mapping={"nr_updated_ars": str(len(importedars)),
-                         "nr_updated_results": str(ancount)})
-
     def create_mime_attachmenttype(self):
         # Create the AttachmentType for mime type if not exists
         attachmentType = self.bsc(portal_type="AttachmentType",
@@ -595,162 +794,127 @@ class AnalysisResultsImporter(Logger):
             fn_attachments[fn].append(att)
         return fn_attachments
 
-    def _getObjects(self, objid, criteria, states):
-        #self.log("Criteria: %s %s") % (criteria, obji))
-        obj = []
-        if (criteria == 'arid'):
-            obj = self.ar_catalog(
-                           getId=objid,
-                           review_state=states)
-        elif (criteria == 'sid'):
-            obj = self.ar_catalog(
-                           getSampleID=objid,
-                           review_state=states)
-        elif (criteria == 'csid'):
-            obj = self.ar_catalog(
-                           getClientSampleID=objid,
-                           review_state=states)
-        elif (criteria == 'aruid'):
-            obj = self.ar_catalog(
-                           UID=objid,
-                           review_state=states)
-        elif (criteria == 'rgid'):
-            obj = self.bac(portal_type=['ReferenceAnalysis',
-                                         'DuplicateAnalysis'],
-                                         getReferenceAnalysesGroupID=objid)
-        elif (criteria == 'rid'):
-            obj = self.bac(portal_type=['ReferenceAnalysis',
-                                         'DuplicateAnalysis'], id=objid)
-        elif (criteria == 'ruid'):
-            obj = self.bac(portal_type=['ReferenceAnalysis',
-                                          'DuplicateAnalysis'], UID=objid)
-        if obj and len(obj) > 0:
-            self._priorizedsearchcriteria = criteria
-        return obj
+    def _groupBy(self, brains, column):
+        """ Returns a dict {value: [brains]} with the brains passed in
+            grouped by the value of the metadata column
+        """
+        grouped = {}
+        for brain in brains:
+            grouped.setdefault(getattr(brain, column), []).append(brain)
+        return grouped
 
-    def _getZODBAnalyses(self, objid):
-        """ Searches for analyses from ZODB to be filled with results.
-            objid can be either AR ID or Worksheet's Reference Sample IDs.
-            It uses the getIdSearchCriteria() for searches
-            Only analyses that matches with getAnallowedAnalysisStates() will
-            be returned. If not a ReferenceAnalysis, getAllowedARStates() is
+    def _groupByKeyword(self, analyses):
+        """ Returns a dict {keyword: [analyses]} with the analyses passed in
+        """
+        grouped = {}
+        for analysis in analyses:
+            grouped.setdefault(analysis.getKeyword(), []).append(analysis)
+        return grouped
+
+    def _prefetch(self, objids, keywords):
+        """ Resolves all the object ids parsed (AR IDs or Worksheet's
+            Reference Sample IDs) to the analyses to be filled with results,
+            with a few catalog queries for all of them instead of several
+            queries per id. Returns a dict {objid: {keyword: [analyses]}}.
+            Only the analyses with the keywords passed in are woken up; the
+            keywords of the rest are mapped to empty lists.
+            Only analyses that matches with getAllowedAnalysisStates() are
+            returned. If not a ReferenceAnalysis, getAllowedARStates() is
             also checked.
-            Returns empty array if no analyses found
         """
-        ars = []
-        analyses = []
+        targets = {}
+        pending = set(objids)
+        ars = {}
         # HACK: Use always the full search workflow
-        #searchcriteria = self.getIdSearchCriteria()
-        searchcriteria = ['getId', 'getSampleID', 'getClientSampleID']
-        allowed_ar_states = self.getAllowedARStates()
-        allowed_an_states = self.getAllowedAnalysisStates()
-        allowed_ar_states_msg = [_(s) for s in allowed_ar_states]
-        allowed_an_states_msg = [_(s) for s in allowed_an_states]
-
-        # Acceleration of searches using priorization
-        if (self._priorizedsearchcriteria in ['rgid','rid','ruid']):
-            # Look from reference analyses
-            analyses = self._getZODBAnalysesFromReferenceAnalyses(objid,
-                        self._priorizedsearchcriteria)
-        if (len(analyses) == 0):
-            # Look from ar and derived
-            analyses = self._getZODBAnalysesFromAR(objid,
-                        '',
-                        searchcriteria,
-                        allowed_ar_states)
-
-        # Discard analyses that don't match with allowed_an_states
-        analyses = [analysis for analysis in analyses \
-                    if analysis.portal_type != 'Analysis' \
-                        or self.wf.getInfoFor(analysis, 'review_state') \
-                        in allowed_an_states]
+        # searchcriteria = self.getIdSearchCriteria()
+        for index in ['getId', 'getSampleID', 'getClientSampleID', 'UID']:
+            if not pending:
+                break
+            brains = self.ar_catalog({index: list(pending),
+                                      'review_state':
+                                          self.getAllowedARStates()})
+            for objid, matches in self._groupBy(brains, index).items():
+                pending.discard(objid)
+                if len(matches) > 1:
+                    self.err("More than one Analysis Request found for "
+                             "${object_id}", mapping={"object_id": objid})
+                    targets[objid] = {}
+                else:
+                    ars[matches[0].getPath()] = objid
+        if ars:
+            brains = self.bac(portal_type='Analysis',
+                              review_state=self.getAllowedAnalysisStates(),
+                              path={'query': ars.keys(), 'level': 0})
+            for objid in ars.values():
+                targets[objid] = {}
+            for brain in brains:
+                objid = ars.get(brain.getPath().rsplit('/', 1)[0])
+                if objid is None:
+                    continue
+                analyses = targets[objid].setdefault(brain.getKeyword, [])
+                if brain.getKeyword in keywords:
+                    analyses.append(brain.getObject())
+        if pending:
+            targets.update(self._prefetchReferenceAnalyses(pending))
+        return targets
+
+    def _prefetchReferenceAnalyses(self, objids):
+        """ Resolves the object ids passed in to the Reference and Duplicate
+            analyses with that Reference Analyses Group ID, id or UID.
+            Returns a dict {objid: {keyword: [analyses]}}
+        """
+        targets = {}
+        pending = set(objids)
+        portal_type = ['ReferenceAnalysis', 'DuplicateAnalysis']
+        for index, column in [('getReferenceAnalysesGroupID',
+                               'getReferenceAnalysesGroupID'),
+                              ('id', 'getId'),
+                              ('UID', 'UID')]:
+            if not pending:
+                break
+            brains = self.bac(portal_type=portal_type,
+                              **{index: list(pending)})
+            for objid, matches in self._groupBy(brains, column).items():
+                if index == 'getReferenceAnalysesGroupID':
+                    analyses = [brain.getObject() for brain in matches]
+                elif len(matches) > 1:
+                    # This should never happen!
+                    # Fetching ReferenceAnalysis for its id or uid should
+                    # *always* return a unique result
+                    self.err("More than one Reference Analysis found for "
+                             "${object_id}", mapping={"object_id": objid})
+                    continue
+                else:
+                    # The search has been made using the internal identifier
+                    # from a Reference Analysis (id or uid). That is not
+                    # usual. A ReferenceAnalysis must be always assigned to
+                    # a Worksheet (Regular QC) or to an Instrument (Internal
+                    # Calibration Test)
+                    an = matches[0].getObject()
+                    if not an.getWorksheetUID() \
+                            and not an.getInstrument():
+                        self.err("The Reference Analysis ${object_id} has "
+                                 "neither instrument nor worksheet assigned",
+                                 mapping={"object_id": objid})
+                        continue
+                    analyses = [an]
+                pending.discard(objid)
+                targets[objid] = self._groupByKeyword(analyses)
+        return targets
 
+    def _getZODBAnalyses(self, objid):
+        """ Returns the analyses to be filled with results for the object id
+            passed in, as resolved by _prefetch(), as a dict
+            {keyword: [analyses]}. Returns an empty dict if no analyses found
+        """
+        analyses = self._targets.get(objid, {})
         if len(analyses) == 0:
+            allowed_an_states_msg = [_(s) for s in
+                                     self.getAllowedAnalysisStates()]
             self.err(
                 "No analyses '${allowed_analysis_states}' states found for ${object_id}",
                 mapping={"allowed_analysis_states": ', '.join(allowed_an_states_msg),
                          "object_id": objid})
-
-        return analyses
-
-    def _getZODBAnalysesFromAR(self, objid, criteria, allowedsearches, arstates):
-        ars = []
-        analyses = []
-        if criteria:
-            ars = self._getObjects(objid, criteria, arstates)
-            if not ars or len(ars) == 0:
-                return self._getZODBAnalysesFromAR(objid, None,
-                            allowedsearches, arstates)
-        else:
-            sortorder = ['arid', 'sid', 'csid', 'aruid'];
-            for crit in sortorder:
-                if (crit == 'arid' and 'getId' in allowedsearches) \
-                    or (crit == 'sid' and 'getSampleID' in allowedsearches) \
-                    or (crit == 'csid' and 'getClientSampleID' in allowedsearches) \
-                    or (crit == 'aruid' and 'getId' in allowedsearches):
-                    ars = self._getObjects(objid, crit, arstates)
-                    if ars and len(ars) > 0:
-                        break
-
-        if not ars or len(ars) == 0:
-            return self._getZODBAnalysesFromReferenceAnalyses(objid, None)
-
-        elif len(ars) > 1:
-            self.err("More than one Analysis Request found for ${object_id}",
-                     mapping={"object_id": objid})
-            return []
-
-        ar = ars[0].getObject()
-        analyses = [analysis.getObject() for analysis in ar.getAnalyses()]
-
-        return analyses
-
-
-    def _getZODBAnalysesFromReferenceAnalyses(self, objid, criteria):
-        analyses = []
-        if criteria:
-            refans = self._getObjects(objid, criteria, [])
-            if len(refans) == 0:
-                return []
-
-            elif criteria == 'rgid':
-                return [an.getObject() for an in refans]
-
-            elif len(refans) == 1:
-                # The search has been made using the internal identifier
-                # from a Reference Analysis (id or uid). That is not usual.
-                an = refans[0].getObject()
-                wss = an.getBackReferences('WorksheetAnalysis')
-                if wss and len(wss) > 0:
-                    # A regular QC test (assigned to a Worksheet)
-                    return [an,]
-                elif an.getInstrument():
-                    # An Internal Calibration Test
-                    return [an,]
-                else:
-                    # Oops. This should never happen!
-                    # A ReferenceAnalysis must be always assigned to
-                    # a Worksheet (Regular QC) or to an Instrument
-                    # (Internal Calibration Test)
-                    self.err("The Reference Analysis ${object_id} has neither "
-                             "instrument nor worksheet assigned",
-                             mapping={"object_id":objid})
-                    return []
-            else:
-                # This should never happen!
-                # Fetching ReferenceAnalysis for its id or uid should
-                # *always* return a unique result
-                self.err("More than one Reference Analysis found for ${obect_id}",
-                         mapping={"object_id": objid})
-                return []
-
-        else:
-            sortorder = ['rgid', 'rid', 'ruid'];
-            for crit in sortorder:
-                analyses = self._getZODBAnalysesFromReferenceAnalyses(objid, crit)
-                if len(analyses) > 0:
-                    return analyses
-
         return analyses
 
     def _process_analysis(self, objid, analysis, values):
@@ -806,9 +970,10 @@ class AnalysisResultsImporter(Logger):
         fields_to_reindex = []
         if len(interimsout) > 0:
             analysis.setInterimFields(interimsout)
-            # won't be doing setResult below, so manually calculate result.
-            analysis.calculateResult(override=self._override[1])
-            fields_to_reindex.append('Result')
+        if resultsaved:
+            # won't be doing setResult below, so the result is calculated
+            # from the interims imported once all the results are imported.
+            self._recalculate.append(analysis)
 
         if resultsaved == False and (values.get(defresultkey, '')
                                      or values.get(defresultkey, '') == 0
@@ -825,6 +990,11 @@ class AnalysisResultsImporter(Logger):
                 analysis.setResultCaptureDate(capturedate)
             doActionFor(analysis, 'submit')
             resultsaved = True
+            # the analyses that depend on this one must be calculated
+            self._recalculate.append(analysis)
+            if analysis.getCalculation():
+                # but not this one, the result comes from the file
+                self._imported_results.add(analysis.UID())
 
         elif resultsaved == False:
             self.log("${request_id} result for '${analysis_keyword}': '${result}'",
@@ -46,6 +46,15 @@ class RocheCobasTaqmanRSFParser(InstrumentResultsFileParser):
                 return value
 
     def parse(self):
+        for row in self._readrows():
+            pass
+
+    def parseRecords(self, chunk_size=None):
+        return self._streamRecords(self._readrows(), chunk_size)
+
+    def _readrows(self):
+        """ Parses the file lazily, yielding the number of each row parsed
+        """
         reader = csv.DictReader(self.getInputFile(), delimiter=',')
 
         for n, row in enumerate(reader):
@@ -80,6 +89,7 @@ class RocheCobasTaqmanRSFParser(InstrumentResultsFileParser):
             rawdict['DateTime'] = dt
 
             self._addRawResult(resid, {testname: rawdict}, False)
+            yield n
 
 
 class RocheCobasTaqmanImporter(AnalysisResultsImporter):
@@ -4,7 +4,9 @@
 # Some rights reserved. See LICENSE.txt, AUTHORS.txt.
 
 from AccessControl import ModuleSecurityInfo, allow_module
+from BTrees.OOBTree import OOBTree
 from DateTime import DateTime
+from persistent import Persistent
 from Products.Archetypes.public import DisplayList
 from Products.CMFCore.utils import getToolByName
 from Products.CMFPlone.TranslationServiceTool import TranslationServiceTool
@@ -15,6 +17,7 @@ from bika.lims import interfaces
 from bika.lims import logger
 from plone.i18n.normalizer.interfaces import IFileNameNormalizer
 from plone.i18n.normalizer.interfaces import IIDNormalizer
+from zope.annotation.interfaces import IAnnotations
 from zope.component import getUtility
 from zope.interface import providedBy
 import copy,re,urllib
@@ -24,9 +27,100 @@ from zope.component import getAdapters
 from bika.lims.interfaces import IIdServer
 
 
+# Annotation key of the portal where the ID counters are stored
+ID_STORAGE = 'bika.lims.idserver.counters'
+# Annotation key of the request where the ID reservations are stored
+ID_RESERVATIONS = 'bika.lims.idserver.reservations'
+
+
 class IDServerUnavailable(Exception):
     pass
 
+
+class IDCounter(Persistent):
+    """ Persistent sequence counter for a single ID prefix.
+
+        Each prefix gets its own persistent record, so creating objects with
+        different prefixes concurrently never conflicts. Concurrent increments
+        of the same prefix are deliberately not resolved: merging both states
+        would hand out the same number twice, so the ConflictError is left to
+        the publisher, which retries the request against the new value.
+    """
+
+    def __init__(self, value=0):
+        self.value = value
+
+    def increment(self):
+        """ Returns the next number of the sequence
+        """
+        return self.reserve(1)[0]
+
+    def reserve(self, count):
+        """ Reserves a block of 'count' consecutive numbers and returns them
+            as a list. The counter is moved past the whole block at once.
+        """
+        count = int(count)
+        if count < 1:
+            raise ValueError("Cannot reserve %s ids" % count)
+        start = self.value + 1
+        self.value = self.value + count
+        return range(start, self.value + 1)
+
+    def ensure(self, value):
+        """ Moves the counter forward to 'value' if it lags behind it
+        """
+        if value > self.value:
+            self.value = value
+
+
+def get_id_storage(context):
+    """ Returns the BTree (prefix -> IDCounter) stored in the portal
+    """
+    portal = getToolByName(context, 'portal_url').getPortalObject()
+    annotations = IAnnotations(portal)
+    if ID_STORAGE not in annotations:
+        annotations[ID_STORAGE] = OOBTree()
+    return annotations[ID_STORAGE]
+
+
+def get_id_counter(context, key, seed=None):
+    """ Returns the IDCounter for the key passed in. If no counter exists
+        yet, a new one is created with the value returned by 'seed', a
+        callable that is only called once per key.
+    """
+    storage = get_id_storage(context)
+    counter = storage.get(key)
+    if counter is None:
+        value = seed and seed() or 0
+        counter = IDCounter(value)
+        storage[key] = counter
+    return counter
+
+
+def get_catalog_max_id(context, prefix, separator):
+    """ Returns the highest number used in ids of the form
+        <prefix><separator><number> in the first catalog the portal type of
+        context is indexed in, or 0 if none. This walks all the values of the
+        'id' index, so it is only used to seed the counters.
+    """
+    plone = context.portal_url.getPortalObject()
+    # grab the first catalog we are indexed in.
+    at = getToolByName(plone, 'archetype_tool')
+    if context.portal_type in at.catalog_map:
+        catalog_name = at.catalog_map[context.portal_type][0]
+    else:
+        catalog_name = 'portal_catalog'
+    catalog = getToolByName(plone, catalog_name)
+
+    # get all IDS that start with prefix
+    # this must specifically exclude AR IDs (two -'s)
+    rr = re.compile("^" + re.escape(prefix + separator) + "[\d+]+$")
+    ids = [int(i.split(prefix + separator)[1])
+           for i in catalog.Indexes['id'].uniqueValues()
+           if rr.match(i)]
+    return ids and max(ids) or 0
+
+
 def idserver_generate_id(context, prefix, batch_size = None):
     """ Generate a new id using external ID server.
     """
@@ -54,6 +148,80 @@ def idserver_generate_id(context, prefix, batch_size = None):
 
     return new_id
 
+def get_id_reservations(context):
+    """ Returns the ID reservations of the current request: a dict with the
+        announced number of objects keyed by (portal_type, prefix) and the
+        blocks of numbers already reserved keyed by sequence key.
+    """
+    request = getattr(context, 'REQUEST', None)
+    if request is None:
+        return None
+    annotations = IAnnotations(request)
+    if ID_RESERVATIONS not in annotations:
+        annotations[ID_RESERVATIONS] = {'pending': {}, 'blocks': {}}
+    return annotations[ID_RESERVATIONS]
+
+
+def reserve_ids(context, portal_type, count, prefix=None):
+    """ Announces that 'count' objects of 'portal_type' are about to be
+        created in the current request, e.g. by an import. The first id
+        generated afterwards for each sequence of that type reserves a block
+        big enough for all the announced objects, so a bulk creation makes
+        a single round trip to the counter (or the external ID server) per
+        prefix instead of one per object.
+
+        'prefix' narrows the announcement down to the objects that use that
+        prefix (e.g. the prefix of a Sample Type), so imports that mix
+        several prefixes don't reserve more numbers than they consume.
+        Numbers reserved but not used are lost when the request ends.
+    """
+    reservations = get_id_reservations(context)
+    if reservations is None:
+        return
+    pending = reservations['pending']
+    key = (portal_type, prefix)
+    pending[key] = pending.get(key, 0) + int(count)
+
+
+def discard_id_reservations(context):
+    """ Forgets the announcements and the blocks of numbers reserved in the
+        current request. To be called when a transaction that may have
+        fetched a block from the counter is aborted, so numbers that are
+        no longer reserved in the counter are not used.
+    """
+    request = getattr(context, 'REQUEST', None)
+    if request is None:
+        return
+    annotations = IAnnotations(request)
+    if ID_RESERVATIONS in annotations:
+        del annotations[ID_RESERVATIONS]
+
+
+def next_in_sequence(context, prefix, key, fetch):
+    """ Returns the next number of the sequence 'key'. 'fetch' is a callable
+        that takes a count and returns that many consecutive numbers from
+        the counter. If a bulk creation was announced with reserve_ids, the
+        number is taken from the block reserved for the current request.
+    """
+    reservations = get_id_reservations(context)
+    if not reservations or not reservations['pending']:
+        return fetch(1)[0]
+    pending = reservations['pending']
+    blocks = reservations['blocks']
+    announced = (context.portal_type, prefix)
+    if not pending.get(announced):
+        announced = (context.portal_type, None)
+    remaining = pending.get(announced, 0)
+    if remaining:
+        pending[announced] = remaining - 1
+    block = blocks.get(key)
+    if not block:
+        if remaining < 2:
+            return fetch(1)[0]
+        block = blocks[key] = list(fetch(remaining))
+    return block.pop(0)
+
+
 def generateUniqueId(context):
     """ Generate pretty content IDs.
         - context is used to find portal_type; in case there is no
@@ -106,19 +274,28 @@ def generateUniqueId(context):
 
         # if using external server
 
+        def next_id(prefix, key):
+            def fetch(count):
+                if count > 1:
+                    first = idserver_generate_id(context, key, count)
+                else:
+                    first = idserver_generate_id(context, key)
+                return range(int(first), int(first) + count)
+            return str(next_in_sequence(context, prefix, key, fetch))
+
         for d in prefixes:
             # Sample ID comes from SampleType
             if context.portal_type == "Sample":
                 prefix = context.getSampleType().getPrefix()
                 padding = context.bika_setup.getSampleIDPadding()
-                new_id = str(idserver_generate_id(context, "%s%s-" % (prefix, year)))
+                new_id = next_id(prefix, "%s%s-" % (prefix, year))
                 if padding:
                     new_id = new_id.zfill(int(padding))
                 return ('%s%s' + separator + '%s') % (prefix, year, new_id)
             elif d['portal_type'] == context.portal_type:
                 prefix = d['prefix']
                 padding = d['padding']
-                new_id = str(idserver_generate_id(context, "%s%s-" % (prefix, year)))
+                new_id = next_id(prefix, "%s%s-" % (prefix, year))
                 if padding:
                     new_id = new_id.zfill(int(padding))
                 return ('%s%s' + separator + '%s') % (prefix, year, new_id)
@@ -126,61 +303,50 @@ def generateUniqueId(context):
         # year is not inserted here
         # portal_type is be normalized to lowercase
         npt = id_normalize(context.portal_type)
-        new_id = str(idserver_generate_id(context, npt + "-"))
+        new_id = next_id(None, npt + "-")
         return ('%s' + separator + '%s') % (npt, new_id)
 
     else:
 
         # No external id-server.
 
-        def next_id(prefix):
+        def next_id(prefix, year, sequence_start=None):
             # normalize before anything
-            prefix = fn_normalize(prefix)
-            plone = context.portal_url.getPortalObject()
-            # grab the first catalog we are indexed in.
-            at = getToolByName(plone, 'archetype_tool')
-            if context.portal_type in at.catalog_map:
-                catalog_name = at.catalog_map[context.portal_type][0]
-            else:
-                catalog_name = 'portal_catalog'
-            catalog = getToolByName(plone, catalog_name)
-
-            # get all IDS that start with prefix
-            # this must specifically exclude AR IDs (two -'s)
-            rr = re.compile("^"+prefix+separator+"[\d+]+$")
-            ids = [int(i.split(prefix+separator)[1]) \
-                   for i in catalog.Indexes['id'].uniqueValues() \
-                   if rr.match(i)]
-
-            #plone_tool = getToolByName(context, 'plone_utils')
-            #if not plone_tool.isIDAutoGenerated(l.id):
-            ids.sort()
-            _id = ids and ids[-1] or 0
-            new_id = _id + 1
-            return str(new_id)
+            key = fn_normalize(prefix + year)
+
+            def fetch(count):
+                # the counter is seeded from the catalog the first time the
+                # prefix is used, then handed out in constant time
+                seed = lambda: get_catalog_max_id(context, key, separator)
+                counter = get_id_counter(context, key + separator, seed)
+                block = counter.reserve(count)
+                # If sequence_start is greater than new_id. Set
+                # sequence_start as new_id. (Jira LIMS-280)
+                if sequence_start and int(sequence_start) > block[0]:
+                    block = range(int(sequence_start),
+                                  int(sequence_start) + count)
+                    counter.ensure(block[-1])
+                return block
+
+            return str(next_in_sequence(
+                context, prefix, key + separator, fetch))
 
         for d in prefixes:
             if context.portal_type == "Sample":
                 # Special case for Sample IDs
-                prefix = fn_normalize(context.getSampleType().getPrefix())
+                prefix = context.getSampleType().getPrefix()
                 padding = context.bika_setup.getSampleIDPadding()
                 sequence_start = context.bika_setup.getSampleIDSequenceStart()
-                new_id = next_id(prefix+year)
-                # If sequence_start is greater than new_id. Set
-                # sequence_start as new_id. (Jira LIMS-280)
-                if sequence_start > int(new_id):
-                    new_id = str(sequence_start)
+                new_id = next_id(prefix, year, sequence_start)
                 if padding:
                     new_id = new_id.zfill(int(padding))
-                return ('%s%s' + separator + '%s') % (prefix, year, new_id)
+                return ('%s%s' + separator + '%s') % (
+                    fn_normalize(prefix), year, new_id)
             elif d['portal_type'] == context.portal_type:
                 prefix = d['prefix']
                 padding = d['padding']
                 sequence_start = d.get("sequence_start", None)
-                new_id = next_id(prefix+year)
-                # Jira-tracker LIMS-280
-                if sequence_start and int(sequence_start) > int(new_id):
-                    new_id = str(sequence_start)
+                new_id = next_id(prefix, year, sequence_start)
                 if padding:
                     new_id = new_id.zfill(int(padding))
                 return ('%s%s' + separator + '%s') % (prefix, year, new_id)
@@ -189,7 +355,7 @@ def generateUniqueId(context):
         # no year inserted here
         # use "IID" normalizer, because we want portal_type to be lowercased.
         prefix = id_normalize(context.portal_type);
-        new_id = next_id(prefix)
+        new_id = next_id(prefix, '')
         return ('%s' + separator + '%s') % (prefix, new_id)
 
 
@@ -0,0 +1,114 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+""" Load test for id-server.py.
+
+    Starts several parallel clients that request ids from a running ID
+    server, reports the number of ids issued per second and checks that no
+    id has been issued twice.
+"""
+
+import getopt
+import sys
+import threading
+import time
+import urllib2
+
+
+def usage(message=''):
+    if message:
+        message = 'Error: %(error)s\n\n'%{'error': message}
+    print '''%(message)sUsage:
+id-server-loadtest [-u url] [-c clients] [-r requests] [-k keys] [-b batch_size]
+
+  -u: URL of the ID server (default: http://localhost:8081)
+  -c: number of parallel clients (default: 8)
+  -r: number of requests made by each client (default: 500)
+  -k: number of different keys requested (default: 4)
+  -b: batch_size sent with each request (default: none)
+
+'''%locals()
+    sys.exit(0)
+
+
+class Client(threading.Thread):
+
+    def __init__(self, url, requests, keys, batch_size):
+        threading.Thread.__init__(self)
+        self.url = url
+        self.requests = requests
+        self.keys = keys
+        self.batch_size = batch_size
+        self.issued = []
+        self.errors = 0
+
+    def run(self):
+        for i in range(self.requests):
+            key = self.keys[i % len(self.keys)]
+            url = '%s/%s' % (self.url, key)
+            if self.batch_size:
+                url = '%s?batch_size=%s' % (url, self.batch_size)
+            try:
+                f = urllib2.urlopen(url)
+                first = int(f.read())
+                f.close()
+            except Exception:
+                self.errors += 1
+                continue
+            for number in range(first, first + (self.batch_size or 1)):
+                self.issued.append((key, number))
+
+
+def run():
+    url = 'http://localhost:8081'
+    clients = 8
+    requests = 500
+    nr_keys = 4
+    batch_size = None
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], 'u:c:r:k:b:h')
+    except getopt.GetoptError, e:
+        usage(str(e))
+    for (opt, arg) in optlist:
+        if opt == '-u': url = arg.rstrip('/')
+        elif opt == '-c': clients = int(arg)
+        elif opt == '-r': requests = int(arg)
+        elif opt == '-k': nr_keys = int(arg)
+        elif opt == '-b': batch_size = int(arg)
+        elif opt == '-h': usage()
+
+    # use fresh keys, so runs against the same server don't interfere
+    stamp = int(time.time())
+    keys = ['loadtest-%s-%s-' % (stamp, i) for i in range(nr_keys)]
+    threads = [Client(url, requests, keys, batch_size)
+               for i in range(clients)]
+
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    issued = []
+    errors = 0
+    for thread in threads:
+        issued.extend(thread.issued)
+        errors += thread.errors
+    duplicates = len(issued) - len(set(issued))
+    calls = clients * requests - errors
+
+    print 'Clients:       %s' % clients
+    print 'Requests:      %s (%s failed)' % (calls, errors)
+    print 'IDs issued:    %s' % len(issued)
+    print 'Elapsed:       %.2fs' % elapsed
+    print 'Requests/sec:  %.1f' % (calls / elapsed)
+    print 'IDs/sec:       %.1f' % (len(issued) / elapsed)
+    print 'Duplicates:    %s' % duplicates
+    if duplicates or errors:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    run()
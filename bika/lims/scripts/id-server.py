@@ -5,13 +5,110 @@
 
 import os, sys, getopt, cgi
 import BaseHTTPServer
+import SocketServer
+import json
+import threading
 from cPickle import Pickler, Unpickler
 
+# Number of journal entries after which the counters are compacted into the
+# counter file and the journal is truncated
+COMPACT_EVERY = 10000
+
+
+class CounterStore(object):
+    """ Keeps the counters in memory and makes them durable.
+
+        The counter file holds a pickled snapshot of all the counters (the
+        same format used by previous versions of this server). Every change
+        is appended to a journal next to it and fsync'ed before the id is
+        handed out, so no id can be issued twice after a crash. Once the
+        journal reaches 'compact_every' entries, a new snapshot is written
+        and the journal is truncated.
+    """
+
+    def __init__(self, counter_file, compact_every=COMPACT_EVERY):
+        self.counter_file = counter_file
+        self.journal_file = counter_file + '.journal'
+        self.compact_every = compact_every
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.load()
+        self.compact()
+        self.journal = open(self.journal_file, 'a')
+
+    def load(self):
+        """ Reads the last snapshot and replays the journal on top of it
+        """
+        if os.path.exists(self.counter_file):
+            f = open(self.counter_file, 'rb')
+            try:
+                self.counters = Unpickler(f).load()
+            except EOFError:
+                self.counters = {}
+            f.close()
+        if not os.path.exists(self.journal_file):
+            return
+        f = open(self.journal_file, 'r')
+        for line in f:
+            try:
+                key, count = json.loads(line)
+            except ValueError:
+                # incomplete entry written while crashing. It was never
+                # fsync'ed, so the id it stands for was never handed out
+                break
+            self.counters[key] = max(count, self.counters.get(key, 0))
+        f.close()
+
+    def compact(self):
+        """ Writes a snapshot of the counters and truncates the journal.
+            The snapshot is written to a temporary file and renamed, so the
+            counter file is always complete.
+        """
+        tmp = self.counter_file + '.tmp'
+        f = open(tmp, 'wb')
+        Pickler(f).dump(self.counters)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        if os.name == 'nt' and os.path.exists(self.counter_file):
+            os.remove(self.counter_file)
+        os.rename(tmp, self.counter_file)
+        f = open(self.journal_file, 'w')
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        self.entries = 0
+
+    def next(self, key, batch_size=None, count_from=None):
+        """ Reserves the next 'batch_size' numbers for key and returns the
+            first one. If 'count_from' is given and has not been issued yet,
+            counting for key goes on from there.
+        """
+        self.lock.acquire()
+        try:
+            prev_count = self.counters.get(key, 0)
+            if count_from and count_from - 1 > prev_count:
+                prev_count = count_from - 1
+            next_count = prev_count + 1
+            last_count = prev_count + (batch_size or 1)
+            self.journal.write(json.dumps([key, last_count]) + '\n')
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+            self.counters[key] = last_count
+            self.entries += 1
+            if self.entries >= self.compact_every:
+                self.journal.close()
+                self.compact()
+                self.journal = open(self.journal_file, 'a')
+            return next_count
+        finally:
+            self.lock.release()
+
+
 class IDRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
     def run(self):
         try:
-            self.counter_file = os.environ.get('counter')
             self.get_id()
         except:
             self.send_response(400)
@@ -21,87 +118,75 @@ class IDRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     do_GET = run
     # do_POST = run
 
-    def getCounter(self, key):
-        # initialise counter
+    def get_int(self, data, name):
         try:
-            f = open(self.counter_file, 'r+')
-            self._counters = Unpickler(f).load()
-        except:
-            f = open(self.counter_file, 'w+')
-            self._counters = {}
-        f.close()
-        if not self._counters.has_key(key):
-            self._counters[key] = 0
-        return self._counters[key]
-
-    def setCounter(self, key, count):
-        self._counters[key] = count
-        f = open(self.counter_file, 'r+')
-        p = Pickler(f)
-        p.dump(self._counters)
-        f.close()
+            return int(data[name][0])
+        except (KeyError, IndexError, ValueError):
+            return None
 
     def get_id(self):
         batch_size = None
-        command = self.command.lower() 
+        count_from = None
+        command = self.command.lower()
         if command == 'get' and self.path.find('?') != -1:
             key, qs = self.path.split('?', 1)
             data = cgi.parse_qs(qs)
-            try:
-                batch_size = int(data['batch_size'][0])
-            except:
-                batch_size = None
+            batch_size = self.get_int(data, 'batch_size')
+            count_from = self.get_int(data, 'count_from')
         else:
             key = self.path
 
-        # POST (also works .. let's GET for now .. )
-        # elif command == 'post':
-        #     key = self.path
-        #     length = self.headers.getheader('content-length')
-        #     if length:
-        #         length = int(length)
-        #         qs = self.rfile.read(length)
-        #         data = cgi.parse_qs(qs)
-
-        prev_count = self.getCounter(key)
-        next_count = prev_count + 1
-        if batch_size:
-            last_count = prev_count + batch_size
-        else:
-            last_count = next_count 
-        self.setCounter(key, last_count)
+        next_count = self.server.store.next(key, batch_size, count_from)
         self.send_response(200)
         self.send_header('Content-Type', 'text/plain')
         self.end_headers()
         self.wfile.write(str(next_count))
 
+
+class IDServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ HTTP server handling each request in its own thread, so slow clients
+        don't hold the others back. Access to the counters is serialized by
+        the store.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, handler, store):
+        BaseHTTPServer.HTTPServer.__init__(self, address, handler)
+        self.store = store
+
 # Copied and modified roundup-server code - thanks Richard Jones
 
 def usage(message=''):
     if message:
         message = 'Error: %(error)s\n\n'%{'error': message}
     print '''%(message)sUsage:
-id-server [-f counter] [-n hostname] [-p port] [-l file] [-d file]
+id-server [-f counter] [-n hostname] [-p port] [-l file] [-d file] [-c entries]
 
-  -f: counter file
+  -f: counter file. Changes are journaled to <counter>.journal
   -n: sets the host name
   -p: sets the port to listen on
   -l: sets a filename to log to (instead of stdout)
   -d: run the server in the background and on UN*X write the server's PID
       to the nominated file. Note: on Windows the PID argument is needed,
       but ignored.
+  -c: number of journal entries after which the counter file is rewritten
+      and the journal truncated (default: %(compact)s)
 
   Call the ID server with the key for which you want a count as path.
   E.g. calling
     http://<hostname>:<port>/Key
-  repeatedly will return 1, 2, 3, etc. To start counting at a particular
-  number (e.g. to skip a range of numbers), pass 'count_from' as a
-  parameter:
+  repeatedly will return 1, 2, 3, etc. To reserve a block of numbers, pass
+  'batch_size' as a parameter:
+    http://<hostname>:<port>/Key?batch_size=10
+  This will return the first number of the block and skip the other nine.
+  To start counting at a particular number (e.g. to skip a range of
+  numbers), pass 'count_from' as a parameter:
     http://<hostname>:<port>/Key?count_from=104
   This will return 104, or (if 104 has already been issued) the next
   available number.
 
-'''%locals()
+'''%{'message': message, 'compact': COMPACT_EVERY}
     sys.exit(0)
 
 def abspath(path):
@@ -136,9 +221,9 @@ def daemonize(pidfile):
         pidfile = open(pidfile, 'w')
         pidfile.write(str(pid))
         pidfile.close()
-        os._exit(0)         
+        os._exit(0)
 
-    os.chdir("/")         
+    os.chdir("/")
     os.umask(0)
 
     # close off sys.std(in|out|err), redirect to devnull so the file
@@ -162,20 +247,22 @@ def run():
     logfile = None
     user = None
     counter = None
+    compact_every = COMPACT_EVERY
     try:
         # handle the command-line args
         try:
-            optlist, args = getopt.getopt(sys.argv[1:], 'f:n:p:u:d:l:h')
+            optlist, args = getopt.getopt(sys.argv[1:], 'f:n:p:u:d:l:c:h')
         except getopt.GetoptError, e:
             usage(str(e))
 
         for (opt, arg) in optlist:
-            if opt == '-f': counter = arg
+            if opt == '-f': counter = abspath(arg)
             elif opt == '-n': hostname = arg
             elif opt == '-p': port = int(arg)
             elif opt == '-u': user = arg
             elif opt == '-d': pidfile = abspath(arg)
             elif opt == '-l': logfile = abspath(arg)
+            elif opt == '-c': compact_every = int(arg)
             elif opt == '-h': usage()
 
         if hasattr(os, 'getuid'):
@@ -199,8 +286,6 @@ def run():
 
         if counter is None:
             raise ValueError, "You have to specify the location of the counter file."
-        else:
-            os.environ['counter'] = counter
 
     except SystemExit:
         raise
@@ -226,12 +311,16 @@ def run():
         # appending, unbuffered
         sys.stdout = sys.stderr = open(logfile, 'a', 0)
 
-    httpd = BaseHTTPServer.HTTPServer(address, IDRequestHandler)
+    store = CounterStore(counter, compact_every)
+    httpd = IDServer(address, IDRequestHandler, store)
     print 'ID server started on %(address)s'%locals()
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
         print 'Keyboard Interrupt: exiting'
+        store.lock.acquire()
+        store.journal.close()
+        store.compact()
 
 if __name__ == '__main__':
     run()
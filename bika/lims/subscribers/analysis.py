@@ -6,6 +6,8 @@
 from AccessControl import getSecurityManager
 from Acquisition import aq_inner
 from bika.lims import logger
+from bika.lims.analytics import update_analyses_extract
+from bika.lims.interfaces import IAnalysisRequest
 from bika.lims.subscribers import doActionFor
 from bika.lims.subscribers import skip
 from bika.lims.utils import changeWorkflowState
@@ -50,12 +52,26 @@ def ObjectInitializedEventHandler(instance, event):
 
     return
 
+def AfterTransitionEventHandler(instance, event):
+    """ Keeps the progress counts of the Analysis Request and the extract the
+        analyses reports are built from up to date
+    """
+    ar = instance.aq_parent
+    if IAnalysisRequest.providedBy(ar):
+        ar.updateAnalysesNum(instance)
+    if instance.portal_type == 'Analysis':
+        update_analyses_extract(instance)
+
 def ObjectRemovedEventHandler(instance, event):
     # TODO Workflow - Review all this function and normalize
     # May need to promote the AR's review_state
     # if all other analyses are at a higher state than this one was.
     workflow = getToolByName(instance, 'portal_workflow')
     ar = instance.getRequest()
+    if IAnalysisRequest.providedBy(ar):
+        ar.updateAnalysesNum(instance, removed=True)
+    if instance.portal_type == 'Analysis':
+        update_analyses_extract(instance, removed=True)
     can_submit = True
     can_attach = True
     can_verify = True
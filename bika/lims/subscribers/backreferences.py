@@ -0,0 +1,16 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+from bika.lims.backreferences import remove_references
+from bika.lims.browser.fields import IndexedReferenceField
+
+
+def ObjectRemovedEventHandler(instance, event):
+    """ The references of deleted objects are removed from the back
+        references index
+    """
+    for field in instance.Schema().fields():
+        if isinstance(field, IndexedReferenceField):
+            remove_references(instance, field.relationship)
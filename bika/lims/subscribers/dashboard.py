@@ -0,0 +1,21 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+from bika.lims.dashboard_counters import remove_from_evolution_counters
+from bika.lims.dashboard_counters import update_evolution_counters
+
+
+def AfterTransitionEventHandler(instance, event):
+    """ Counts the objects in the dashboard's evolution charts in their new
+        state. Also fired on creation, once the initial state has been set
+    """
+    update_evolution_counters(instance)
+
+
+def ObjectRemovedEventHandler(instance, event):
+    """ Deleted objects are no longer counted in the dashboard's evolution
+        charts
+    """
+    remove_from_evolution_counters(instance)
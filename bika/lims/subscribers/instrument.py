@@ -0,0 +1,26 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+from Acquisition import aq_parent
+from bika.lims.content.instrument import invalidate_instrument_validity
+from bika.lims.interfaces import IInstrument
+
+
+def InstrumentObjectEventHandler(instance, event):
+    """ Certifications, calibrations and validations added, modified or
+        removed change the validity of their instrument
+    """
+    instrument = aq_parent(instance)
+    if IInstrument.providedBy(instrument):
+        invalidate_instrument_validity(instrument)
+
+
+def ReferenceAnalysisTransitionEventHandler(instance, event):
+    """ The results of the internal calibration tests change the validity
+        of their instrument
+    """
+    instrument = instance.getInstrument()
+    if instrument:
+        invalidate_instrument_validity(instrument)
@@ -0,0 +1,13 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+from bika.lims.browser.fields.uidreferencefield import uncache_object
+
+
+def ObjectMovedEventHandler(instance, event):
+    """ Objects moved, renamed or deleted are no longer returned from the
+        objects resolved by UIDReferenceFields during the current request
+    """
+    uncache_object(instance)
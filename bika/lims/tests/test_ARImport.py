@@ -131,6 +131,12 @@ Total price excl Tax,,,,,,,,,,,,,,
         l = len(bc(portal_type='Sample'))
         if l != 4:
             self.fail('4 Samples were not created!  We found %s' % l)
+        # the rows are imported in chunks, and the objects of each recorded
+        if not arimport.isImportComplete():
+            self.fail('Import cursor was not moved past the last row!')
+        l = len(arimport.getImportedObjects())
+        if l != 4:
+            self.fail('4 imported rows were not recorded!  We found %s' % l)
         bac = getToolByName(self.portal, 'bika_analysis_catalog')
         analyses = bac(portal_type='Analysis')
         l = len(analyses)
@@ -0,0 +1,85 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+from bika.lims.analytics import AnalysesExtract
+from bika.lims.analytics import ExtractView
+from bika.lims.analytics import group_by
+from bika.lims.testing import BIKA_FUNCTIONAL_TESTING
+from bika.lims.tests.base import BikaFunctionalTestCase
+
+try:
+    import unittest2 as unittest
+except ImportError: # Python 2.7
+    import unittest
+
+
+class TestAnalysesExtract(BikaFunctionalTestCase):
+    layer = BIKA_FUNCTIONAL_TESTING
+
+    def get_extract(self):
+        extract = AnalysesExtract()
+        extract.append({'uid': 'a', 'keyword': 'Ca', 'service_uid': 's1',
+                        'created': 10.0, 'result': 1.0})
+        extract.append({'uid': 'b', 'keyword': 'Mg', 'service_uid': 's1',
+                        'created': 20.0, 'result': 2.0})
+        extract.append({'uid': 'c', 'keyword': 'Ca', 'service_uid': 's2',
+                        'created': 30.0})
+        return extract
+
+    def test_select(self):
+        extract = self.get_extract()
+        self.assertEqual(extract.select(keyword='Ca'), [0, 2])
+        self.assertEqual(extract.select(created=(15, None)), [1, 2])
+        self.assertEqual(
+            extract.select(keyword=['Ca', 'Mg'], created=(None, 25)), [0, 1])
+        # Missing numbers are NaN, never in range
+        self.assertEqual(extract.select(result=(None, None)), [0, 1])
+        counts = group_by(extract.values('service_uid', extract.select()))
+        self.assertEqual(counts, {'s1': 2, 's2': 1})
+
+    def test_merge(self):
+        extract = self.get_extract()
+        merged = extract.merge({'a': None,
+                                'b': {'uid': 'b', 'keyword': 'Zn'}})
+        self.assertEqual(merged.uids, ['c', 'b'])
+        self.assertEqual(merged.column('keyword'), ['Ca', 'Zn'])
+        self.assertEqual(merged.select(keyword='Mg'), [])
+        # The extract merged into is left untouched
+        self.assertEqual(extract.column('keyword'), ['Ca', 'Mg', 'Ca'])
+
+    def test_view(self):
+        extract = self.get_extract()
+        view = ExtractView(extract, {'a': None,
+                                     'b': {'uid': 'b', 'keyword': 'Zn',
+                                           'created': 40.0}})
+        self.assertEqual(len(view), 2)
+        self.assertEqual(view.column('keyword'), ['Ca', 'Zn'])
+        self.assertEqual(view.select(keyword='Mg'), [])
+        positions = view.select(created=(25, None))
+        self.assertEqual(positions, [2, 3])
+        self.assertEqual(view.values('uid', positions), ['c', 'b'])
+        self.assertEqual(view.rows([3], ['keyword', 'service_uid']),
+                         [{'keyword': 'Zn', 'service_uid': ''}])
+        self.assertEqual(view.select(result=(None, None)), [])
+
+    def test_durations(self):
+        extract = AnalysesExtract()
+        extract.append({'uid': 'a', 'date_started': 600.0,
+                        'date_verified': 1800.0})
+        extract.append({'uid': 'b', 'date_started': 600.0})
+        extract.append({'uid': 'c'})
+        # Analyses not verified yet take up to now
+        self.assertEqual(extract.durations([0, 1, 2], now=3000.0),
+                         [20.0, 40.0, 0])
+        view = ExtractView(extract, {'c': {'uid': 'c', 'date_started': 0.0}})
+        self.assertEqual(view.durations(view.select(), now=3000.0),
+                         [20.0, 40.0, 50.0])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestAnalysesExtract))
+    suite.layer = BIKA_FUNCTIONAL_TESTING
+    return suite
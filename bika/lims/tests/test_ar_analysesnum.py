@@ -0,0 +1,64 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+from Products.CMFCore.utils import getToolByName
+from bika.lims.testing import BIKA_FUNCTIONAL_TESTING
+from bika.lims.tests.base import BikaFunctionalTestCase
+from bika.lims.utils.analysisrequest import create_analysisrequest
+from plone.app.testing import login, logout
+from plone.app.testing import TEST_USER_NAME
+
+try:
+    import unittest2 as unittest
+except ImportError: # Python 2.7
+    import unittest
+
+
+class TestAnalysesNum(BikaFunctionalTestCase):
+    layer = BIKA_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        super(TestAnalysesNum, self).setUp()
+        login(self.portal, TEST_USER_NAME)
+
+    def tearDown(self):
+        logout()
+        super(TestAnalysesNum, self).tearDown()
+
+    def test_counts_follow_transitions(self):
+        catalog = getToolByName(self.portal, 'portal_catalog')
+        client = self.portal.clients['client-1']
+        sampletype = self.portal.bika_setup.bika_sampletypes['sampletype-1']
+        values = {'Client': client.UID(),
+                  'Contact': client.getContacts()[0].UID(),
+                  'SamplingDate': '2015-01-01',
+                  'SampleType': sampletype.UID()}
+        services = catalog(portal_type='AnalysisService',
+                           inactive_state='active')[:3]
+        service_uids = [service.getObject().UID() for service in services]
+        ar = create_analysisrequest(client, {}, values, service_uids)
+        wf = getToolByName(ar, 'portal_workflow')
+        wf.doActionFor(ar, 'receive')
+        self.assertEqual(ar.getAnalysesNum(), [0, 3, 3, 0])
+
+        analysis = ar.getAnalyses(full_objects=True)[0]
+        analysis.setResult('12')
+        wf.doActionFor(analysis, 'submit')
+        self.assertEqual(ar.getAnalysesNum(), [0, 3, 2, 1])
+
+        # The retest is pending and the retracted analysis is not counted
+        wf.doActionFor(analysis, 'retract')
+        self.assertEqual(ar.getAnalysesNum(), [0, 3, 3, 0])
+
+        # The counts built from the catalog match the incremental ones
+        ar.rebuildAnalysesNum()
+        self.assertEqual(ar.getAnalysesNum(), [0, 3, 3, 0])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestAnalysesNum))
+    suite.layer = BIKA_FUNCTIONAL_TESTING
+    return suite
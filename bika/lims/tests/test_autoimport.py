@@ -0,0 +1,86 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+from bika.lims.browser.resultsimport.resultsimport import get_changed_files
+from bika.lims.browser.resultsimport.resultsimport import get_import_ledger
+from bika.lims.browser.resultsimport.resultsimport import seed_import_ledger
+from bika.lims.testing import BIKA_FUNCTIONAL_TESTING
+from bika.lims.tests.base import BikaFunctionalTestCase
+from plone.app.testing import login, logout
+from plone.app.testing import TEST_USER_NAME
+import os
+import shutil
+import tempfile
+
+try:
+    import unittest2 as unittest
+except ImportError: # Python 2.7
+    import unittest
+
+
+class TestAutoImportLedger(BikaFunctionalTestCase):
+    layer = BIKA_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        super(TestAutoImportLedger, self).setUp()
+        login(self.portal, TEST_USER_NAME)
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+        logout()
+        super(TestAutoImportLedger, self).tearDown()
+
+    def write(self, name, data, mtime=None):
+        path = os.path.join(self.folder, name)
+        with open(path, 'w') as f:
+            f.write(data)
+        if mtime:
+            os.utime(path, (mtime, mtime))
+
+    def changed(self, ledger, since=None):
+        changed, newest = get_changed_files(ledger, self.folder, since)
+        return [name for name, entry in changed]
+
+    def test_changed_files(self):
+        ledger = get_import_ledger(self.portal, self.folder)
+        self.write('imported.csv', 'imported.csv\nlogs.log\nold.csv\n')
+        self.write('old.csv', 'old')
+        self.write('new.csv', 'new')
+        seed_import_ledger(ledger, self.folder)
+        self.assertEqual(list(ledger.keys()), ['old.csv'])
+        changed, newest = get_changed_files(ledger, self.folder)
+        self.assertEqual([name for name, entry in changed], ['new.csv'])
+        for name, entry in changed:
+            ledger[name] = entry
+        self.assertEqual(self.changed(ledger), [])
+        # Touched without changing the contents
+        self.write('new.csv', 'new', mtime=1000000000)
+        self.assertEqual(self.changed(ledger), [])
+        self.assertEqual(ledger['new.csv'][1], 1000000000)
+        # Modified after the import
+        self.write('old.csv', 'modified')
+        self.assertEqual(self.changed(ledger), ['old.csv'])
+
+    def test_changed_files_since(self):
+        ledger = get_import_ledger(self.portal, self.folder)
+        self.write('a.csv', 'a', mtime=1000000000)
+        self.write('b.csv', 'b', mtime=1000000100)
+        changed, newest = get_changed_files(ledger, self.folder)
+        self.assertEqual(newest, 1000000100)
+        # Files modified before the newest file seen are skipped
+        self.assertEqual(self.changed(ledger, since=newest), ['b.csv'])
+        self.write('c.csv', 'c', mtime=1000000200)
+        self.assertEqual(self.changed(ledger, since=newest),
+                         ['b.csv', 'c.csv'])
+        # Unless the folder is scanned again in full
+        self.assertEqual(self.changed(ledger), ['a.csv', 'b.csv', 'c.csv'])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestAutoImportLedger))
+    suite.layer = BIKA_FUNCTIONAL_TESTING
+    return suite
@@ -0,0 +1,60 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+from bika.lims.backreferences import get_backreference_uids
+from bika.lims.backreferences import rebuild_references
+from bika.lims.testing import BIKA_FUNCTIONAL_TESTING
+from bika.lims.tests.base import BikaFunctionalTestCase
+from bika.lims.utils import tmpID
+from plone.app.testing import login, logout
+from plone.app.testing import TEST_USER_NAME
+from Products.CMFPlone.utils import _createObjectByType
+
+try:
+    import unittest2 as unittest
+except ImportError: # Python 2.7
+    import unittest
+
+
+class TestBackReferences(BikaFunctionalTestCase):
+    layer = BIKA_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        super(TestBackReferences, self).setUp()
+        login(self.portal, TEST_USER_NAME)
+
+    def tearDown(self):
+        logout()
+        super(TestBackReferences, self).tearDown()
+
+    def addthing(self, folder, portal_type):
+        thing = _createObjectByType(portal_type, folder, tmpID())
+        thing.processForm()
+        return thing
+
+    def test_worksheet_analyses_index(self):
+        ws = self.addthing(self.portal.worksheets, 'Worksheet')
+        target = self.addthing(self.portal.batches, 'Batch')
+        relationship = 'WorksheetAnalysis'
+        self.assertEqual(get_backreference_uids(target, relationship), [])
+        ws.setAnalyses([target])
+        self.assertEqual(get_backreference_uids(target, relationship),
+                         [ws.UID()])
+        # The index built from reference_catalog matches the incremental one
+        rebuild_references(self.portal, relationship)
+        self.assertEqual(get_backreference_uids(target, relationship),
+                         [ws.UID()])
+        ws.setAnalyses([])
+        self.assertEqual(get_backreference_uids(target, relationship), [])
+        ws.setAnalyses([target.UID()])
+        self.portal.worksheets.manage_delObjects([ws.getId()])
+        self.assertEqual(get_backreference_uids(target, relationship), [])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestBackReferences))
+    suite.layer = BIKA_FUNCTIONAL_TESTING
+    return suite
@@ -0,0 +1,144 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+from bika.lims.browser.bika_listing import BikaListingView
+from bika.lims.browser.bika_listing import decode_cursor
+from bika.lims.browser.bika_listing import encode_cursor
+from bika.lims.testing import BIKA_FUNCTIONAL_TESTING
+from bika.lims.tests.base import BikaFunctionalTestCase
+from bika.lims.utils import tmpID
+from plone.app.testing import login, logout
+from plone.app.testing import TEST_USER_NAME
+from Products.CMFCore.utils import getToolByName
+from Products.CMFPlone.utils import _createObjectByType
+import base64
+import json
+
+try:
+    import unittest2 as unittest
+except ImportError: # Python 2.7
+    import unittest
+
+
+class TestBikaListingCursor(BikaFunctionalTestCase):
+    layer = BIKA_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        super(TestBikaListingCursor, self).setUp()
+        login(self.portal, TEST_USER_NAME)
+        self.folder = self.portal.bika_setup.bika_analysiscategories
+        # Four categories share the sort value, more than a page
+        self.uids = []
+        for title in ['Alpha', 'Beta', 'Beta', 'Beta', 'Beta', 'Gamma']:
+            category = _createObjectByType('AnalysisCategory', self.folder,
+                                           tmpID())
+            category.unmarkCreationFlag()
+            category.edit(title=title)
+            category._renameAfterCreation()
+            category.reindexObject()
+            self.uids.append(category.UID())
+
+    def tearDown(self):
+        logout()
+        super(TestBikaListingCursor, self).tearDown()
+
+    def listing(self, sort_order='ascending'):
+        view = BikaListingView(self.folder, self.request)
+        view.catalog = 'bika_setup_catalog'
+        view.contentsMethod = getToolByName(self.portal, view.catalog)
+        view.contentFilter = {'portal_type': 'AnalysisCategory',
+                              'UID': self.uids,
+                              'sort_on': 'sortable_title',
+                              'sort_order': sort_order}
+        view.pagesize = 2
+        return view
+
+    def walk(self, view):
+        """Returns the titles and UIDs displayed on each page, fetching the
+        next pages with the cursor of the last item displayed
+        """
+        index = view.get_cursor_index()
+        pages = []
+        cursor = None
+        while len(pages) < 10:
+            if cursor:
+                brains = view._fetch_brains(cursor=cursor, limit=True)
+            else:
+                brains = view._fetch_brains(limit=True)
+            page = brains[:view.pagesize]
+            if not page:
+                break
+            pages.append([(brain.Title, brain.UID) for brain in page])
+            if not view._truncated and len(brains) <= view.pagesize:
+                break
+            cursor = decode_cursor(view._get_next_cursor(index, page, cursor))
+        return pages
+
+    def test_cursor_round_trip(self):
+        for value in ['beta', u'b\xe9ta', 42, 1458121530.5]:
+            token = encode_cursor(value, 'uid', 3)
+            self.assertEqual(decode_cursor(token), (value, 'uid', 3))
+            # The token can be passed in a url as it is
+            self.assertEqual(token, base64.urlsafe_b64encode(
+                base64.urlsafe_b64decode(token)))
+
+    def test_invalid_cursor(self):
+        def token(*values):
+            return base64.urlsafe_b64encode(json.dumps(values))
+        self.assertEqual(decode_cursor(None), None)
+        self.assertEqual(decode_cursor(''), None)
+        self.assertEqual(decode_cursor('not a cursor'), None)
+        self.assertEqual(decode_cursor(u'\xe9'), None)
+        # Truncated
+        self.assertEqual(decode_cursor(token('beta', 'uid', 2)[:-2]), None)
+        # Tampered
+        self.assertEqual(decode_cursor(token('beta', 'uid')), None)
+        self.assertEqual(decode_cursor(token('beta', 'uid', 'x')), None)
+        self.assertEqual(decode_cursor(token('beta', 'uid', -1)), None)
+        self.assertEqual(decode_cursor(token('beta', None, 2)), None)
+        self.assertEqual(
+            decode_cursor(token({'query': 'beta'}, 'uid', 2)), None)
+        self.assertEqual(decode_cursor(token(['beta'], 'uid', 2)), None)
+
+    def test_cursor_index(self):
+        view = self.listing()
+        self.assertEqual(view.get_cursor_index().getId(), 'sortable_title')
+        view.show_all = True
+        self.assertEqual(view.get_cursor_index(), None)
+        view = self.listing()
+        view.contentFilter['sort_on'] = 'Title'
+        self.assertEqual(view.get_cursor_index(), None)
+
+    def test_pages_with_ties(self):
+        for sort_order in ['ascending', 'reverse']:
+            view = self.listing(sort_order)
+            pages = self.walk(view)
+            self.assertEqual([len(page) for page in pages], [2, 2, 2])
+            titles = [title for page in pages for title, uid in page]
+            expected = ['Alpha', 'Beta', 'Beta', 'Beta', 'Beta', 'Gamma']
+            if sort_order == 'reverse':
+                expected.reverse()
+            self.assertEqual(titles, expected)
+            # No item skipped or displayed twice
+            uids = [uid for page in pages for title, uid in page]
+            self.assertEqual(len(set(uids)), 6)
+
+    def test_cursor_item_removed(self):
+        view = self.listing()
+        brains = view.contentsMethod(UID=self.uids, sort_on='sortable_title')
+        value = brains[1].sortable_title
+        # The last item displayed is gone: the items sharing its sort value
+        # already displayed are skipped by their number
+        cursor = decode_cursor(encode_cursor(value, 'removed', 1))
+        brains = view._fetch_brains(cursor=cursor, limit=True)
+        self.assertEqual([brain.Title for brain in brains],
+                         ['Beta', 'Beta', 'Beta'])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestBikaListingCursor))
+    suite.layer = BIKA_FUNCTIONAL_TESTING
+    return suite
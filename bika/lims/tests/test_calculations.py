@@ -7,6 +7,7 @@ from bika.lims import logger
 from bika.lims.content.analysis import Analysis
 from bika.lims.testing import BIKA_FUNCTIONAL_TESTING
 from bika.lims.tests.base import BikaFunctionalTestCase
+from bika.lims.utils.analysis import RecalculationPass
 from bika.lims.utils.analysisrequest import create_analysisrequest
 from bika.lims.workflow import doActionFor
 from plone.app.testing import login, logout
@@ -506,6 +507,64 @@ class TestCalculations(BikaFunctionalTestCase):
                 calcanalysis.calculateResult(True, True)
                 self.assertEqual(calcanalysis.getFormattedResult(), case['expected_result'])
 
+    def test_compiled_formula(self):
+        self.calculation.setFormula('[Ca] + [Mg.LDL] * 2')
+        mapping = {'Ca': 10, 'Mg.LDL': 2.5}
+        self.assertEqual(self.calculation.evaluateFormula(mapping), 15.0)
+        # The formula is compiled once and reused
+        code = self.calculation.getCompiledFormula()
+        self.assertIs(self.calculation.getCompiledFormula(), code)
+        self.assertRaises(KeyError, self.calculation.evaluateFormula, {})
+        mapping['Ca'] = 'NA'
+        self.assertRaises(TypeError, self.calculation.evaluateFormula, mapping)
+        # Changing the formula discards the compiled one
+        self.calculation.setFormula('[Ca] / [Mg]')
+        self.assertIsNot(self.calculation.getCompiledFormula(), code)
+        self.assertRaises(ZeroDivisionError,
+                          self.calculation.evaluateFormula, {'Ca': 1, 'Mg': 0})
+
+    def test_recalculation_pass(self):
+        self.calculation.setFormula('[Ca] + [Mg]')
+        client = self.portal.clients['client-1']
+        sampletype = self.portal.bika_setup.bika_sampletypes['sampletype-1']
+        values = {'Client': client.UID(),
+                  'Contact': client.getContacts()[0].UID(),
+                  'SamplingDate': '2015-01-01',
+                  'SampleType': sampletype.UID()}
+        services = [s.UID() for s in self.services] + [self.calcservice.UID()]
+        ar = create_analysisrequest(client, {}, values, services)
+        wf = getToolByName(ar, 'portal_workflow')
+        wf.doActionFor(ar, 'receive')
+        analyses = dict([(an.getKeyword(), an) for an in
+                         ar.getAnalyses(full_objects=True)])
+        calcanalysis = analyses[self.calcservice.getKeyword()]
+        analyses['Ca'].setResult('12')
+        analyses['Mg'].setResult('15')
+
+        recalculation = RecalculationPass([analyses['Ca'], analyses['Mg']])
+        self.assertEqual(
+            sorted([an.getKeyword() for an in
+                    recalculation.getDependencies(calcanalysis)]),
+            ['Ca', 'Mg'])
+        self.assertEqual(recalculation.calculate(), [calcanalysis])
+        self.assertEqual(float(calcanalysis.getResult()), 27.0)
+
+        # Existing results are only replaced when overriding
+        analyses['Ca'].setResult('10')
+        recalculation = RecalculationPass([analyses['Ca']])
+        self.assertEqual(recalculation.calculate(), [])
+        self.assertEqual(recalculation.calculate(override=True),
+                         [calcanalysis])
+        self.assertEqual(float(calcanalysis.getResult()), 25.0)
+
+        # Results kept (e.g. imported) are never calculated
+        calcanalysis.setResult('100')
+        recalculation = RecalculationPass([analyses['Ca'], calcanalysis])
+        self.assertEqual(recalculation.calculate(
+            override=True, keep=[calcanalysis.UID()]), [])
+        self.assertEqual(float(calcanalysis.getResult()), 100.0)
+
+
 def test_suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(TestCalculations))
@@ -0,0 +1,53 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+from bika.lims.catalog import CATALOG_WORKSHEET_LISTING
+from bika.lims.catalog import getCatalogDefinitions
+from bika.lims.catalog import setup_catalogs
+from bika.lims.testing import BIKA_FUNCTIONAL_TESTING
+from bika.lims.tests.base import BikaFunctionalTestCase
+from bika.lims.utils import tmpID
+from plone.app.testing import login, logout
+from plone.app.testing import TEST_USER_NAME
+from Products.CMFPlone.utils import _createObjectByType
+
+try:
+    import unittest2 as unittest
+except ImportError: # Python 2.7
+    import unittest
+
+
+class TestCatalogBackfill(BikaFunctionalTestCase):
+    layer = BIKA_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        super(TestCatalogBackfill, self).setUp()
+        login(self.portal, TEST_USER_NAME)
+
+    def tearDown(self):
+        logout()
+        super(TestCatalogBackfill, self).tearDown()
+
+    def test_backfill_new_index_and_column(self):
+        ws = _createObjectByType("Worksheet", self.portal.worksheets, tmpID())
+        ws.processForm()
+        catalog = self.portal[CATALOG_WORKSHEET_LISTING]
+        catalog.delIndex('review_state')
+        catalog.delColumn('getNumberOfRegularAnalyses')
+
+        rebuilt = setup_catalogs(
+            self.portal, getCatalogDefinitions(), backfill=True)
+
+        self.assertNotIn(CATALOG_WORKSHEET_LISTING, rebuilt)
+        brains = catalog(UID=ws.UID(), review_state='open')
+        self.assertEqual(len(brains), 1)
+        self.assertEqual(brains[0].getNumberOfRegularAnalyses, 0)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestCatalogBackfill))
+    suite.layer = BIKA_FUNCTIONAL_TESTING
+    return suite
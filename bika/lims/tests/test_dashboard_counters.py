@@ -0,0 +1,57 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+from bika.lims.dashboard_counters import get_evolution_counts
+from bika.lims.dashboard_counters import rebuild_evolution_counters
+from bika.lims.testing import BIKA_FUNCTIONAL_TESTING
+from bika.lims.tests.base import BikaFunctionalTestCase
+from bika.lims.utils import tmpID
+from DateTime import DateTime
+from plone.app.testing import login, logout
+from plone.app.testing import TEST_USER_NAME
+from Products.CMFPlone.utils import _createObjectByType
+import datetime
+
+try:
+    import unittest2 as unittest
+except ImportError: # Python 2.7
+    import unittest
+
+
+class TestDashboardCounters(BikaFunctionalTestCase):
+    layer = BIKA_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        super(TestDashboardCounters, self).setUp()
+        login(self.portal, TEST_USER_NAME)
+
+    def tearDown(self):
+        logout()
+        super(TestDashboardCounters, self).tearDown()
+
+    def count_open_worksheets(self):
+        today = DateTime()
+        counts = get_evolution_counts(
+            self.portal, 'Worksheet', today - 1, today + 1)
+        return counts.get((datetime.date.today(), 'open'), 0)
+
+    def test_worksheet_counters(self):
+        before = self.count_open_worksheets()
+        wsfolder = self.portal.worksheets
+        ws = _createObjectByType("Worksheet", wsfolder, tmpID())
+        ws.processForm()
+        self.assertEqual(self.count_open_worksheets(), before + 1)
+        # The counters built from the catalogs match the incremental ones
+        rebuild_evolution_counters(self.portal)
+        self.assertEqual(self.count_open_worksheets(), before + 1)
+        wsfolder.manage_delObjects([ws.getId()])
+        self.assertEqual(self.count_open_worksheets(), before)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestDashboardCounters))
+    suite.layer = BIKA_FUNCTIONAL_TESTING
+    return suite
@@ -0,0 +1,98 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+from bika.lims.idserver import get_id_counter
+from bika.lims.idserver import get_id_storage
+from bika.lims.idserver import IDCounter
+from bika.lims.idserver import reserve_ids
+from bika.lims.testing import BIKA_FUNCTIONAL_TESTING
+from bika.lims.tests.base import BikaFunctionalTestCase
+from bika.lims.utils import tmpID
+from plone.app.testing import login, logout
+from plone.app.testing import TEST_USER_NAME
+from Products.CMFPlone.utils import _createObjectByType
+
+try:
+    import unittest2 as unittest
+except ImportError: # Python 2.7
+    import unittest
+
+
+class TestIDServer(BikaFunctionalTestCase):
+    layer = BIKA_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        super(TestIDServer, self).setUp()
+        login(self.portal, TEST_USER_NAME)
+
+    def tearDown(self):
+        logout()
+        super(TestIDServer, self).tearDown()
+
+    def addthing(self, folder, portal_type, **kwargs):
+        thing = _createObjectByType(portal_type, folder, tmpID())
+        thing.unmarkCreationFlag()
+        thing.edit(**kwargs)
+        thing._renameAfterCreation()
+        return thing
+
+    def test_counter_reserve(self):
+        counter = IDCounter(5)
+        self.assertEqual(counter.increment(), 6)
+        self.assertEqual(counter.reserve(3), [7, 8, 9])
+        self.assertEqual(counter.value, 9)
+        counter.ensure(4)
+        self.assertEqual(counter.value, 9)
+        counter.ensure(20)
+        self.assertEqual(counter.increment(), 21)
+        self.assertRaises(ValueError, counter.reserve, 0)
+
+    def test_counter_is_seeded_once(self):
+        calls = []
+
+        def seed():
+            calls.append(1)
+            return 41
+
+        counter = get_id_counter(self.portal, 'seeded-', seed)
+        self.assertEqual(counter.increment(), 42)
+        counter = get_id_counter(self.portal, 'seeded-', seed)
+        self.assertEqual(counter.increment(), 43)
+        self.assertEqual(len(calls), 1)
+
+    def test_batch_ids_use_counter(self):
+        batches = self.portal.batches
+        first = self.addthing(batches, 'Batch', title='First')
+        second = self.addthing(batches, 'Batch', title='Second')
+        prefix, number = first.getId().rsplit('-', 1)
+        self.assertEqual(second.getId(), '%s-%s' % (prefix, int(number) + 1))
+        storage = get_id_storage(self.portal)
+        self.assertEqual(storage[prefix + '-'].value, int(number) + 1)
+
+    def test_reserve_ids(self):
+        batches = self.portal.batches
+        first = self.addthing(batches, 'Batch', title='First')
+        prefix, number = first.getId().rsplit('-', 1)
+        number = int(number)
+        counter = get_id_storage(self.portal)[prefix + '-']
+        reserve_ids(self.portal, 'Batch', 3)
+        second = self.addthing(batches, 'Batch', title='Second')
+        # The whole block has been reserved with the first id
+        self.assertEqual(counter.value, number + 3)
+        third = self.addthing(batches, 'Batch', title='Third')
+        fourth = self.addthing(batches, 'Batch', title='Fourth')
+        self.assertEqual([second.getId(), third.getId(), fourth.getId()],
+                         ['%s-%s' % (prefix, number + i) for i in (1, 2, 3)])
+        # Once the block is consumed, ids are generated one by one again
+        fifth = self.addthing(batches, 'Batch', title='Fifth')
+        self.assertEqual(fifth.getId(), '%s-%s' % (prefix, number + 4))
+        self.assertEqual(counter.value, number + 4)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestIDServer))
+    suite.layer = BIKA_FUNCTIONAL_TESTING
+    return suite
@@ -0,0 +1,103 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+from bika.lims.browser.reports import REPORT_CONCURRENCY
+from bika.lims.browser.reports import REPORT_TASK_QUEUE
+from bika.lims.browser.reports import RenderReportView
+from bika.lims.browser.reports import count_running_reports
+from bika.lims.browser.reports import find_queued_reports
+from bika.lims.browser.reports import resume_deferred_report
+from bika.lims.testing import BIKA_FUNCTIONAL_TESTING
+from bika.lims.tests.base import BikaFunctionalTestCase
+from collective.taskqueue.interfaces import ITaskQueue
+from collective.taskqueue.taskqueue import LocalVolatileTaskQueue
+from DateTime import DateTime
+from plone.app.testing import login, logout
+from plone.app.testing import TEST_USER_NAME
+from Products.CMFPlone.utils import _createObjectByType
+from zope.component import getGlobalSiteManager
+import json
+import transaction
+
+try:
+    import unittest2 as unittest
+except ImportError: # Python 2.7
+    import unittest
+
+
+class TestReportQueue(BikaFunctionalTestCase):
+    layer = BIKA_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        super(TestReportQueue, self).setUp()
+        login(self.portal, TEST_USER_NAME)
+        self.reports = self.portal.reports
+
+    def tearDown(self):
+        logout()
+        super(TestReportQueue, self).tearDown()
+
+    def add_report(self, status, parameters_hash='hash', age=0):
+        reportid = self.reports.generateUniqueId('Report')
+        report = _createObjectByType("Report", self.reports, reportid)
+        report.processForm()
+        report.edit(RenderStatus=status, ParametersHash=parameters_hash)
+        report.reindexObject()
+        if age:
+            report.setModificationDate(DateTime() - age / 86400.0)
+        return report
+
+    def test_identical_reports(self):
+        self.assertEqual(find_queued_reports(self.reports, 'hash'), [])
+        self.add_report('done')
+        self.assertEqual(find_queued_reports(self.reports, 'hash'), [])
+        report = self.add_report('pending')
+        self.add_report('pending', parameters_hash='other')
+        brains = find_queued_reports(self.reports, 'hash')
+        self.assertEqual([brain.UID for brain in brains], [report.UID()])
+
+    def test_abandoned_reports(self):
+        # Reports whose job or worker is gone don't hold identical requests
+        self.add_report('pending', age=7200)
+        self.add_report('running', age=7200)
+        self.assertEqual(find_queued_reports(self.reports, 'hash'), [])
+        self.assertEqual(count_running_reports(self.reports), 0)
+        self.add_report('running')
+        self.assertEqual(count_running_reports(self.reports), 1)
+        self.assertEqual(len(find_queued_reports(self.reports, 'hash')), 1)
+
+    def test_concurrency_limit(self):
+        for num in range(REPORT_CONCURRENCY):
+            self.add_report('running', parameters_hash=str(num))
+        report = self.add_report('pending')
+        self.request.form['uid'] = report.UID()
+        view = RenderReportView(self.reports, self.request)
+        self.assertEqual(json.loads(view()),
+                         {'success': False, 'deferred': True})
+        self.assertEqual(report.getRenderStatus(), 'deferred')
+        # Still found for identical requests
+        self.assertEqual(len(find_queued_reports(self.reports, 'hash')), 1)
+
+        # Queued again once another report is done
+        task_queue = LocalVolatileTaskQueue()
+        gsm = getGlobalSiteManager()
+        gsm.registerUtility(task_queue, ITaskQueue, name=REPORT_TASK_QUEUE)
+        try:
+            self.assertEqual(resume_deferred_report(self.reports), report)
+            self.assertEqual(resume_deferred_report(self.reports), None)
+            # The jobs are queued once the transaction is committed
+            transaction.commit()
+        finally:
+            gsm.unregisterUtility(task_queue, ITaskQueue,
+                                  name=REPORT_TASK_QUEUE)
+        self.assertEqual(report.getRenderStatus(), 'pending')
+        self.assertEqual(len(task_queue), 1)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestReportQueue))
+    suite.layer = BIKA_FUNCTIONAL_TESTING
+    return suite
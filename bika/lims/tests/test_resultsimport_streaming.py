@@ -0,0 +1,142 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+from BTrees.OOBTree import OOBTree
+from bika.lims.browser.resultsimport.resultsimport import GeneralImporter
+from bika.lims.exportimport.instruments.resultsimport import \
+    InstrumentCSVResultsFileParser
+from bika.lims.testing import BIKA_FUNCTIONAL_TESTING
+from bika.lims.tests.base import BikaFunctionalTestCase
+from plone.app.testing import login, logout
+from plone.app.testing import TEST_USER_NAME
+import StringIO
+
+try:
+    import unittest2 as unittest
+except ImportError: # Python 2.7
+    import unittest
+
+
+class LineParser(InstrumentCSVResultsFileParser):
+    """ One result per line: objid, keyword, result
+    """
+
+    def _parseline(self, line):
+        objid, keyword, result = self.splitLine(line)
+        self._addRawResult(objid, {keyword: {'DefaultResult': 'Result',
+                                             'Result': result}})
+        return 0
+
+
+class ChunkRecorder(GeneralImporter):
+    """ Records the chunks processed instead of importing them
+    """
+
+    def _processChunk(self, records):
+        self._chunks += 1
+        self.chunks.append([objid for objid, results in records])
+        if self.commit_chunks:
+            self.checkpoint(self._records)
+
+
+def results_file(objids):
+    infile = StringIO.StringIO(
+        "\n".join(["%s,Ca,%s" % (objid, num)
+                   for num, objid in enumerate(objids)]))
+    infile.filename = 'results.csv'
+    return infile
+
+
+class TestResultsImportStreaming(BikaFunctionalTestCase):
+    layer = BIKA_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        super(TestResultsImportStreaming, self).setUp()
+        login(self.portal, TEST_USER_NAME)
+
+    def tearDown(self):
+        logout()
+        super(TestResultsImportStreaming, self).tearDown()
+
+    def importer(self, objids, progress, file_hash='hash'):
+        parser = LineParser(results_file(objids))
+        importer = ChunkRecorder(parser, self.portal, ['getId'],
+                                 [False, False], progress=progress,
+                                 file_name='results.csv', file_hash=file_hash)
+        importer.chunk_size = 2
+        importer.chunks = []
+        return importer
+
+    def test_parse_records_chunked(self):
+        objids = ['a', 'b', 'c', 'd', 'e', 'f', 'a']
+        parser = LineParser(results_file(objids))
+        records = []
+        kept = 0
+        for objid, results in parser.parseRecords(2):
+            records.append((objid, len(results)))
+            kept = max(kept, len(parser.getRawResults()))
+        # Only the results of about twice chunk_size objects are kept
+        self.assertTrue(kept <= 5)
+        # 'a' is yielded again with the results read after it was flushed
+        self.assertEqual(records, [('a', 1), ('b', 1), ('c', 1), ('d', 1),
+                                   ('e', 1), ('f', 1), ('a', 1)])
+        self.assertEqual(parser.getObjectsTotalCount(), 6)
+        self.assertEqual(parser.getResultsTotalCount(), 7)
+        self.assertEqual(parser.getAnalysisKeywords(), ['Ca'])
+        self.assertTrue(parser.resume())
+
+    def test_parse_records_whole_file(self):
+        objids = ['a', 'b', 'c', 'd', 'e', 'f', 'a']
+        parser = LineParser(results_file(objids))
+        records = [(objid, len(results))
+                   for objid, results in parser.parseRecords()]
+        self.assertEqual(records, [('b', 1), ('c', 1), ('d', 1), ('e', 1),
+                                   ('f', 1), ('a', 2)])
+        self.assertEqual(parser.getObjectsTotalCount(), 6)
+
+    def test_parse_records_empty_file(self):
+        parser = LineParser(results_file([]))
+        self.assertEqual(list(parser.parseRecords(2)), [])
+        self.assertFalse(parser.resume())
+
+    def test_checkpoint(self):
+        progress = OOBTree()
+        importer = self.importer(['a', 'b', 'c', 'd', 'e'], progress)
+        importer.process()
+        self.assertEqual(importer.chunks, [['a', 'b'], ['c', 'd'], ['e']])
+        self.assertEqual(progress['results.csv'], ('hash', 5))
+
+    def test_resume_after_checkpoint(self):
+        progress = OOBTree()
+        progress['results.csv'] = ('hash', 2)
+        importer = self.importer(['a', 'b', 'c', 'd', 'e'], progress)
+        self.assertEqual(importer.skip_records, 2)
+        importer.process()
+        self.assertEqual(importer.chunks, [['c', 'd'], ['e']])
+        self.assertEqual(progress['results.csv'], ('hash', 5))
+
+        # Nothing left to import once the whole file has been imported
+        importer = self.importer(['a', 'b', 'c', 'd', 'e'], progress)
+        importer.process()
+        self.assertEqual(importer.chunks, [])
+        self.assertEqual(importer.errors, [])
+
+    def test_resume_changed_file(self):
+        # The records imported from a file that has changed since are ignored
+        progress = OOBTree()
+        progress['results.csv'] = ('hash', 2)
+        importer = self.importer(['a', 'b', 'c'], progress,
+                                 file_hash='other')
+        self.assertEqual(importer.skip_records, 0)
+        importer.process()
+        self.assertEqual(importer.chunks, [['a', 'b'], ['c']])
+        self.assertEqual(progress['results.csv'], ('other', 3))
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestResultsImportStreaming))
+    suite.layer = BIKA_FUNCTIONAL_TESTING
+    return suite
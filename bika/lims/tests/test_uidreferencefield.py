@@ -0,0 +1,141 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+from bika.lims.browser.fields import uidreferencefield
+from bika.lims.browser.fields.uidreferencefield import UIDReferenceField
+from bika.lims.browser.fields.uidreferencefield import UIDReferenceSequence
+from bika.lims.browser.fields.uidreferencefield import get_uid_cache
+from bika.lims.browser.fields.uidreferencefield import resolve_uids
+from bika.lims.testing import BIKA_FUNCTIONAL_TESTING
+from bika.lims.tests.base import BikaFunctionalTestCase
+from bika.lims.utils import tmpID
+from plone.app.testing import login, logout
+from plone.app.testing import TEST_USER_NAME
+from Products.CMFPlone.utils import _createObjectByType
+import transaction
+
+try:
+    import unittest2 as unittest
+except ImportError: # Python 2.7
+    import unittest
+
+
+class TestUIDReferenceField(BikaFunctionalTestCase):
+    layer = BIKA_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        super(TestUIDReferenceField, self).setUp()
+        login(self.portal, TEST_USER_NAME)
+        self.folder = self.portal.batches
+        self.holder = self.addthing(self.folder, 'Batch')
+        self.targets = [self.addthing(self.folder, 'Batch') for i in range(3)]
+        self.uids = [target.UID() for target in self.targets]
+        self.field = UIDReferenceField('TestReferences', multiValued=1)
+        self.cache = get_uid_cache(self.portal)
+        self.cache.clear()
+
+    def tearDown(self):
+        logout()
+        super(TestUIDReferenceField, self).tearDown()
+
+    def addthing(self, folder, portal_type):
+        thing = _createObjectByType(portal_type, folder, tmpID())
+        thing.processForm()
+        return thing
+
+    def count_queries(self):
+        """Returns the list where the uid_catalog queries made from now on
+        are recorded
+        """
+        queries = []
+        get_uid_catalog = uidreferencefield.get_uid_catalog
+
+        def recording_get_uid_catalog(context):
+            catalog = get_uid_catalog(context)
+
+            def query(**kwargs):
+                queries.append(kwargs)
+                return catalog(**kwargs)
+            return query
+        uidreferencefield.get_uid_catalog = recording_get_uid_catalog
+        self.addCleanup(setattr, uidreferencefield, 'get_uid_catalog',
+                        get_uid_catalog)
+        return queries
+
+    def test_resolve_uids(self):
+        queries = self.count_queries()
+        a, b, c = self.uids
+        objects = resolve_uids(self.portal, [a, b, '', 'nonexistent'])
+        self.assertEqual(sorted(objects.keys()), sorted([a, b]))
+        self.assertEqual(objects[a].UID(), a)
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(sorted(self.cache.keys()), sorted([a, b]))
+
+        # Objects resolved during the request are taken from the cache
+        cached = resolve_uids(self.portal, [a, b])
+        self.assertEqual(len(queries), 1)
+        self.assertTrue(cached[a] is objects[a])
+
+        # Only the UIDs not resolved yet are looked up
+        objects = resolve_uids(self.portal, [a, c])
+        self.assertEqual(sorted(objects.keys()), sorted([a, c]))
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(queries[-1]['UID'], [c])
+
+    def test_get_objects(self):
+        self.field.set(self.holder, self.targets)
+        self.assertEqual(self.field.getRaw(self.holder), self.uids)
+        queries = self.count_queries()
+        objects = self.field.get(self.holder)
+        self.assertEqual([obj.UID() for obj in objects], self.uids)
+        self.assertEqual(len(queries), 1)
+
+    def test_lazy_sequence(self):
+        self.field.set(self.holder, self.uids)
+        self.cache.clear()
+        sequence = self.field.get(self.holder, lazy=True)
+        self.assertTrue(isinstance(sequence, UIDReferenceSequence))
+        # No object is resolved unless accessed
+        self.assertEqual(len(sequence), 3)
+        self.assertTrue(sequence)
+        self.assertEqual(sequence.getUIDs(), self.uids)
+        self.assertTrue(self.targets[1] in sequence)
+        self.assertTrue(self.uids[1] in sequence)
+        self.assertFalse(self.holder in sequence)
+        self.assertEqual(self.cache, {})
+        self.assertEqual(sequence[1].UID(), self.uids[1])
+        self.assertEqual(self.cache.keys(), [self.uids[1]])
+        self.assertEqual([obj.UID() for obj in sequence[1:]], self.uids[1:])
+        self.assertEqual([obj.UID() for obj in sequence], self.uids)
+
+        # Objects removed are left out
+        self.folder.manage_delObjects([self.targets[2].getId()])
+        sequence = self.field.get(self.holder, lazy=True)
+        self.assertEqual(len(sequence), 2)
+        self.assertEqual(sequence.getUIDs(), self.uids[:2])
+        self.assertEqual(len(self.field.getRaw(self.holder)), 3)
+
+    def test_cache_invalidated_after_move(self):
+        uid = self.uids[0]
+        obj = resolve_uids(self.portal, [uid])[uid]
+        self.assertTrue(uid in self.cache)
+        transaction.savepoint(optimistic=True)
+        self.folder.manage_renameObject(obj.getId(), 'renamed')
+        self.assertFalse(uid in self.cache)
+        obj = resolve_uids(self.portal, [uid])[uid]
+        self.assertEqual(obj.getId(), 'renamed')
+        self.assertEqual(obj.getPhysicalPath()[-1], 'renamed')
+
+        # Objects removed are no longer returned
+        self.folder.manage_delObjects(['renamed'])
+        self.assertFalse(uid in self.cache)
+        self.assertEqual(resolve_uids(self.portal, [uid]), {})
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestUIDReferenceField))
+    suite.layer = BIKA_FUNCTIONAL_TESTING
+    return suite
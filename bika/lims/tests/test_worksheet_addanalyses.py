@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+from bika.lims.testing import BIKA_FUNCTIONAL_TESTING
+from bika.lims.tests.base import BikaFunctionalTestCase
+from bika.lims.utils import tmpID
+from bika.lims.utils.analysisrequest import create_analysisrequest
+from plone.app.testing import login, logout
+from plone.app.testing import TEST_USER_NAME
+from Products.CMFCore.utils import getToolByName
+from Products.CMFPlone.utils import _createObjectByType
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+
+class TestWorksheetAddAnalyses(BikaFunctionalTestCase):
+    layer = BIKA_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        super(TestWorksheetAddAnalyses, self).setUp()
+        login(self.portal, TEST_USER_NAME)
+
+    def tearDown(self):
+        logout()
+        super(TestWorksheetAddAnalyses, self).tearDown()
+
+    def create_ar(self):
+        client = self.portal.clients['client-1']
+        sampletype = self.portal.bika_setup.bika_sampletypes['sampletype-1']
+        values = {'Client': client.UID(),
+                  'Contact': client.getContacts()[0].UID(),
+                  'SamplingDate': '2015-01-01',
+                  'SampleType': sampletype.UID()}
+        servs = self.portal.bika_setup.bika_analysisservices
+        services = [servs['analysisservice-3'].UID(),
+                    servs['analysisservice-6'].UID()]
+        ar = create_analysisrequest(client, {}, values, services)
+        wf = getToolByName(ar, 'portal_workflow')
+        wf.doActionFor(ar, 'receive')
+        return ar
+
+    def test_add_analyses(self):
+        ar1 = self.create_ar()
+        ar2 = self.create_ar()
+        wsfolder = self.portal.worksheets
+        ws = _createObjectByType("Worksheet", wsfolder, tmpID())
+        ws.processForm()
+        self.request['context_uid'] = ws.UID()
+        analyses = ar1.getAnalyses(full_objects=True) + \
+            ar2.getAnalyses(full_objects=True)
+        ws.addAnalyses(analyses, {ar2.UID(): 3})
+        self.assertEqual(len(ws.getAnalyses()), 4)
+        positions = dict([(slot['analysis_uid'], int(slot['position']))
+                          for slot in ws.getLayout()])
+        for an in ar1.getAnalyses(full_objects=True):
+            self.assertEqual(positions[an.UID()], 1)
+        for an in ar2.getAnalyses(full_objects=True):
+            self.assertEqual(positions[an.UID()], 3)
+        wf = getToolByName(ws, 'portal_workflow')
+        for an in analyses:
+            self.assertEqual(
+                wf.getInfoFor(an, 'worksheetanalysis_review_state'),
+                'assigned')
+        # Analyses already in the worksheet are not added twice
+        ws.addAnalyses(analyses)
+        self.assertEqual(len(ws.getLayout()), 4)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestWorksheetAddAnalyses))
+    suite.layer = BIKA_FUNCTIONAL_TESTING
+    return suite
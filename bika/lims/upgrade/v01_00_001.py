@@ -0,0 +1,60 @@
+from Acquisition import aq_inner
+from Acquisition import aq_parent
+from Products.CMFCore.utils import getToolByName
+
+from bika.lims import logger
+from bika.lims.analytics import rebuild_analyses_extract
+from bika.lims.backreferences import get_reference_storage
+from bika.lims.backreferences import rebuild_references
+from bika.lims.catalog import getCatalogDefinitions
+from bika.lims.catalog import setup_catalogs
+from bika.lims.dashboard_counters import rebuild_evolution_counters
+from bika.lims.upgrade import upgradestep
+from bika.lims.upgrade.utils import UpgradeUtils
+from bika.lims.config import  PROJECTNAME as product
+import transaction
+
+version = '1.0.1'
+profile = 'profile-{0}:default'.format(product)
+
+
+@upgradestep(product, version)
+def upgrade(tool):
+    portal = aq_parent(aq_inner(tool))
+    ut = UpgradeUtils(portal)
+    ver_from = ut.getInstalledVersion(product)
+
+    logger.info("Upgrading {0}: {1} -> {2}".format(product, ver_from, version))
+
+    # Add the indexes and columns added to the catalogs definitions. Only
+    # those are filled for the objects already catalogued
+    setup_catalogs(portal, getCatalogDefinitions(), backfill=True)
+
+    # Count the existing objects for the evolution charts of the dashboard
+    rebuild_evolution_counters(portal)
+
+    # Index the worksheet of each analysis and store it as metadata
+    rebuild_references(portal, 'WorksheetAnalysis')
+    reindex_worksheet_uids(portal)
+
+    # Extract the analyses the productivity and QC reports are built from
+    rebuild_analyses_extract(portal)
+
+    logger.info("{0} upgraded to version {1}".format(product, version))
+    return True
+
+
+def reindex_worksheet_uids(portal):
+    """Fills the getWorksheetUID column of the analyses assigned to a
+    worksheet. Other analyses have no worksheet, so the column is left empty.
+    """
+    backrefs, forwardrefs = get_reference_storage(portal)
+    uids = [uid for (relationship, uid) in backrefs.keys()
+            if relationship == 'WorksheetAnalysis']
+    logger.info("Reindexing the worksheet of {0} analyses".format(len(uids)))
+    uc = getToolByName(portal, 'uid_catalog')
+    for num, brain in enumerate(uc(UID=uids)):
+        analysis = brain.getObject()
+        analysis.reindexObject(idxs=['getWorksheetUID'])
+        if num and num % 1000 == 0:
+            transaction.savepoint(optimistic=True)
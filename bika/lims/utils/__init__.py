@@ -367,6 +367,10 @@ def changeWorkflowState(content, wf_id, state_id, acquire_permissions=False,
 
     # Map changes to the catalogs
     content.reindexObject(idxs=['allowedRolesAndUsers', 'review_state'])
+
+    # No transition event is fired, so update the dashboard counters here
+    from bika.lims.dashboard_counters import update_evolution_counters
+    update_evolution_counters(content)
     return
 
 
@@ -15,6 +15,7 @@ from Products.CMFCore.utils import getToolByName
 from Products.CMFPlone.utils import _createObjectByType
 from bika.lims import bikaMessageFactory as _, logger
 from bika.lims.interfaces import IAnalysisService
+from bika.lims.interfaces import IRoutineAnalysis
 from bika.lims.utils import changeWorkflowState
 from bika.lims.utils import formatDecimalMark
 from bika.lims.utils import to_unicode
@@ -598,3 +599,133 @@ def get_method_instrument_constraints(context, uids):
             constraints[auid][muid] = targ
             cached_servs[cachedkey][suid][muid] = targ
     return constraints
+
+
+class RecalculationPass(object):
+    """Calculates, in a single pass, the results of the analyses passed in
+    and of the calculated analyses that depend on them.
+
+    The dependency graph of each group of sibling analyses (e.g. the
+    analyses of an Analysis Request) is built once, from the services the
+    calculations depend on. The calculated analyses are sorted so that each
+    one comes after the analyses it depends on, and each one is calculated
+    exactly once. The values read from the dependencies are shared by all
+    the calculations of the pass.
+    """
+
+    def __init__(self, analyses):
+        # uids of the analyses passed in
+        self.changed = set()
+        # list of tuples (calculated analyses sorted, requirements), where
+        # requirements maps the uid of each calculated analysis to the uids
+        # of the siblings it depends on, directly or not
+        self.groups = []
+        # uid -> list of siblings the analysis depends on directly
+        self.dependencies = {}
+        # uid -> values the analysis provides to calculations
+        self.values = {}
+        self._keywords = {}
+        grouped = {}
+        for analysis in analyses:
+            uid = analysis.UID()
+            self.changed.add(uid)
+            # siblings are shared by all the analyses of the group
+            members = grouped.setdefault(analysis.portal_type, set())
+            if uid in members:
+                continue
+            if IRoutineAnalysis.providedBy(analysis):
+                group = [analysis] + analysis.getSiblings()
+            else:
+                group = [analysis]
+            members.update([member.UID() for member in group])
+            self._add_group(group)
+
+    def _get_keywords(self, calculation):
+        """Returns a tuple (direct, flat) with the sets of keywords of the
+        services the calculation depends on directly, and directly or
+        through other calculations
+        """
+        uid = calculation.UID()
+        if uid not in self._keywords:
+            direct = set([service.getKeyword() for service in
+                          calculation.getDependentServices()])
+            flat = calculation.getCalculationDependencies(flat=True)
+            flat = set([service.getKeyword() for service in flat])
+            self._keywords[uid] = (direct, flat | direct)
+        return self._keywords[uid]
+
+    def _add_group(self, group):
+        keywords = [(analysis.UID(), analysis.getKeyword())
+                    for analysis in group]
+        calculated = []
+        requirements = {}
+        for analysis in group:
+            calculation = analysis.getCalculation()
+            if not calculation:
+                continue
+            uid = analysis.UID()
+            direct, flat = self._get_keywords(calculation)
+            self.dependencies[uid] = [
+                sibling for sibling, (suid, keyword) in zip(group, keywords)
+                if suid != uid and keyword in direct]
+            requirements[uid] = set([suid for suid, keyword in keywords
+                                     if suid != uid and keyword in flat])
+            calculated.append(analysis)
+        self.groups.append((self._sort(calculated, requirements),
+                            requirements))
+
+    def _sort(self, calculated, requirements):
+        """Sorts the calculated analyses so that each one comes after the
+        calculated analyses it depends on. Analyses in a dependency cycle
+        are left at the end, in their original order.
+        """
+        pending = [analysis.UID() for analysis in calculated]
+        by_uid = dict(zip(pending, calculated))
+        required = dict([(uid, requirements[uid] & set(pending))
+                         for uid in pending])
+        order = []
+        done = set()
+        while pending:
+            ready = [uid for uid in pending if not required[uid] - done]
+            if not ready:
+                logger.warn("Circular dependency between the calculations "
+                            "of %s" % ', '.join(pending))
+                ready = pending
+            order.extend([by_uid[uid] for uid in ready])
+            done.update(ready)
+            pending = [uid for uid in pending if uid not in done]
+        return order
+
+    def getDependencies(self, analysis):
+        """Returns the siblings the analysis depends on directly
+        """
+        return self.dependencies.get(analysis.UID(), [])
+
+    def calculate(self, override=False, keep=()):
+        """Calculates the analyses passed in and the ones that depend on
+        them, except the ones whose uid is in keep, which already have the
+        result they must keep (e.g. imported from a file). Returns the list
+        of analyses whose result has been set.
+        """
+        calculated = []
+        affected = set(self.changed)
+        done = set()
+        for order, requirements in self.groups:
+            for analysis in order:
+                uid = analysis.UID()
+                if uid in done:
+                    continue
+                if uid not in affected and \
+                        not requirements[uid] & affected:
+                    continue
+                affected.add(uid)
+                done.add(uid)
+                if uid in keep:
+                    continue
+                if analysis.calculateResult(
+                        override, dependencies=self.dependencies[uid],
+                        values=self.values):
+                    # The values read before are no longer valid
+                    self.values.pop(uid, None)
+                    calculated.append(analysis)
+        return calculated
@@ -156,7 +156,7 @@ def after_attach(obj):
             workflow.doActionFor(ar, "attach")
     # If assigned to a worksheet and all analyses on the worksheet have
     # been attached, then attach the worksheet.
-    ws = obj.getBackReferences('WorksheetAnalysis')
+    ws = obj.getWorksheet()
     if ws:
         ws_state = workflow.getInfoFor(ws, "review_state")
         if ws_state == "attachment_due" \
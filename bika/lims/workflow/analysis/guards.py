@@ -52,7 +52,7 @@ def import_transition(obj):
 def attach(obj):
     if not isBasicTransitionAllowed(obj):
         return False
-    if not obj.getAttachment():
+    if not obj.getAttachment(lazy=True):
         return obj.getAttachmentOption() != 'r'
     return True
 
@@ -67,10 +67,9 @@ def unassign(obj):
     mtool = getToolByName(obj, "portal_membership")
     if not isBasicTransitionAllowed(obj):
         return False
-    ws = obj.getBackReferences("WorksheetAnalysis")
+    ws = obj.getWorksheet()
     if not ws:
         return False
-    ws = ws[0]
     if isBasicTransitionAllowed(ws):
         if mtool.checkPermission(Unassign, ws):
             return True